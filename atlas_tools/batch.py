@@ -0,0 +1,283 @@
+from __future__ import print_function
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+
+from atlas_tools.cache import cache_from_args
+from atlas_tools.countries import DETAIL_LEVELS, DEFAULT_DETAIL
+from atlas_tools.dns_map import make_map
+from atlas_tools.grid import LatencyGrid
+from atlas_tools.latency_countrymap import draw_countrymap, country_latencies
+from atlas_tools.latency_heatmap import BACKENDS, DEFAULT_BACKEND, render_heatmap
+from atlas_tools.measurement import PingMeasure
+from atlas_tools.profiling import profile_from_args, span
+from atlas_tools.ripe_atlas import completion_from_args, server_from_args
+from atlas_tools.scheduler import MeasurementScheduler
+from atlas_tools.util import base_parser, atlas_parser, start_logger
+
+OUTPUTS = ('heatmap', 'countrymap', 'dnsmap')
+OUTPUT_NAMES = {
+    'heatmap': 'heatmap_%s.png',
+    'countrymap': 'countrymap_%s.html',
+    'dnsmap': 'dnsmap_%s.html',
+}
+# raw results of a target held before they are parsed
+PARSE_BATCH = 1000
+RENDER_WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+
+def read_targets(targets, targets_file=None):
+    # one target per line, '#' starts a comment; duplicates are measured once
+    targets = list(targets)
+    if targets_file is not None:
+        with open(targets_file) as fd:
+            for line in fd:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    targets.append(line)
+
+    unique = []
+    for target in targets:
+        if target not in unique:
+            unique.append(target)
+    return unique
+
+
+def _form_measures(targets, atlas_key, country=None, probe_limit=None, timeout=None,
+                   cache=None, completion=None):
+    # the probes are listed once, for the first target
+    probe_params = {}
+    if country is not None:
+        probe_params['country_code'] = country
+
+    measures = []
+    probes_data = None
+    for target in targets:
+        measure = PingMeasure(
+            target,
+            atlas_key,
+            probes_features=probe_params,
+            probes_data=probes_data,
+            probe_number=probe_limit,
+            timeout=timeout,
+            cache=cache,
+            completion=completion
+        )
+        probes_data = measure.probes_data
+        measures.append(measure)
+
+    return measures
+
+
+def _schedule(measures, timeout=None):
+    # all the targets share the Atlas limits, so they go through one scheduler
+    atlas = measures[0].atlas
+    with span('create_measurements', type='ping', targets=len(measures)) as create_span:
+        scheduler = MeasurementScheduler(atlas, timeout=timeout)
+        target_jobs = [
+            (measure, scheduler.add(atlas.create_ping(target=measure.target), measure.probes_data))
+            for measure in measures
+        ]
+        scheduler.run()
+
+        for measure, jobs in target_jobs:
+            for job in jobs:
+                measure.response.extend(job.measurements)
+
+        create_span.set(items=sum(len(measure.response) for measure in measures))
+
+
+def _collect(measures, timeout=None):
+    # results of all the measurements are downloaded concurrently and parsed
+    # per target in batches of PARSE_BATCH
+    measure_by_id = {}
+    for measure in measures:
+        for msm_id in measure.response:
+            measure_by_id[msm_id] = measure
+
+    atlas = measures[0].atlas
+    pending = dict((measure.target, []) for measure in measures)
+    with span('parse_results', type='ping', targets=len(measures)) as parse_span:
+        for msm_id, item in atlas.iter_measurement_results(sorted(measure_by_id), timeout):
+            measure = measure_by_id[msm_id]
+            msm_data = pending[measure.target]
+            msm_data.append(item)
+            if len(msm_data) >= PARSE_BATCH:
+                measure.add_results(msm_data)
+                pending[measure.target] = []
+
+        for measure in measures:
+            measure.add_results(pending[measure.target])
+
+        parse_span.set(items=sum(len(measure.results) for measure in measures))
+
+
+def measure_targets(targets, atlas_key, country=None, probe_limit=None, timeout=None,
+                    cache=None, completion=None):
+    measures = _form_measures(
+        targets, atlas_key,
+        country=country,
+        probe_limit=probe_limit,
+        timeout=timeout,
+        cache=cache,
+        completion=completion
+    )
+    _schedule(measures, timeout=timeout)
+
+    for measure in measures:
+        print('Atlas ping measurement IDs for %s: %s' %
+              (measure.target, ' '.join(str(mid) for mid in measure.response)))
+
+    _collect(measures, timeout=timeout)
+    return measures
+
+
+def _render(output, ping_results, fname, target, options):
+    # module level, so that it can run in a worker process
+    with span('render_output', output=output, target=target, items=len(ping_results)):
+        if output == 'heatmap':
+            density = options['density']
+            grid = LatencyGrid(density, minimums=False).add(ping_results)
+            render_heatmap(
+                grid.means(), density, fname, target,
+                backend=options['backend'],
+                basemap_dir=options['basemap_dir']
+            )
+        elif output == 'countrymap':
+            draw_countrymap(country_latencies(ping_results), fname, detail=options['detail'])
+        else:
+            make_map(ping_results, fname)
+
+    return fname
+
+
+def render_outputs(measures, outputs, output_dir='.', workers=RENDER_WORKERS, **options):
+    tasks = []
+    for measure in measures:
+        if not len(measure.results):
+            logger.warning('No results for %s, nothing to draw', measure.target)
+            continue
+
+        for output in outputs:
+            fname = os.path.join(output_dir, OUTPUT_NAMES[output] % measure.target)
+            tasks.append((output, measure.results, fname, measure.target, options))
+
+    if workers <= 1 or len(tasks) <= 1:
+        futures = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=min(workers, len(tasks)))
+        futures = [pool.submit(_render, *task) for task in tasks]
+
+    rendered = []
+    try:
+        for i, task in enumerate(tasks):
+            output, _, fname, target, _ = task
+            # a failed output doesn't stop the others
+            try:
+                if futures is None:
+                    _render(*task)
+                else:
+                    futures[i].result()
+            except Exception:
+                logger.exception('Drawing %s of %s failed', output, target)
+                continue
+
+            rendered.append(fname)
+    finally:
+        if futures is not None:
+            pool.shutdown()
+
+    return rendered
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        parents=[base_parser(), atlas_parser(multiple_targets=True)],
+        description='measure many targets from the same probes and draw their maps'
+    )
+    parser.add_argument(
+        '--targets-file',
+        metavar='FILE',
+        help="read more targets from FILE, one per line, '#' starts a comment"
+    )
+    parser.add_argument(
+        '-O', '--outputs',
+        nargs='+',
+        choices=OUTPUTS,
+        default=list(OUTPUTS),
+        help='maps to draw for every target (default: all of them)'
+    )
+    parser.add_argument(
+        '-o', '--output-dir',
+        metavar='DIR',
+        default='.',
+        help="directory of the maps, named as by the single target tools "
+             "(default: current directory)"
+    )
+    parser.add_argument(
+        '-w', '--render-workers',
+        type=int,
+        default=RENDER_WORKERS,
+        metavar='N',
+        help='processes drawing the maps (default: %d)' % RENDER_WORKERS
+    )
+    parser.add_argument(
+        '-d', '--density',
+        type=int,
+        default=4,
+        help='heatmap cells number per degree (default: 4)'
+    )
+    parser.add_argument(
+        '-b', '--backend',
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help='heatmap backend, see atlas-heatmap (default: %s)' % DEFAULT_BACKEND
+    )
+    parser.add_argument(
+        '--detail',
+        choices=sorted(DETAIL_LEVELS),
+        default=DEFAULT_DETAIL,
+        help='level of detail of countrymap borders (default: %s)' % DEFAULT_DETAIL
+    )
+    args = parser.parse_args()
+
+    targets = read_targets(args.targets, args.targets_file)
+    if not targets:
+        parser.error('no targets: use -t or --targets-file')
+    if args.key is None:
+        parser.error('Atlas key (-k) is required for creating new measurements')
+
+    start_logger('atlas_tools', verbose=args.verbose)
+    profile_from_args(args)
+    server_from_args(args)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    cache = cache_from_args(args)
+    with span('run', tool='atlas-batch', targets=len(targets)):
+        measures = measure_targets(
+            targets, args.key,
+            country=args.country,
+            probe_limit=args.probe_number,
+            timeout=args.timeout,
+            cache=cache,
+            completion=completion_from_args(args)
+        )
+        render_outputs(
+            measures, args.outputs,
+            output_dir=args.output_dir,
+            workers=args.render_workers,
+            density=args.density,
+            backend=args.backend,
+            basemap_dir=cache.basemaps if cache is not None else None,
+            detail=args.detail
+        )
+
+
+if __name__ == '__main__':
+    main()
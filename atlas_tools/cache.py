@@ -0,0 +1,281 @@
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+from ripe.atlas.cousteau import ProbeRequest
+
+from atlas_tools.reverse_dns import PtrCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'atlas_tools')
+PROBES_FILENAME = 'probes.sqlite'
+RESULTS_DIRNAME = 'results'
+PTR_FILENAME = 'ptr.json'
+BASEMAPS_DIRNAME = 'basemaps'
+# seconds the probe catalog is used as is before an incremental refresh
+PROBES_TTL = 3600
+# seconds between full reloads, which pick up changed tags and locations
+PROBES_FULL_REFRESH = 7 * 24 * 3600
+# probe IDs per request of the probes missing from the catalog
+MISSING_PROBES_BATCH = 500
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def _tags_value(probe):
+    # ',slug1,slug2,' to match a single tag with LIKE '%,slug,%'
+    slugs = [tag['slug'] for tag in probe.get('tags') or []]
+    return ',%s,' % ','.join(slugs)
+
+
+def _split_value(value):
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [item for item in str(value).split(',') if item]
+
+
+class ProbeCatalog(object):
+    # probe filters of the Atlas API the catalog can answer
+    FILTERS = ('status_name', 'tags', 'country_code', 'id__in')
+
+    def __init__(self, path, ttl=PROBES_TTL):
+        _makedirs(os.path.dirname(path))
+        self.path = path
+        self.ttl = ttl
+
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS probes ('
+                'id INTEGER PRIMARY KEY, country_code TEXT, asn_v4 INTEGER, '
+                'longitude REAL, latitude REAL, status_name TEXT, tags TEXT)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS sync (name TEXT PRIMARY KEY, value REAL)'
+            )
+
+    def _get_sync(self, name):
+        row = self.connection.execute(
+            'SELECT value FROM sync WHERE name = ?', (name,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _set_sync(self, name, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO sync (name, value) VALUES (?, ?)', (name, value)
+        )
+
+    def _store(self, probes):
+        rows = []
+        for probe in probes:
+            geometry = probe.get('geometry') or {}
+            lon, lat = geometry.get('coordinates') or (None, None)
+            status = probe.get('status') or {}
+            rows.append((
+                probe['id'], probe.get('country_code'), probe.get('asn_v4'),
+                lon, lat, status.get('name'), _tags_value(probe)
+            ))
+
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+        )
+        return len(rows)
+
+    def refresh(self, force=False):
+        now = time.time()
+        last_sync = self._get_sync('last_sync')
+        full_sync = self._get_sync('full_sync')
+
+        if not force and last_sync is not None and now - last_sync < self.ttl:
+            return
+
+        with self.connection:
+            if force or full_sync is None or now - full_sync >= PROBES_FULL_REFRESH:
+                logger.info('Loading the probe catalog')
+                self.connection.execute('DELETE FROM probes')
+                count = self._store(ProbeRequest())
+                self._set_sync('full_sync', now)
+
+            else:
+                # probes whose status changed since the last sync and new ones
+                max_id = self.connection.execute('SELECT MAX(id) FROM probes').fetchone()[0]
+                count = self._store(ProbeRequest(status_since__gte=int(last_sync)))
+                count += self._store(ProbeRequest(id__gt=max_id or 0))
+
+            self._set_sync('last_sync', now)
+
+        logger.info('Probe catalog refreshed: %d probes updated', count)
+
+    def _load_missing(self, probe_ids):
+        # probes asked for by ID but unknown to the catalog, e.g. created
+        # since the last sync
+        known = set(row[0] for row in self.connection.execute('SELECT id FROM probes'))
+        missing = sorted(probe_ids - known)
+        if not missing:
+            return
+
+        logger.info('Loading %d probes missing from the catalog', len(missing))
+        with self.connection:
+            for start in range(0, len(missing), MISSING_PROBES_BATCH):
+                self._store(ProbeRequest(id__in=missing[start:start + MISSING_PROBES_BATCH]))
+
+        known = set(row[0] for row in self.connection.execute('SELECT id FROM probes'))
+        unknown = [probe_id for probe_id in missing if probe_id not in known]
+        if unknown:
+            logger.warning('%d probes are unknown to Atlas, their results are dropped: %s',
+                           len(unknown), ' '.join(str(probe_id) for probe_id in unknown))
+
+    @classmethod
+    def supports(cls, atlas_params):
+        return all(name in cls.FILTERS for name in atlas_params)
+
+    def select(self, atlas_params, limit=None):
+        self.refresh()
+
+        conditions = []
+        values = []
+        probe_ids = None
+        for name, value in atlas_params.items():
+            if name == 'status_name':
+                conditions.append('status_name = ?')
+                values.append(value)
+            elif name == 'country_code':
+                conditions.append('country_code = ? COLLATE NOCASE')
+                values.append(value)
+            elif name == 'tags':
+                for tag in _split_value(value):
+                    conditions.append("tags LIKE ?")
+                    values.append('%%,%s,%%' % tag)
+            elif name == 'id__in':
+                probe_ids = set(int(probe_id) for probe_id in _split_value(value))
+            else:
+                raise ValueError('unsupported probe filter: %s' % name)
+
+        if probe_ids is not None:
+            self._load_missing(probe_ids)
+
+        query = 'SELECT id, country_code, asn_v4, longitude, latitude FROM probes'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY id'
+
+        probes_data = {}
+        for probe_id, country_code, asn_v4, lon, lat in self.connection.execute(query, values):
+            if probe_ids is not None and probe_id not in probe_ids:
+                continue
+
+            probes_data[probe_id] = {
+                'id': probe_id,
+                'country_code': country_code,
+                'asn_v4': asn_v4,
+                'geometry': {'type': 'Point', 'coordinates': [lon, lat]}
+            }
+
+            if limit is not None and len(probes_data) >= limit:
+                break
+
+        return probes_data
+
+
+class ResultCache(object):
+    # Results of stopped measurements, one gzipped JSON lines file per
+    # measurement ID.
+
+    def __init__(self, path):
+        _makedirs(path)
+        self.path = path
+
+    def _filename(self, msm_id):
+        return os.path.join(self.path, '%d.jsonl.gz' % msm_id)
+
+    def __contains__(self, msm_id):
+        return os.path.exists(self._filename(msm_id))
+
+    def iter_results(self, msm_id):
+        with gzip.open(self._filename(msm_id), 'rt') as fd:
+            for line in fd:
+                yield json.loads(line)
+
+    def load(self, msm_id):
+        if msm_id not in self:
+            return None
+        return list(self.iter_results(msm_id))
+
+    def store(self, msm_id, results):
+        for _ in self.store_iter(msm_id, results):
+            pass
+
+    def store_iter(self, msm_id, results):
+        # Yields the results while writing them to a temporary file, which
+        # becomes the cached measurement only once all of them are read, so
+        # that readers never see a partially written measurement. `results`
+        # must raise rather than end early if they are incomplete.
+        fd, tmp_fname = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        stored = False
+        try:
+            with gzip.open(tmp_fname, 'wt') as fd:
+                for item in results:
+                    fd.write(json.dumps(item, separators=(',', ':')))
+                    fd.write('\n')
+                    yield item
+            os.rename(tmp_fname, self._filename(msm_id))
+            stored = True
+        finally:
+            if not stored:
+                os.unlink(tmp_fname)
+
+
+class ResultSpool(object):
+    # results kept in a temporary file to be read again
+
+    def __init__(self):
+        self._fd = tempfile.TemporaryFile(mode='w+')
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        self._fd.flush()
+        self._fd.seek(0)
+        for line in self._fd:
+            yield json.loads(line)
+
+    def append(self, item):
+        self._fd.seek(0, os.SEEK_END)
+        self._fd.write(json.dumps(item, separators=(',', ':')))
+        self._fd.write('\n')
+        self._size += 1
+
+    def close(self):
+        self._fd.close()
+
+
+class AtlasCache(object):
+    def __init__(self, path=DEFAULT_CACHE_DIR, probes_ttl=PROBES_TTL):
+        self.path = path
+        self.probes = ProbeCatalog(os.path.join(path, PROBES_FILENAME), ttl=probes_ttl)
+        self.results = ResultCache(os.path.join(path, RESULTS_DIRNAME))
+        self.basemaps = os.path.join(path, BASEMAPS_DIRNAME)
+        self._ptr = None
+
+    @property
+    def ptr(self):
+        if self._ptr is None:
+            self._ptr = PtrCache(os.path.join(self.path, PTR_FILENAME))
+        return self._ptr
+
+
+def cache_from_args(args):
+    if args.no_cache:
+        return None
+    return AtlasCache(args.cache_dir or DEFAULT_CACHE_DIR, probes_ttl=args.probes_ttl)
@@ -0,0 +1,120 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+
+from atlas_tools.util import base_parser, start_logger
+
+SHAPEFILE_DIR = 'countries'
+SHAPEFILE_NAME = 'ne_50m_admin_0_countries.shp'
+GEOJSON_NAME = 'ne_50m_admin_0_countries.%s.geojson.gz'
+
+# simplification tolerance (degrees) and coordinate precision per level of detail
+DETAIL_LEVELS = {
+    'low': (0.1, 2),
+    'medium': (0.02, 3),
+    'full': (None, 4),
+}
+DEFAULT_DETAIL = 'medium'
+
+logger = logging.getLogger(__name__)
+
+
+def _resource_fname(name):
+    import pkg_resources
+
+    resource_dir = pkg_resources.resource_filename(__package__, SHAPEFILE_DIR)
+    return os.path.join(resource_dir, name)
+
+
+def _round_coords(coords, precision):
+    if isinstance(coords[0], (list, tuple)):
+        return [_round_coords(item, precision) for item in coords]
+    return [round(value, precision) for value in coords]
+
+
+def _simplify_borders(geometries, tolerance):
+    # Every shared border is simplified once, so neighbours still meet with
+    # no gaps or overlaps (needs shapely >= 2.1 built with GEOS >= 3.14). The
+    # shapefile has small overlaps, they go to the smaller country so that
+    # enclaves like the Vatican are kept.
+    import shapely
+
+    coverage = shapely.coverage_clean(shapely.make_valid(geometries), merge_strategy='min_area')
+    return shapely.coverage_simplify(coverage, tolerance)
+
+
+def build_countries(detail, shapefile=None, fname=None):
+    # the only place that needs geopandas: run once, load the result after
+    import geopandas
+
+    tolerance, precision = DETAIL_LEVELS[detail]
+
+    countries = geopandas.GeoDataFrame.from_file(
+        shapefile or _resource_fname(SHAPEFILE_NAME)
+    )
+    countries = countries[['iso_a2', 'geometry']]
+    if tolerance is not None:
+        countries = countries.assign(
+            geometry=_simplify_borders(countries.geometry.to_numpy(), tolerance)
+        )
+
+    features = json.loads(countries.to_json())
+    for feature in features['features']:
+        feature.pop('id', None)
+        geometry = feature['geometry']
+        geometry['coordinates'] = _round_coords(geometry['coordinates'], precision)
+
+    if fname is not None:
+        with gzip.open(fname, 'wt') as fd:
+            json.dump(features, fd, separators=(',', ':'))
+
+        logger.info('%s: %d countries', fname, len(features['features']))
+
+    return features
+
+
+def load_countries(detail=DEFAULT_DETAIL):
+    fname = _resource_fname(GEOJSON_NAME % detail)
+    if not os.path.exists(fname):
+        logger.warning('%s is missing, simplifying the shapefile', fname)
+        return build_countries(detail)
+
+    with gzip.open(fname, 'rt') as fd:
+        return json.load(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        parents=[base_parser()],
+        description='precompile simplified country geometries for atlas-countrymap'
+    )
+    parser.add_argument(
+        '-s', '--shapefile',
+        help='source shapefile (default: bundled Natural Earth 50m countries)'
+    )
+    parser.add_argument(
+        'levels',
+        nargs='*',
+        metavar='LEVEL',
+        help='levels of detail to build: %s (default: all)' % ', '.join(sorted(DETAIL_LEVELS))
+    )
+    args = parser.parse_args()
+
+    unknown = set(args.levels) - set(DETAIL_LEVELS)
+    if unknown:
+        parser.error('unknown levels of detail: %s' % ', '.join(sorted(unknown)))
+
+    start_logger('atlas_tools', verbose=args.verbose)
+
+    for detail in args.levels or sorted(DETAIL_LEVELS):
+        build_countries(
+            detail,
+            shapefile=args.shapefile,
+            fname=_resource_fname(GEOJSON_NAME % detail)
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,12 @@
-from collections import defaultdict
 import argparse
 import logging
 
-import folium
-import pandas
+import numpy as np
 
+from atlas_tools.cache import cache_from_args
 from atlas_tools.measurement import ping_measure
+from atlas_tools.profiling import profile_from_args, span
+from atlas_tools.ripe_atlas import completion_from_args, server_from_args
 from atlas_tools.util import base_parser, atlas_parser, ping_parser, start_logger, check_ping_args
 
 logger = logging.getLogger(__name__)
@@ -17,17 +18,40 @@ MAP_COLORS = [
 ]
 
 
-def _make_map(ping_results, fname):
-    logger.info('Drawing DNS map')
+def _group_resolves(ping_results):
+    # [(dst_ip, rows)] with the most frequent resolves first
+    dst_ips, inverse, counts = np.unique(
+        ping_results['dst_ip'], return_inverse=True, return_counts=True
+    )
+    rows = np.split(np.argsort(inverse, kind='stable'), np.cumsum(counts)[:-1])
+    order = np.argsort(-counts, kind='stable')
+    return [(ping_results.ips[dst_ips[i]], rows[i]) for i in order]
 
-    columns_labels = [
-        'probe_id', 'source_ip', 'dst_ip', 'asn',
-        'country', 'latitude', 'longitude', 'latency'
-    ]
 
-    panda_probes = pandas.DataFrame.from_records(
-        ping_results, columns=columns_labels
+def _resolve_features(ping_results, dst_ip, rows):
+    probes = zip(
+        ping_results['probe_id'][rows].tolist(),
+        ping_results['latitude'][rows].tolist(),
+        ping_results['longitude'][rows].tolist()
     )
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+                'properties': {'probe_id': probe_id, 'dst_ip': dst_ip},
+            }
+            for probe_id, lat, lon in probes
+        ]
+    }
+
+
+def make_map(ping_results, fname):
+    logger.info('Drawing DNS map')
+
+    # folium takes a while to import, load it only to render
+    import folium
 
     dns_map = folium.Map(
         location=[20, 20],
@@ -35,54 +59,44 @@ def _make_map(ping_results, fname):
         tiles='Mapbox Bright'
     )
 
-    resolves_counters = defaultdict(int)
-    for name, row in panda_probes.iterrows():
-        resolves_counters[row["dst_ip"]] += 1
-
-    resolves_counters = [
-        (dst_ip, count) for dst_ip, count in resolves_counters.items()
-    ]
-    resolves_counters.sort(key=lambda tup: tup[1], reverse=True)
-
-    marker_clusters = defaultdict(dict)
-    for i, (dst_ip, count) in enumerate(resolves_counters):
+    # a single GeoJSON layer per resolved ip: the markers are drawn
+    # client-side instead of being a separate map object each
+    for i, (dst_ip, rows) in enumerate(_group_resolves(ping_results)):
         color = MAP_COLORS[i % len(MAP_COLORS)]
-        marker_clusters[dst_ip]['count'] = count
-        marker_clusters[dst_ip]['color'] = color
-
-        feature_layer = folium.FeatureGroup(
-            name='Resolved ip: %s, color: %s, count: %s' %
-                 (dst_ip, color, count)
+        style = {'color': color, 'fillColor': color}
+
+        folium.GeoJson(
+            _resolve_features(ping_results, dst_ip, rows),
+            name='Resolved ip: %s, color: %s, count: %s' % (dst_ip, color, len(rows)),
+            marker=folium.CircleMarker(radius=2, fill=True, fill_opacity=1.0),
+            style_function=lambda feature, style=style: style,
+            popup=folium.GeoJsonPopup(
+                fields=['probe_id', 'dst_ip'],
+                aliases=['Probe_id', 'Resolved_ip'],
+                labels=True
+            ),
+            embed=True
         ).add_to(dns_map)
-        marker_clusters[dst_ip]['layer'] = feature_layer
-
-    for name, row in panda_probes.iterrows():
-        dst_ip = row['dst_ip']
-        folium.CircleMarker(
-            location=[float(row['latitude']), float(row['longitude'])],
-            popup="Probe_id: %s<br />Resolved_ip: %s" %
-                  (row['probe_id'], dst_ip),
-            radius=2,
-            fill=True,
-            color=marker_clusters[dst_ip]['color'],
-            fill_opacity=1.0
-        ).add_to(marker_clusters[dst_ip]['layer'])
 
     dns_map.add_child(folium.LayerControl())
     dns_map.save(fname)
 
 
 def create_map(fname, atlas_key, target, country=None,
-               probe_limit=None, timeout=None, measurements_list=None):
+               probe_limit=None, timeout=None, measurements_list=None,
+               cache=None, completion=None):
     pings = ping_measure(
         atlas_key, target,
         country=country,
         probe_limit=probe_limit,
         timeout=timeout,
-        measurements_list=measurements_list
+        measurements_list=measurements_list,
+        cache=cache,
+        completion=completion
     )
 
-    _make_map(pings.results, fname)
+    with span('render', items=len(pings.results)):
+        make_map(pings.results, fname)
 
 
 def main():
@@ -101,14 +115,19 @@ def main():
         args.filename = 'dnsmap_%s.html' % args.target
 
     start_logger('atlas_tools', verbose=args.verbose)
-
-    create_map(
-        args.filename, args.key, args.target,
-        country=args.country,
-        probe_limit=args.probe_number,
-        timeout=args.timeout,
-        measurements_list=args.msms
-    )
+    profile_from_args(args)
+    server_from_args(args)
+
+    with span('run', tool='atlas-dnsmap', target=args.target):
+        create_map(
+            args.filename, args.key, args.target,
+            country=args.country,
+            probe_limit=args.probe_number,
+            timeout=args.timeout,
+            measurements_list=args.msms,
+            cache=cache_from_args(args),
+            completion=completion_from_args(args)
+        )
 
 
 if __name__ == '__main__':
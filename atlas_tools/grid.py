@@ -0,0 +1,482 @@
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import os
+
+import numpy as np
+
+from atlas_tools.util import base_parser, start_logger
+
+LONGITUDE_EQUATOR_1_DEGREE = 111.321
+LATITUDE_1_DEGREE = 111.0
+EARTH_RADIUS = 6371.009
+BASE_VALUE = 0.0
+# km around a probe its latency is spread to
+PROBE_RADIUS = 250
+# mean latencies are drawn no lower than this
+MIN_LATENCY = 30
+# cells closer to the poles are left blank
+MAX_LATITUDE = 80
+
+# 'circle' spreads every latency over PROBE_RADIUS, the others interpolate
+# every cell from its nearest probes: weighted by inverse distance or not
+INTERPOLATIONS = ('circle', 'idw', 'nearest')
+DEFAULT_INTERPOLATION = 'circle'
+NEIGHBOURS = 8
+# km, farther probes are not used for a cell; None for no limit
+MAX_DISTANCE = 1000
+IDW_POWER = 2
+# km, closer probes are weighted as if they were this far
+MIN_DISTANCE = 1.0
+# cells queried at once, bounds the memory of the neighbour arrays
+QUERY_CELLS = 1 << 16
+
+# latency histogram bins, ms
+HISTOGRAM_EDGES = (0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 120, 150, 200, 300, 500)
+
+# grid file: magic, JSON header padded to HEADER_SIZE, 64-byte aligned arrays
+GRID_MAGIC = b'ATLASGRID1\n'
+HEADER_SIZE = 4096
+ARRAY_ALIGNMENT = 64
+
+logger = logging.getLogger(__name__)
+
+# (partial grid buffers, density, latitudes, longitudes, latencies) of a
+# grid worker process
+_worker_state = None
+
+
+def _coords_to_indices(density, lat, lon):
+    lat = int((lat + 90) * density)
+    lon = int((lon + 180) * density)
+    return lat, lon
+
+
+def _indices_to_coords(density, lat, lon):
+    lat = lat / float(density) - 90
+    lon = lon / float(density) - 180
+    return lat, lon
+
+
+def _minmax_coords(center_coord, radius):
+    return center_coord - radius, center_coord + radius + 1
+
+
+def _great_circle(lat1, lon1, lat2, lon2):
+    # same formula and earth radius as geopy.distance.great_circle
+    lat1, lon1 = np.radians(lat1), np.radians(lon1)
+    lat2, lon2 = np.radians(lat2), np.radians(lon2)
+
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_lat2, cos_lat2 = np.sin(lat2), np.cos(lat2)
+
+    delta_lon = lon2 - lon1
+    cos_delta_lon, sin_delta_lon = np.cos(delta_lon), np.sin(delta_lon)
+
+    d = np.arctan2(
+        np.sqrt((cos_lat2 * sin_delta_lon) ** 2 +
+                (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lon) ** 2),
+        sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lon
+    )
+    return EARTH_RADIUS * d
+
+
+def _coords_in_circle(density, center_lat_geo, center_lon_geo, radius=PROBE_RADIUS):
+    center_lat_index, center_lon_index = _coords_to_indices(density, center_lat_geo, center_lon_geo)
+
+    lon_radius = int(
+        density * radius /
+        (math.cos(math.radians(center_lat_geo)) *
+         LONGITUDE_EQUATOR_1_DEGREE)
+    )
+    # near the poles the window wraps the whole parallel; don't visit a cell twice
+    lon_radius = min(lon_radius, (360 * density - 1) // 2)
+    lat_radius = int(radius / LATITUDE_1_DEGREE * density)
+
+    min_lon, max_lon = _minmax_coords(center_lon_index, lon_radius)
+    min_lat, max_lat = _minmax_coords(center_lat_index, lat_radius)
+
+    lat_indices = np.arange(min_lat, max_lat)
+    lon_indices = np.arange(min_lon, max_lon)
+    lat_geo, lon_geo = _indices_to_coords(density, lat_indices, lon_indices)
+
+    in_range = (lat_geo <= MAX_LATITUDE) & (lat_geo >= -MAX_LATITUDE)
+    lat_indices, lat_geo = lat_indices[in_range], lat_geo[in_range]
+
+    distance = _great_circle(
+        center_lat_geo, center_lon_geo,
+        lat_geo[:, np.newaxis], lon_geo[np.newaxis, :]
+    )
+    lat_hits, lon_hits = np.nonzero(distance <= radius)
+
+    return lat_indices[lat_hits], lon_indices[lon_hits] % (360 * density)
+
+
+def grid_shape(density):
+    return 180 * density + 1, 360 * density
+
+
+def _unit_vectors(lat, lon):
+    # points on the unit sphere: euclidean (chord) distances between them
+    # grow with the great circle distances
+    lat, lon = np.radians(lat), np.radians(lon)
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def _chord(distance):
+    return 2 * np.sin(np.minimum(distance / (2 * EARTH_RADIUS), math.pi / 2))
+
+
+def _arc(chord):
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
+
+
+def interpolate(ping_results, density, method='idw', neighbours=NEIGHBOURS,
+                max_distance=MAX_DISTANCE, power=IDW_POWER, workers=1):
+    # Mean latencies of every cell from its `neighbours` nearest probes, found
+    # by a KD-tree of the probes for all the cells at once. The cost grows
+    # with the number of cells rather than with the probes and their circles,
+    # and cells between the probes get a value as well.
+    final_grid = np.full(grid_shape(density), BASE_VALUE)
+    if not len(ping_results):
+        return final_grid
+
+    from scipy.spatial import cKDTree
+
+    latencies = np.asarray(ping_results['latency'], dtype=np.float64)
+    tree = cKDTree(_unit_vectors(ping_results['latitude'], ping_results['longitude']))
+    k = min(neighbours, len(latencies))
+    upper_bound = np.inf if max_distance is None else _chord(float(max_distance))
+
+    lat_indices = np.arange(final_grid.shape[0])
+    lat_geo, lon_geo = _indices_to_coords(density, lat_indices, np.arange(final_grid.shape[1]))
+    lat_indices = lat_indices[np.abs(lat_geo) <= MAX_LATITUDE]
+
+    rows_number = max(1, QUERY_CELLS // len(lon_geo))
+    for start in range(0, len(lat_indices), rows_number):
+        rows = lat_indices[start:start + rows_number]
+        cells_lat, cells_lon = np.meshgrid(
+            _indices_to_coords(density, rows, 0)[0], lon_geo, indexing='ij'
+        )
+        distances, indices = tree.query(
+            _unit_vectors(cells_lat.ravel(), cells_lon.ravel()),
+            k=k, distance_upper_bound=upper_bound, workers=workers
+        )
+        if k == 1:
+            distances, indices = distances[:, np.newaxis], indices[:, np.newaxis]
+
+        # missing neighbours are at an infinite distance, past the last probe
+        found = np.isfinite(distances)
+        values = latencies[np.minimum(indices, len(latencies) - 1)]
+        if method == 'idw':
+            km = np.maximum(_arc(np.where(found, distances, 0)), MIN_DISTANCE)
+            weights = np.where(found, km ** -float(power), 0)
+        elif method == 'nearest':
+            weights = found.astype(np.float64)
+        else:
+            raise ValueError('unknown interpolation: %s' % method)
+
+        total = weights.sum(axis=1)
+        has_data = total > 0
+        means = np.full(len(total), BASE_VALUE)
+        means[has_data] = np.maximum(
+            MIN_LATENCY, (weights * values).sum(axis=1)[has_data] / total[has_data]
+        )
+        final_grid[rows] = means.reshape(len(rows), len(lon_geo))
+
+    return final_grid
+
+
+class LatencyGrid(object):
+    # Sufficient statistics of the probe latencies spread over the grid
+    # cells: sums and counts, optionally minimums and a histogram. Unlike
+    # the mean latencies, they can be updated with new results and merged.
+
+    def __init__(self, density, minimums=True, histogram=False, arrays=None):
+        self.density = density
+        shape = grid_shape(density)
+
+        if arrays is None:
+            arrays = {
+                'sums': np.zeros(shape, dtype=np.float64),
+                'counts': np.zeros(shape, dtype=np.uint32),
+            }
+            if minimums:
+                arrays['minimums'] = np.full(shape, np.inf, dtype=np.float32)
+            if histogram:
+                arrays['histogram'] = np.zeros(
+                    shape + (len(HISTOGRAM_EDGES),), dtype=np.uint32
+                )
+
+        self.arrays = arrays
+        self.sums = arrays['sums']
+        self.counts = arrays['counts']
+        self.minimums = arrays.get('minimums')
+        self.histogram = arrays.get('histogram')
+
+    def add(self, ping_results, workers=1):
+        # workers: processes, -1 for all the cores
+        if workers == -1:
+            workers = multiprocessing.cpu_count()
+        if workers > 1 and len(ping_results):
+            return self.merge(_parallel_grid(self, ping_results, workers))
+
+        self._update(ping_results, np.add)
+        return self
+
+    def remove(self, ping_results):
+        # latencies added before, e.g. replaced by the newer ones
+        if self.minimums is not None:
+            raise ValueError('latencies can not be removed from a grid with minimums')
+
+        self._update(ping_results, np.subtract)
+        return self
+
+    def _update(self, ping_results, ufunc):
+        self._update_probes(
+            ping_results['latitude'].tolist(),
+            ping_results['longitude'].tolist(),
+            ping_results['latency'].tolist(),
+            ufunc
+        )
+
+    def _update_probes(self, latitudes, longitudes, latencies, ufunc):
+        for lat, lon, rtt in zip(latitudes, longitudes, latencies):
+            cells = _coords_in_circle(self.density, lat, lon)
+            ufunc.at(self.sums, cells, rtt)
+            ufunc.at(self.counts, cells, 1)
+
+            if self.minimums is not None:
+                np.minimum.at(self.minimums, cells, rtt)
+            if self.histogram is not None:
+                bucket = np.searchsorted(HISTOGRAM_EDGES, rtt, side='right') - 1
+                ufunc.at(self.histogram, cells + (max(bucket, 0),), 1)
+
+    def merge(self, other):
+        if other.density != self.density:
+            raise ValueError('grid densities differ: %d and %d' % (self.density, other.density))
+
+        self.sums += other.sums
+        self.counts += other.counts
+        # statistics missing in either of the grids can't be kept
+        if self.minimums is not None:
+            if other.minimums is None:
+                self._drop('minimums')
+            else:
+                np.minimum(self.minimums, other.minimums, out=self.minimums)
+        if self.histogram is not None:
+            if other.histogram is None:
+                self._drop('histogram')
+            else:
+                self.histogram += other.histogram
+
+        return self
+
+    def _drop(self, name):
+        logger.warning('%s are not in all of the merged grids, dropped', name)
+        del self.arrays[name]
+        setattr(self, name, None)
+
+    def means(self):
+        # what the heatmap draws: BASE_VALUE for cells without data
+        final_grid = np.full(self.sums.shape, BASE_VALUE)
+
+        has_data = self.counts > 0
+        final_grid[has_data] = np.maximum(
+            MIN_LATENCY, self.sums[has_data] / self.counts[has_data]
+        )
+
+        return final_grid
+
+    def quantiles(self, q):
+        # upper edges of the histogram buckets holding the q quantile
+        if self.histogram is None:
+            raise ValueError('the grid has no histogram')
+
+        cumulative = np.cumsum(self.histogram, axis=2)
+        buckets = np.argmax(cumulative >= q * cumulative[..., -1:], axis=2)
+        edges = np.append(HISTOGRAM_EDGES[1:], np.inf)
+
+        final_grid = np.full(self.sums.shape, BASE_VALUE)
+        has_data = self.counts > 0
+        final_grid[has_data] = edges[buckets[has_data]]
+        return final_grid
+
+    def save(self, fname):
+        header = {'density': self.density, 'arrays': []}
+        offset = HEADER_SIZE
+        for name in sorted(self.arrays):
+            array = self.arrays[name]
+            header['arrays'].append({
+                'name': name,
+                'dtype': array.dtype.str,
+                'shape': array.shape,
+                'offset': offset,
+            })
+            offset += -(-array.nbytes // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+        header_data = GRID_MAGIC + json.dumps(header).encode()
+        if len(header_data) > HEADER_SIZE:
+            raise ValueError('grid header is too long')
+
+        tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmp_fname, 'wb') as fd:
+            fd.write(header_data.ljust(HEADER_SIZE, b'\0'))
+            for item in header['arrays']:
+                fd.seek(item['offset'])
+                fd.write(np.ascontiguousarray(self.arrays[item['name']]).tobytes())
+            fd.truncate(offset)
+        os.rename(tmp_fname, fname)
+
+    @classmethod
+    def load(cls, fname, writable=False):
+        # The arrays are memory-mapped: changes go to the file if writable,
+        # stay in memory (copy-on-write) otherwise.
+        with open(fname, 'rb') as fd:
+            header_data = fd.read(HEADER_SIZE)
+        if not header_data.startswith(GRID_MAGIC):
+            raise ValueError('%s is not a latency grid file' % fname)
+
+        header = json.loads(header_data[len(GRID_MAGIC):].rstrip(b'\0').decode())
+        arrays = {}
+        for item in header['arrays']:
+            arrays[item['name']] = np.memmap(
+                fname,
+                dtype=np.dtype(item['dtype']),
+                mode='r+' if writable else 'c',
+                offset=item['offset'],
+                shape=tuple(item['shape'])
+            )
+
+        return cls(header['density'], arrays=arrays)
+
+    def flush(self):
+        for array in self.arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+
+
+def _shared_arrays(buffers):
+    return dict(
+        (name, np.frombuffer(buffer, dtype=np.dtype(dtype)).reshape(shape))
+        for name, (buffer, dtype, shape) in buffers.items()
+    )
+
+
+def _shared_grid(grid):
+    # an empty grid of the same statistics in shared memory
+    buffers = dict(
+        (name, (RawArray('b', array.nbytes), array.dtype.str, array.shape))
+        for name, array in grid.arrays.items()
+    )
+    partial = LatencyGrid(grid.density, arrays=_shared_arrays(buffers))
+    if partial.minimums is not None:
+        partial.minimums.fill(np.inf)
+    return partial, buffers
+
+
+def _init_worker(buffers, density, latitudes, longitudes, latencies):
+    global _worker_state
+    _worker_state = buffers, density, latitudes, longitudes, latencies
+
+
+def _fill_shard(shard):
+    # every n-th probe goes to the partial grid of the shard, so the probes
+    # of a crowded region are spread over all the workers
+    buffers, density, latitudes, longitudes, latencies = _worker_state
+    grid = LatencyGrid(density, arrays=_shared_arrays(buffers[shard]))
+    step = len(buffers)
+    grid._update_probes(
+        latitudes[shard::step].tolist(),
+        longitudes[shard::step].tolist(),
+        latencies[shard::step].tolist(),
+        np.add
+    )
+    return shard
+
+
+def _parallel_grid(grid, ping_results, workers):
+    # Every worker adds its shard of the probes to its own partial grid in
+    # shared memory, so they need no locks, and the partials are merged in
+    # place instead of being pickled. Each partial takes as much memory as
+    # the grid.
+    workers = min(workers, len(ping_results))
+    partials = [_shared_grid(grid) for _ in range(workers)]
+    probes = (
+        np.asarray(ping_results['latitude'], dtype=np.float64),
+        np.asarray(ping_results['longitude'], dtype=np.float64),
+        np.asarray(ping_results['latency'], dtype=np.float64),
+    )
+
+    pool = multiprocessing.Pool(
+        workers,
+        initializer=_init_worker,
+        initargs=([buffers for _, buffers in partials], grid.density) + probes
+    )
+    try:
+        for _ in pool.imap_unordered(_fill_shard, range(workers)):
+            pass
+    finally:
+        pool.terminate()
+        pool.join()
+
+    merged = partials[0][0]
+    for partial, _ in partials[1:]:
+        merged.merge(partial)
+    return merged
+
+
+def _make_grid(ping_results, density, workers=1):
+    return LatencyGrid(density, minimums=False).add(ping_results, workers=workers).means()
+
+
+def merge_grids(fnames):
+    grid = None
+    for fname in fnames:
+        other = LatencyGrid.load(fname)
+        grid = other if grid is None else grid.merge(other)
+    return grid
+
+
+def main():
+    # the heatmap module pulls the measurement code in, load it only here
+    from atlas_tools.latency_heatmap import BACKENDS, DEFAULT_BACKEND, render_heatmap
+
+    parser = argparse.ArgumentParser(
+        parents=[base_parser()],
+        description='merge latency grids saved by atlas-heatmap --grid and draw the heatmap'
+    )
+    parser.add_argument('grids', nargs='+', metavar='GRID', help='grid files to merge')
+    parser.add_argument('-o', '--output', help='save the merged grid to this file')
+    parser.add_argument(
+        '-f', '--filename',
+        help='draw the heatmap of the merged grid to this PNG image'
+    )
+    parser.add_argument('-t', '--target', default='', help='target name for the heatmap title')
+    parser.add_argument(
+        '-b', '--backend',
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help='heatmap backend, see atlas-heatmap (default: %s)' % DEFAULT_BACKEND
+    )
+    args = parser.parse_args()
+
+    if args.output is None and args.filename is None:
+        parser.error('nothing to do: neither -o nor -f is given')
+
+    start_logger('atlas_tools', verbose=args.verbose)
+
+    grid = merge_grids(args.grids)
+    if args.output is not None:
+        grid.save(args.output)
+
+    if args.filename is not None:
+        render_heatmap(grid.means(), grid.density, args.filename, args.target, backend=args.backend)
+
+
+if __name__ == '__main__':
+    main()
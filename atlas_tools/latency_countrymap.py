@@ -1,54 +1,50 @@
-from collections import defaultdict
 import argparse
 import logging
-import os
 
-import folium
-import geopandas
-import pandas
-import pkg_resources
+import numpy as np
 
+from atlas_tools.cache import cache_from_args
+from atlas_tools.countries import load_countries, DETAIL_LEVELS, DEFAULT_DETAIL
 from atlas_tools.measurement import ping_measure
+from atlas_tools.profiling import profile_from_args, span
+from atlas_tools.ripe_atlas import completion_from_args, server_from_args
 from atlas_tools.util import base_parser, atlas_parser, ping_parser, start_logger, check_ping_args
 
-SHAPEFILE_DIR = 'countries'
-SHAPEFILE_NAME = 'ne_50m_admin_0_countries.shp'
-
 logger = logging.getLogger(__name__)
 
 
-def _handle_data(ping_results):
-    states_array = defaultdict(list)
-    for (_, _, _, _, region, _, _, rtt) in ping_results:
-        states_array[region].append(rtt)
-
+def country_states(countries, rtt_sums, rtt_counts):
     states = dict()
-    for country, rtt_list in states_array.items():
-        states[country] = min(int(sum(rtt_list) / len(rtt_list)), 120)
+    for country, rtt_sum, rtt_count in zip(countries, rtt_sums, rtt_counts):
+        if rtt_count:
+            states[country] = min(int(rtt_sum / rtt_count), 120)
 
     return states
 
 
-def _choose_color(feature, dataframe, linear):
+def country_latencies(ping_results):
+    countries, country_indices = np.unique(ping_results['country'], return_inverse=True)
+    rtt_sums = np.bincount(country_indices, weights=ping_results['latency'])
+    rtt_counts = np.bincount(country_indices)
+
+    return country_states(countries.tolist(), rtt_sums, rtt_counts)
+
+
+def _choose_color(feature, cut_countries, linear):
     iso = feature['properties']['iso_a2']
-    if iso in dataframe.index:
-        return linear(dataframe.at[iso, 'Latency'])
+    if iso in cut_countries:
+        return linear(cut_countries[iso])
     else:
         return 'lightgrey'
 
 
-def _draw_countrymap(cut_countries, fname):
+def draw_countrymap(cut_countries, fname, detail=DEFAULT_DETAIL):
     logger.info('Drawing the countrymap')
 
-    resource_dir = pkg_resources.resource_filename(__package__, SHAPEFILE_DIR)
-    resource_fname = os.path.join(resource_dir, SHAPEFILE_NAME)
-    df_shapefile_countries = geopandas.GeoDataFrame.from_file(resource_fname)
+    # folium takes a while to import, load it only to render
+    import folium
 
-    dataframe = pandas.DataFrame(
-        data=list(cut_countries.items()),
-        columns=['iso_a2', 'Latency'],
-    )
-    dataframe.set_index('iso_a2', inplace=True)
+    countries = load_countries(detail)
 
     linear = folium.LinearColormap(
         ['green', 'yellow', 'red'], vmin=0., vmax=120.
@@ -61,15 +57,15 @@ def _draw_countrymap(cut_countries, fname):
     )
 
     folium.GeoJson(
-        df_shapefile_countries,
+        countries,
         style_function=lambda feature: {
-            'fillColor': _choose_color(feature, dataframe, linear),
+            'fillColor': _choose_color(feature, cut_countries, linear),
             'color': 'black',
             'weight': 1,
             'fillOpacity': 0.6
         },
         highlight_function=lambda feature: {
-            'fillColor': _choose_color(feature, dataframe, linear),
+            'fillColor': _choose_color(feature, cut_countries, linear),
             'color': 'black',
             'weight': 3,
             'fillOpacity': 0.7,
@@ -82,17 +78,23 @@ def _draw_countrymap(cut_countries, fname):
 
 
 def create_countrymap(fname, atlas_key, target, country=None,
-                      probe_limit=None, timeout=None, measurements_list=None):
+                      probe_limit=None, timeout=None, measurements_list=None,
+                      cache=None, completion=None, detail=DEFAULT_DETAIL):
     pings = ping_measure(
         atlas_key, target,
         country=country,
         probe_limit=probe_limit,
         timeout=timeout,
-        measurements_list=measurements_list
+        measurements_list=measurements_list,
+        cache=cache,
+        completion=completion
     )
 
-    cut_countries = _handle_data(pings.results)
-    _draw_countrymap(cut_countries, fname)
+    with span('handle_data', items=len(pings.results)):
+        cut_countries = country_latencies(pings.results)
+
+    with span('render', detail=detail):
+        draw_countrymap(cut_countries, fname, detail=detail)
 
 
 def main():
@@ -104,6 +106,12 @@ def main():
         '-f', '--filename',
         help="output HTML filename (default: 'countrymap_<target>.html')"
     )
+    parser.add_argument(
+        '--detail',
+        choices=sorted(DETAIL_LEVELS),
+        default=DEFAULT_DETAIL,
+        help='level of detail of country borders (default: %s)' % DEFAULT_DETAIL
+    )
     args = parser.parse_args()
 
     check_ping_args(parser, args)
@@ -111,14 +119,20 @@ def main():
         args.filename = 'countrymap_%s.html' % args.target
 
     start_logger('atlas_tools', verbose=args.verbose)
-
-    create_countrymap(
-        args.filename, args.key, args.target,
-        country=args.country,
-        probe_limit=args.probe_number,
-        timeout=args.timeout,
-        measurements_list=args.msms
-    )
+    profile_from_args(args)
+    server_from_args(args)
+
+    with span('run', tool='atlas-countrymap', target=args.target):
+        create_countrymap(
+            args.filename, args.key, args.target,
+            country=args.country,
+            probe_limit=args.probe_number,
+            timeout=args.timeout,
+            measurements_list=args.msms,
+            cache=cache_from_args(args),
+            completion=completion_from_args(args),
+            detail=args.detail
+        )
 
 
 if __name__ == '__main__':
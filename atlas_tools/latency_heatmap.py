@@ -1,96 +1,38 @@
-from collections import defaultdict
 import argparse
 import logging
-import math
-
-from cartopy import crs
-from geopy.distance import great_circle
-from geoviews import feature as gf
-import geoviews as gv
-import holoviews as hv
-from matplotlib import pyplot
+import os
+
 import numpy as np
-import xarray as xr
 
+from atlas_tools.cache import cache_from_args
+from atlas_tools.grid import LatencyGrid, interpolate, INTERPOLATIONS, DEFAULT_INTERPOLATION, \
+    NEIGHBOURS, MAX_DISTANCE, PROBE_RADIUS
 from atlas_tools.measurement import ping_measure
+from atlas_tools.profiling import profile_from_args, span
+from atlas_tools.raster_heatmap import draw_heatmap
+from atlas_tools.ripe_atlas import completion_from_args, server_from_args
 from atlas_tools.util import base_parser, atlas_parser, ping_parser, start_logger, check_ping_args
 
 
 RENDERER_NAME = 'Agg'
-LONGITUDE_EQUATOR_1_DEGREE = 111.321
-LATITUDE_1_DEGREE = 111.0
-BASE_VALUE = 0.0
+BACKENDS = ('holoviews', 'raster')
+DEFAULT_BACKEND = 'holoviews'
 
 logger = logging.getLogger(__name__)
 
 
-def _coords_to_indices(density, lat, lon):
-    lat = int((lat + 90) * density)
-    lon = int((lon + 180) * density)
-    return lat, lon
-
-
-def _indices_to_coords(density, lat, lon):
-    lat = (float(lat) / density) - 90
-    lon = (float(lon) / density) - 180
-    return lat, lon
-
-
-def _minmax_coords(center_coord, radius):
-    return center_coord - radius, center_coord + radius + 1
-
-
-def _coords_in_circle(density, center_lat_geo, center_lon_geo, radius=250):
-    center_lat_index, center_lon_index = _coords_to_indices(density, center_lat_geo, center_lon_geo)
-
-    lon_radius = int(
-        density * radius /
-        (math.cos(math.radians(center_lat_geo)) *
-         LONGITUDE_EQUATOR_1_DEGREE)
-    )
-    lat_radius = int(radius / LATITUDE_1_DEGREE * density)
-
-    min_lon, max_lon = _minmax_coords(center_lon_index, lon_radius)
-    min_lat, max_lat = _minmax_coords(center_lat_index, lat_radius)
-    for lon_index in range(min_lon, max_lon):
-        for lat_index in range(min_lat, max_lat):
-            lat_geo, lon_geo = _indices_to_coords(density, lat_index, lon_index)
-            if lat_geo > 80 or lat_geo < -80:
-                continue
-
-            lon_index %= (360 * density)
-
-            distance = great_circle(
-                (center_lat_geo, center_lon_geo),
-                (lat_geo, lon_geo)
-            )
-            if distance.kilometers <= radius:
-                yield (lat_index, lon_index)
-
-
-
-def _make_grid(ping_results, density):
-    probes_grid = defaultdict(list)
-    for (_, _, _, _, _, lat, lon, rtt) in ping_results:
-        for coord in _coords_in_circle(density, lat, lon):
-            probes_grid[coord].append(rtt)
-
-    final_grid = np.full(
-        (180 * density + 1, 360 * density),
-        BASE_VALUE
-    )
-
-    for (lat_index, lon_index), rtts in probes_grid.items():
-        final_grid[lat_index][lon_index] = max(
-            30, (sum(rtts) / len(rtts))
-        )
-    
-    return final_grid
-
-
 def _make_heatmap(final_grid, density, fname, target):
     logger.info('Drawing the heatmap')
 
+    # the plotting stack takes seconds to import, load it only to render
+    from cartopy import crs
+    from geoviews import feature as gf
+    import geoviews as gv
+    import holoviews as hv
+    import xarray as xr
+
+    init_renderer()
+
     lat = np.linspace(-90, 90, num=180 * density + 1)
     lon = np.linspace(-179.75, 180, num=360 * density)
 
@@ -134,23 +76,87 @@ def _make_heatmap(final_grid, density, fname, target):
 
 
 def init_renderer():
+    import holoviews as hv
+    from matplotlib import pyplot
+
     hv.extension('matplotlib')
     hv.output(backend='matplotlib')
     pyplot.switch_backend(RENDERER_NAME)
 
 
+def render_heatmap(final_grid, density, fname, target, backend=DEFAULT_BACKEND,
+                   basemap_dir=None):
+    with span('render', backend=backend):
+        if backend == 'raster':
+            draw_heatmap(final_grid, density, fname, target, basemap_dir=basemap_dir)
+        else:
+            _make_heatmap(final_grid, density, fname, target)
+
+
+def _load_grid(grid_file, density, histogram=False):
+    # the statistics of the earlier runs, folded into the file in place
+    if grid_file is None:
+        # only the means are drawn
+        return LatencyGrid(density, minimums=False, histogram=histogram)
+    if not os.path.exists(grid_file):
+        return LatencyGrid(density, histogram=histogram)
+
+    grid = LatencyGrid.load(grid_file, writable=True)
+    if grid.density != density:
+        raise ValueError('%s has density %d, not %d' % (grid_file, grid.density, density))
+
+    logger.info('Adding results to %s', grid_file)
+    return grid
+
+
 def create_heatmap(fname, atlas_key, target, density=4, country=None,
-                   probe_limit=None, timeout=None, measurements_list=None):
+                   probe_limit=None, timeout=None, measurements_list=None,
+                   cache=None, completion=None, backend=DEFAULT_BACKEND,
+                   grid_file=None, histogram=False, interpolation=DEFAULT_INTERPOLATION,
+                   neighbours=NEIGHBOURS, max_distance=MAX_DISTANCE, workers=1):
+    # only the circle statistics add up, the interpolated grids are drawn as is
+    grid = None
+    if interpolation == 'circle':
+        grid = _load_grid(grid_file, density, histogram=histogram)
+    elif grid_file is not None:
+        raise ValueError('%s interpolation can not be kept in a grid file' % interpolation)
+
     pings = ping_measure(
         atlas_key, target,
         country=country,
         probe_limit=probe_limit,
         timeout=timeout,
-        measurements_list=measurements_list
+        measurements_list=measurements_list,
+        cache=cache,
+        completion=completion
     )
 
-    grid = _make_grid(pings.results, density)
-    _make_heatmap(grid, density, fname, target)
+    with span('make_grid', items=len(pings.results), density=density,
+              interpolation=interpolation, workers=workers):
+        if grid is None:
+            final_grid = interpolate(
+                pings.results, density,
+                method=interpolation,
+                neighbours=neighbours,
+                max_distance=max_distance,
+                workers=workers
+            )
+        else:
+            grid.add(pings.results, workers=workers)
+
+    if grid_file is not None:
+        if isinstance(grid.sums, np.memmap):
+            grid.flush()
+        else:
+            grid.save(grid_file)
+    if grid is not None:
+        final_grid = grid.means()
+
+    render_heatmap(
+        final_grid, density, fname, target,
+        backend=backend,
+        basemap_dir=cache.basemaps if cache is not None else None
+    )
 
 
 def main():
@@ -168,25 +174,91 @@ def main():
         default=4,
         help='cells number per dergee (default: 4)'
     )
+    parser.add_argument(
+        '-b', '--backend',
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help="'holoviews' draws through cartopy and geoviews, 'raster' colors "
+             "the grid straight over a cached basemap (default: %s)" % DEFAULT_BACKEND
+    )
+    parser.add_argument(
+        '-g', '--grid',
+        metavar='FILE',
+        help='add the results to the latency statistics in FILE (created if missing) '
+             'and draw all of them, see python -m atlas_tools.grid to merge such files'
+    )
+    parser.add_argument(
+        '--histogram',
+        action='store_true',
+        help='keep a latency histogram of every cell in a new --grid file'
+    )
+    parser.add_argument(
+        '-i', '--interpolation',
+        choices=INTERPOLATIONS,
+        default=DEFAULT_INTERPOLATION,
+        help="'circle' spreads every latency %d km around its probe, 'idw' and "
+             "'nearest' give every cell the mean of its nearest probes, weighted "
+             "by inverse distance or not (default: %s)" % (PROBE_RADIUS, DEFAULT_INTERPOLATION)
+    )
+    parser.add_argument(
+        '--neighbours',
+        type=int,
+        default=NEIGHBOURS,
+        metavar='K',
+        help='probes a cell is interpolated from (default: %d)' % NEIGHBOURS
+    )
+    parser.add_argument(
+        '--max-distance',
+        type=float,
+        default=MAX_DISTANCE,
+        metavar='KM',
+        help='farther probes are not interpolated from, 0 for no limit '
+             '(default: %d)' % MAX_DISTANCE
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        metavar='N',
+        help='processes building the grid, worth it for high densities, '
+             '-1 for all the cores (default: 1)'
+    )
     args = parser.parse_args()
 
     check_ping_args(parser, args)
     if args.filename is None:
         args.filename = 'heatmap_%s.png' % args.target
+    if args.grid is not None and args.interpolation != 'circle':
+        parser.error('--grid keeps the statistics of the circle interpolation only')
+    if args.neighbours < 1:
+        parser.error('--neighbours must be at least 1')
+    if args.max_distance < 0:
+        parser.error('--max-distance must be positive, or 0 for no limit')
+    if args.workers != -1 and args.workers < 1:
+        parser.error('--workers must be -1 or at least 1')
 
     start_logger('atlas_tools', verbose=args.verbose)
-
-    # initialize Matplotlib
-    init_renderer()
-
-    create_heatmap(
-        args.filename, args.key, args.target,
-        density=args.density,
-        country=args.country,
-        probe_limit=args.probe_number,
-        timeout=args.timeout,
-        measurements_list=args.msms
-    )
+    profile_from_args(args)
+    server_from_args(args)
+
+    with span('run', tool='atlas-heatmap', target=args.target):
+        create_heatmap(
+            args.filename, args.key, args.target,
+            density=args.density,
+            country=args.country,
+            probe_limit=args.probe_number,
+            timeout=args.timeout,
+            measurements_list=args.msms,
+            cache=cache_from_args(args),
+            completion=completion_from_args(args),
+            backend=args.backend,
+            grid_file=args.grid,
+            histogram=args.histogram,
+            interpolation=args.interpolation,
+            neighbours=args.neighbours,
+            max_distance=args.max_distance or None,
+            workers=args.workers
+        )
 
 
 if __name__ == '__main__':
@@ -2,32 +2,34 @@ from __future__ import print_function
 
 import logging
 
+from atlas_tools.cache import ResultSpool
+from atlas_tools.profiling import span
+from atlas_tools.results import PingResults, TraceResults
 from atlas_tools.ripe_atlas import Atlas, form_probes
+from atlas_tools.scheduler import MeasurementScheduler
 
-logger = logging.getLogger(__name__)
-
+NO_RTT = float('nan')
+CONNECTED_PROBES = {
+    'status_name': 'Connected',
+    'tags': 'system-ipv4-works',
+}
 
-def chunks(objects_dict, size=10000):
-    chunk = []
-    for obj in objects_dict.keys():
-        chunk.append(obj)
-        if len(chunk) >= size:
-            yield chunk
-            chunk = []
-    if chunk:
-        yield chunk
+logger = logging.getLogger(__name__)
 
 
 class Measure(object):
     def __init__(self, target, atlas_api_key,
                  protocol='ICMP', probes_data=None, probe_number=None,
-                 timeout=None, probes_features=None, measurements_list=None):
-        self.atlas = Atlas(atlas_api_key, protocol=protocol)
+                 timeout=None, probes_features=None, measurements_list=None,
+                 cache=None, completion=None):
+        self.atlas = Atlas(atlas_api_key, protocol=protocol, cache=cache,
+                           completion=completion)
         self.name = ''
         self.target = target
         self.timeout = timeout
+        self.cache = cache
         self.msm_data = list()
-        self.results = list()
+        self.results = self._empty_results()
 
         if measurements_list is None:
             self.response = []
@@ -46,56 +48,93 @@ class Measure(object):
             probe_params = {}
 
         if self.response:
-            probe_ids = []
-            self.msm_data = self.atlas.request_results(self.response, self.timeout)
-            for item in self.msm_data:
-                probe_ids.append(item['prb_id'])
+            # the probes are known only from the results: keep them in a
+            # temporary file to be parsed once the probes are formed
+            probe_ids = set()
+            self.msm_data = ResultSpool()
+            for item in self.atlas.iter_results(self.response, self.timeout):
+                probe_ids.add(item['prb_id'])
+                self.msm_data.append(item)
 
-            probe_params = {'id__in': probe_ids}
+            probe_params = {'id__in': sorted(probe_ids)}
 
         else:
-            probe_params['status_name'] = 'Connected'
-            probe_params['tags'] = "system-ipv4-works"
+            probe_params.update(CONNECTED_PROBES)
+
+        catalog = None if self.cache is None else self.cache.probes
+        with span('form_probes', cached=catalog is not None) as probes_span:
+            probes_data = form_probes(probe_params, limit=probe_number, catalog=catalog)
+            probes_span.set(items=len(probes_data))
 
-        probes_data = form_probes(probe_params, limit=probe_number)
         return probes_data
 
     def _make_measurement(self):
         pass
 
+    def _empty_results(self):
+        return list()
+
     def _form_response(self, measurement):
         logger.info('Forming measurement and waiting response')
 
-        # Atlas limits:
-        # 25 measurements per target simultaneously
-        # 1000 probes per measurement
-        for probes in chunks(self.probes_data, 1000):
-            value = ','.join(str(probe_id) for probe_id in probes)
-            source = self.atlas.create_source(
-                msm_type='probes',
-                value=value,
-                num_of_probes=len(probes)
-            )
+        with span('create_measurements', type=self.name) as create_span:
+            scheduler = MeasurementScheduler(self.atlas, timeout=self.timeout)
+            scheduler.add(measurement, self.probes_data)
+            for job in scheduler.run():
+                self.response.extend(job.measurements)
 
-            is_success, resp = self.atlas.create_request([measurement], source)
-            if is_success:
-                self.response.extend(resp['measurements'])
-
-            else:
-                logger.error('%s %s', is_success, resp)
+            create_span.set(items=len(self.response))
 
     def _flush_results(self):
         pass
 
-    def run(self):
+    def add_results(self, msm_data):
+        # raw results fetched elsewhere, parsed and added to the results
+        self.msm_data = msm_data
+        self._flush_results()
+        return self.results
+
+    def parse(self, msm_data):
+        # the results of msm_data only
+        self.results = self._empty_results()
+        return self.add_results(msm_data)
+
+    def _parse_results(self):
+        with span('parse_results', type=self.name) as parse_span:
+            self._flush_results()
+            parse_span.set(items=len(self.results))
+
+    def _stream(self):
         if not self.response:
             self._make_measurement()
-            self.msm_data = self.atlas.request_results(self.response, self.timeout)
 
         print('Atlas %s measurement IDs: %s' %
               (self.name, ' '.join(str(mid) for mid in self.response)))
 
-        self._flush_results()
+        for msm_data in self.atlas.stream_results(self.response, self.timeout):
+            self.msm_data = msm_data
+            self.results = self._empty_results()
+            self._parse_results()
+            self.msm_data = list()
+
+            yield self.results
+
+    def run(self, stream=False):
+        # In streaming mode a generator is returned: it yields the results
+        # parsed since the previous step while the measurements are running,
+        # and self.results only holds the latest of them.
+        if stream:
+            return self._stream()
+
+        if not self.response:
+            self._make_measurement()
+            # parsed as they are downloaded, the raw results are never all in memory
+            self.msm_data = self.atlas.iter_results(self.response, self.timeout)
+
+        print('Atlas %s measurement IDs: %s' %
+              (self.name, ' '.join(str(mid) for mid in self.response)))
+
+        self._parse_results()
 
 
 class PingMeasure(Measure):
@@ -108,7 +147,17 @@ class PingMeasure(Measure):
         measurement = self.atlas.create_ping(target=self.target)
         self._form_response(measurement)
 
+    def _empty_results(self):
+        return PingResults()
+
+    def parse(self, msm_data):
+        self.failed_probes = {}
+        return super(PingMeasure, self).parse(msm_data)
+
     def _flush_results(self):
+        if isinstance(self.msm_data, (list, ResultSpool)):
+            self.results.reserve(len(self.results) + len(self.msm_data))
+
         for item in self.msm_data:
             prb_id = item['prb_id']
             rtt = item['min']
@@ -129,11 +178,13 @@ class PingMeasure(Measure):
                 continue
 
             lon, lat = prb_data['geometry']['coordinates']
-            data = (
+            self.results.append(
                 prb_id, src_ip, dst_ip, prb_data['asn_v4'],
                 prb_data['country_code'], lat, lon, rtt
             )
-            self.results.append(data)
+
+        # raw results are not needed once parsed
+        self.msm_data = list()
 
 
 class TraceMeasure(Measure):
@@ -145,36 +196,66 @@ class TraceMeasure(Measure):
         measurement = self.atlas.create_traceroute(target=self.target)
         self._form_response(measurement)
 
+    def _empty_results(self):
+        return TraceResults()
+
     def _flush_results(self):
-        parsed_result = []
         for trace_data in self.msm_data:
-            trace = []
-            prb_id = trace_data['prb_id']
-            dst_ip = trace_data['dst_addr']
-            src_ip = trace_data['from']
-            for hop in trace_data['result']:
-                hop_num = hop['hop']
-                if 'error' in hop:
-                    trace.append((hop_num, 'error', hop['error']))
-                    continue
+            self.results.append(
+                trace_data['prb_id'], trace_data['from'], trace_data['dst_addr'],
+                (_parse_hop(hop) for hop in trace_data['result'])
+            )
 
-                hop_ip = hop['result'][0].get('from', '*')
-                hop_rtt = hop['result'][0].get('rtt', '-')
+        self.results.pack()
+        self.msm_data = list()
 
-                trace.append((hop_num, hop_ip, hop_rtt))
 
-                if hop_ip == dst_ip:
-                    trace = []
-                    break
+def _parse_hop(hop):
+    # (hop number, replied IPs, sent, received, min rtt, avg rtt, error)
+    if 'error' in hop:
+        return hop['hop'], (), 0, 0, NO_RTT, NO_RTT, hop['error']
+
+    replies = hop['result']
+    sent = len(replies)
+    ips = []
+    rtts = []
+    for reply in replies:
+        if 'rtt' not in reply:
+            # late replies answer the packets of the earlier hops
+            if 'late' in reply:
+                sent -= 1
+            continue
+        if 'dup' in reply:
+            sent -= 1
+            continue
+
+        rtts.append(reply['rtt'])
+        ip = reply.get('from')
+        if ip is not None and ip not in ips:
+            ips.append(ip)
+
+    if not rtts:
+        return hop['hop'], ips, sent, 0, NO_RTT, NO_RTT, None
+    return hop['hop'], ips, sent, len(rtts), min(rtts), sum(rtts) / len(rtts), None
+
+
+def list_probes(country=None, probe_limit=None, cache=None):
+    # the probes a new measurement would be created for
+    probe_params = dict(CONNECTED_PROBES)
+    if country is not None:
+        probe_params['country_code'] = country
 
-            if trace:
-                parsed_result.append((src_ip, prb_id, trace))
+    catalog = None if cache is None else cache.probes
+    with span('form_probes', cached=catalog is not None) as probes_span:
+        probes_data = form_probes(probe_params, limit=probe_limit, catalog=catalog)
+        probes_span.set(items=len(probes_data))
 
-        self.results.extend(parsed_result)
+    return probes_data
 
 
 def ping_measure(atlas_key, target, country=None,
-                 probe_limit=None, timeout=None, measurements_list=None):
+                 probe_limit=None, timeout=None, measurements_list=None,
+                 cache=None, completion=None):
     probe_params = {}
     if country is not None:
         probe_params['country_code'] = country
@@ -185,20 +266,40 @@ def ping_measure(atlas_key, target, country=None,
         probes_features=probe_params,
         measurements_list=measurements_list,
         probe_number=probe_limit,
-        timeout=timeout
+        timeout=timeout,
+        cache=cache,
+        completion=completion
+    )
+    pings.run()
+
+    return pings
+
+
+def ping_probes(atlas_key, target, probes_data, timeout=None, cache=None,
+                completion=None):
+    pings = PingMeasure(
+        target,
+        atlas_key,
+        probes_data=probes_data,
+        timeout=timeout,
+        cache=cache,
+        completion=completion
     )
     pings.run()
 
     return pings
 
 
-def trace_measure(atlas_key, target, protocol, probes_data, timeout=None):
+def trace_measure(atlas_key, target, protocol, probes_data, timeout=None,
+                  cache=None, completion=None):
     traces = TraceMeasure(
         target,
         atlas_key,
         protocol=protocol,
         probes_data=probes_data,
-        timeout=timeout
+        timeout=timeout,
+        cache=cache,
+        completion=completion
     )
     traces.run()
 
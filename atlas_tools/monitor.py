@@ -0,0 +1,389 @@
+from __future__ import print_function
+
+import argparse
+from collections import defaultdict
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from atlas_tools.cache import cache_from_args
+from atlas_tools.grid import LatencyGrid
+from atlas_tools.latency_countrymap import country_states, draw_countrymap
+from atlas_tools.latency_heatmap import BACKENDS, DEFAULT_BACKEND, render_heatmap
+from atlas_tools.measurement import list_probes, PingMeasure
+from atlas_tools.profiling import profile_from_args, span
+from atlas_tools.results import PingResults
+from atlas_tools.ripe_atlas import Atlas, STREAM_LOOKBACK, server_from_args
+from atlas_tools.scheduler import MeasurementScheduler, plan_chunks, MAX_TARGET_MEASUREMENTS
+from atlas_tools.util import base_parser, atlas_parser, ping_parser, start_logger
+
+# seconds between the rounds of the ongoing pings
+PING_INTERVAL = 900
+# seconds between the result fetches
+CYCLE_INTERVAL = 300
+# latency change (ms) worth drawing the maps again
+CHANGE_THRESHOLD = 5.0
+# ... in this share of the heatmap cells with data
+CHANGED_CELLS = 0.01
+# a probe silent for this many ping rounds is dropped from the maps
+MAX_SILENT_ROUNDS = 3
+
+logger = logging.getLogger(__name__)
+
+
+class ResultWindow(object):
+    # New results of an ongoing measurement. Every fetch starts `lookback`
+    # seconds before the newest result seen, as probes report late; the
+    # results seen in that window are remembered and skipped.
+
+    def __init__(self, since, lookback=STREAM_LOOKBACK):
+        self.newest = since
+        self.lookback = lookback
+        self.seen = set()
+
+    def start(self):
+        return int(self.newest - self.lookback)
+
+    def update(self, results):
+        start = self.start()
+        new_results = []
+        for item in results:
+            key = (item['prb_id'], item['timestamp'])
+            if item['timestamp'] < start or key in self.seen:
+                continue
+
+            self.seen.add(key)
+            self.newest = max(self.newest, item['timestamp'])
+            new_results.append(item)
+
+        # results before the next start are never fetched again
+        start = self.start()
+        self.seen = set(key for key in self.seen if key[1] >= start)
+        return new_results
+
+
+class LatencyAggregates(object):
+    # The latest latency of every probe, summed per country and per heatmap
+    # cell. A new result replaces the previous one of its probe, so only the
+    # probes that reported are added to or removed from the sums.
+
+    def __init__(self, density):
+        self.grid = LatencyGrid(density, minimums=False)
+        self.latest = {}
+        self.country_sums = defaultdict(float)
+        self.country_counts = defaultdict(int)
+
+    def _rows(self, probe_ids):
+        # PingResults rows, only their coordinates and latencies are read
+        return np.array(
+            [self.latest[probe_id][1] for probe_id in probe_ids], dtype=PingResults.DTYPE
+        )
+
+    def _remove(self, probe_ids):
+        probe_ids = [probe_id for probe_id in probe_ids if probe_id in self.latest]
+        if not probe_ids:
+            return
+
+        self.grid.remove(self._rows(probe_ids))
+        for probe_id in probe_ids:
+            _, row = self.latest.pop(probe_id)
+            self.country_sums[row['country']] -= row['latency']
+            self.country_counts[row['country']] -= 1
+
+    def update(self, pings, timestamps):
+        # pings: a PingMeasure with the parsed new results,
+        # timestamps: of these results by probe
+        self._remove(list(pings.failed_probes) + pings.results['probe_id'].tolist())
+
+        for row in pings.results.data:
+            probe_id = int(row['probe_id'])
+            self.latest[probe_id] = (timestamps[probe_id], row.copy())
+            self.country_sums[row['country']] += row['latency']
+            self.country_counts[row['country']] += 1
+        self.grid.add(pings.results)
+
+    def expire(self, before):
+        # probes that have not reported since `before`
+        silent = [
+            probe_id for probe_id, (timestamp, _) in self.latest.items()
+            if timestamp < before
+        ]
+        self._remove(silent)
+        return len(silent)
+
+    def country_states(self):
+        countries = sorted(self.country_counts)
+        return country_states(
+            countries,
+            [self.country_sums[country] for country in countries],
+            [self.country_counts[country] for country in countries]
+        )
+
+
+def _changed_countries(previous, current, threshold):
+    if set(previous) != set(current):
+        return True
+    return any(abs(current[country] - previous[country]) >= threshold for country in current)
+
+
+def _changed_cells(previous, current, threshold):
+    has_data = (previous > 0) | (current > 0)
+    if not has_data.any():
+        return 0.0
+
+    changed = np.abs(current[has_data] - previous[has_data]) >= threshold
+    return float(changed.sum()) / has_data.sum()
+
+
+def load_state(fname, target):
+    # measurement IDs of the earlier runs against the same target
+    if fname is None or not os.path.exists(fname):
+        return None
+
+    with open(fname) as fd:
+        state = json.load(fd)
+    if state.get('target') != target:
+        raise ValueError('%s is the state of %s, not %s' % (fname, state.get('target'), target))
+
+    return state['measurements']
+
+
+def save_state(fname, target, measurements):
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp_fname, 'w') as fd:
+        json.dump({'target': target, 'measurements': measurements}, fd)
+    os.rename(tmp_fname, fname)
+
+
+def create_ongoing(atlas, target, probes_data, interval=PING_INTERVAL):
+    # ongoing measurements never stop, so all of them have to fit in the
+    # per-target limit at once
+    chunks = len(plan_chunks(probes_data))
+    if chunks > MAX_TARGET_MEASUREMENTS:
+        raise ValueError(
+            '%d probes need %d measurements, Atlas runs no more than %d ongoing '
+            'ones per target' % (len(probes_data), chunks, MAX_TARGET_MEASUREMENTS)
+        )
+
+    with span('create_measurements', type='ping', ongoing=True) as create_span:
+        scheduler = MeasurementScheduler(atlas, is_oneoff=False)
+        scheduler.add(atlas.create_ping(target=target, interval=interval), probes_data)
+        measurements = [msm_id for job in scheduler.run() for msm_id in job.measurements]
+        create_span.set(items=len(measurements))
+
+    return measurements
+
+
+class Monitor(object):
+    def __init__(self, target, measurements, probes_data, heatmap=None, countrymap=None,
+                 density=4, backend=DEFAULT_BACKEND, basemap_dir=None,
+                 interval=PING_INTERVAL, change_threshold=CHANGE_THRESHOLD,
+                 changed_cells=CHANGED_CELLS, since=None):
+        self.target = target
+        self.heatmap = heatmap
+        self.countrymap = countrymap
+        self.density = density
+        self.backend = backend
+        self.basemap_dir = basemap_dir
+        self.interval = interval
+        self.change_threshold = change_threshold
+        self.changed_cells = changed_cells
+
+        # the first fetch gets the latest round of the pings
+        if since is None:
+            since = time.time() - interval
+        self.windows = dict((msm_id, ResultWindow(since)) for msm_id in measurements)
+        self.pings = PingMeasure(target, None, probes_data=probes_data)
+        self.aggregates = LatencyAggregates(density)
+        self.cancelled = threading.Event()
+
+        self.rendered_states = None
+        self.rendered_grid = None
+
+    def _fetch(self):
+        new_results = []
+        for msm_id, window in sorted(self.windows.items()):
+            results = Atlas.fetch_results(msm_id, start=window.start(), cancelled=self.cancelled)
+            if results is None:
+                break
+            new_results.extend(window.update(results))
+        return new_results
+
+    def _parse(self, new_results):
+        # the newest result of every probe
+        latest = {}
+        for item in sorted(new_results, key=lambda item: item['timestamp']):
+            latest[item['prb_id']] = item
+
+        self.pings.parse(list(latest.values()))
+        return dict((prb_id, item['timestamp']) for prb_id, item in latest.items())
+
+    def _is_changed(self, states, final_grid):
+        if self.rendered_states is None:
+            return True
+        if _changed_countries(self.rendered_states, states, self.change_threshold):
+            return True
+
+        changed = _changed_cells(self.rendered_grid, final_grid, self.change_threshold)
+        return changed >= self.changed_cells
+
+    def _render(self, states, final_grid):
+        if self.heatmap is not None:
+            render_heatmap(
+                final_grid, self.density, self.heatmap, self.target,
+                backend=self.backend,
+                basemap_dir=self.basemap_dir
+            )
+        if self.countrymap is not None:
+            with span('render', output='countrymap'):
+                draw_countrymap(states, self.countrymap)
+
+        self.rendered_states = states
+        self.rendered_grid = final_grid
+
+    def cycle(self, now=None):
+        # True if the maps are drawn again
+        with span('monitor_cycle', target=self.target) as cycle_span:
+            new_results = self._fetch()
+            timestamps = self._parse(new_results)
+            self.aggregates.update(self.pings, timestamps)
+
+            if now is None:
+                now = time.time()
+            expired = self.aggregates.expire(now - MAX_SILENT_ROUNDS * self.interval)
+
+            states = self.aggregates.country_states()
+            final_grid = self.aggregates.grid.means()
+            changed = bool(self.aggregates.latest) and self._is_changed(states, final_grid)
+            if changed:
+                self._render(states, final_grid)
+
+            logger.info(
+                '%d new results, %d probes dropped as silent, %d probes on the maps%s',
+                len(new_results), expired, len(self.aggregates.latest),
+                ', drawn' if changed else ''
+            )
+            cycle_span.set(items=len(new_results), probes=len(self.aggregates.latest),
+                           rendered=changed)
+
+        return changed
+
+    def run(self, cycle_interval=CYCLE_INTERVAL, cycles=None):
+        done = 0
+        while cycles is None or done < cycles:
+            started = time.time()
+            self.cycle()
+            done += 1
+            if cycles is None or done < cycles:
+                self.cancelled.wait(max(0, cycle_interval - (time.time() - started)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        parents=[base_parser(), atlas_parser(one_off=False), ping_parser()],
+        description='keep the latency maps of the target up to date with ongoing Atlas pings'
+    )
+    parser.add_argument(
+        '-s', '--state',
+        metavar='FILE',
+        help="measurement IDs of the monitor, reused on restart "
+             "(default: 'monitor_<target>.json')"
+    )
+    parser.add_argument(
+        '--heatmap',
+        metavar='FILE',
+        help="heatmap PNG image (default: 'heatmap_<target>.png')"
+    )
+    parser.add_argument(
+        '--countrymap',
+        metavar='FILE',
+        help="countrymap HTML file (default: 'countrymap_<target>.html')"
+    )
+    parser.add_argument(
+        '-d', '--density',
+        type=int,
+        default=4,
+        help='heatmap cells number per degree (default: 4)'
+    )
+    parser.add_argument(
+        '-b', '--backend',
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help='heatmap backend, see atlas-heatmap (default: %s)' % DEFAULT_BACKEND
+    )
+    parser.add_argument(
+        '-i', '--interval',
+        type=int,
+        default=PING_INTERVAL,
+        metavar='SECONDS',
+        help='interval of the ongoing pings (default: %d)' % PING_INTERVAL
+    )
+    parser.add_argument(
+        '--cycle',
+        type=int,
+        default=CYCLE_INTERVAL,
+        metavar='SECONDS',
+        help='fetch new results this often (default: %d)' % CYCLE_INTERVAL
+    )
+    parser.add_argument(
+        '--change-threshold',
+        type=float,
+        default=CHANGE_THRESHOLD,
+        metavar='MS',
+        help='draw the maps again once a country or %g%%%% of the heatmap cells '
+             'changed by this much (default: %g)' % (CHANGED_CELLS * 100, CHANGE_THRESHOLD)
+    )
+    args = parser.parse_args()
+
+    measurements = args.msms
+    if measurements is None:
+        if args.state is None:
+            args.state = 'monitor_%s.json' % args.target
+        measurements = load_state(args.state, args.target)
+    if measurements is None and args.key is None:
+        parser.error('Atlas key (-k) is required for creating new measurements')
+
+    if args.heatmap is None:
+        args.heatmap = 'heatmap_%s.png' % args.target
+    if args.countrymap is None:
+        args.countrymap = 'countrymap_%s.html' % args.target
+
+    start_logger('atlas_tools', verbose=args.verbose)
+    profile_from_args(args)
+    server_from_args(args)
+
+    cache = cache_from_args(args)
+    if measurements is None:
+        probes_data = list_probes(country=args.country, probe_limit=args.probe_number, cache=cache)
+        measurements = create_ongoing(
+            Atlas(args.key, cache=cache), args.target, probes_data, interval=args.interval
+        )
+        save_state(args.state, args.target, measurements)
+    else:
+        # the probes of the measurements are not known, any of them may report
+        probes_data = list_probes(country=args.country, cache=cache)
+
+    print('Atlas ongoing ping measurement IDs: %s' % ' '.join(str(mid) for mid in measurements))
+
+    monitor = Monitor(
+        args.target, measurements, probes_data,
+        heatmap=args.heatmap,
+        countrymap=args.countrymap,
+        density=args.density,
+        backend=args.backend,
+        basemap_dir=cache.basemaps if cache is not None else None,
+        interval=args.interval,
+        change_threshold=args.change_threshold
+    )
+    try:
+        monitor.run(cycle_interval=args.cycle)
+    except KeyboardInterrupt:
+        logger.warning('Stopped, the measurements keep running: %s', measurements)
+
+
+if __name__ == '__main__':
+    main()
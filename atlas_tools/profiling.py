@@ -0,0 +1,175 @@
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# the recorder of the spans, None when profiling is off
+_recorder = None
+
+
+def _peak_rss():
+    # kilobytes
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+class _NullSpan(object):
+    # all that span() returns when profiling is off
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    # A timed stage of the pipeline. Atlas API calls and downloaded bytes are
+    # counted process-wide, so concurrent spans see the calls of each other.
+
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.name = name
+        self.fields = fields
+        self.start = None
+        self.counters = None
+
+    def __enter__(self):
+        self.counters = self.recorder.counters()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        api_calls, downloaded = self.recorder.counters()
+
+        record = {
+            'span': self.name,
+            'start': self.start,
+            'end': end,
+            'seconds': round(end - self.start, 6),
+            'api_calls': api_calls - self.counters[0],
+            'bytes': downloaded - self.counters[1],
+            'peak_rss_kb': _peak_rss(),
+            'thread': threading.current_thread().name,
+        }
+        record.update(self.fields)
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+
+        self.recorder.write(record)
+        return False
+
+    def set(self, **fields):
+        # item counts and such known only at the end of the stage
+        self.fields.update(fields)
+
+
+class Recorder(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self._fd = open(fname, 'w')
+        self._lock = threading.Lock()
+        self._api_calls = 0
+        self._bytes = 0
+
+    def count(self, api_calls=0, downloaded=0):
+        with self._lock:
+            self._api_calls += api_calls
+            self._bytes += downloaded
+
+    def counters(self):
+        with self._lock:
+            return self._api_calls, self._bytes
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            self._fd.write(line + '\n')
+            self._fd.flush()
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
+
+
+def _install_http_hook():
+    # every cousteau request goes through get_http_method
+    from ripe.atlas.cousteau.request import AtlasRequest
+
+    get_http_method = AtlasRequest.get_http_method
+    if getattr(get_http_method, 'profiled', False):
+        return
+
+    def profiled_get_http_method(self, method):
+        response = None
+        try:
+            response = get_http_method(self, method)
+            return response
+        finally:
+            # streamed responses count their bytes as they are read
+            downloaded = 0
+            if response is not None and not self.http_method_args.get('stream'):
+                downloaded = len(response.content)
+            count(api_calls=1, downloaded=downloaded)
+
+    profiled_get_http_method.profiled = True
+    AtlasRequest.get_http_method = profiled_get_http_method
+
+
+def enable(fname):
+    global _recorder
+
+    disable()
+    _install_http_hook()
+    _recorder = Recorder(fname)
+    logger.info('Writing profile spans to %s', fname)
+
+
+def disable():
+    global _recorder
+
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.close()
+
+
+def count(api_calls=0, downloaded=0):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(api_calls=api_calls, downloaded=downloaded)
+
+
+def span(name, **fields):
+    # with span('stage', target=...) as stage_span:
+    #     ...
+    #     stage_span.set(items=n)
+    recorder = _recorder
+    if recorder is None:
+        return NULL_SPAN
+    return Span(recorder, name, fields)
+
+
+def profile_from_args(args):
+    if args.profile_out is not None:
+        enable(args.profile_out)
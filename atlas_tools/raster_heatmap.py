@@ -0,0 +1,204 @@
+import logging
+import os
+
+import numpy as np
+
+from atlas_tools.countries import load_countries
+
+logger = logging.getLogger(__name__)
+
+# equirectangular raster, 2:1
+RASTER_WIDTH = 2048
+COLORMAP = 'RdYlGn_r'
+LATENCY_RANGE = (30, 90)
+LUT_SIZE = 256
+NO_DATA_COLOR = (211, 211, 211, 255)  # lightgrey
+OCEAN_COLOR = (151, 182, 225)
+BORDER_COLOR = (0.2, 0.2, 0.2)
+BORDER_WIDTH = 0.4
+BASEMAP_NAME = 'basemap_%dx%d.npy'
+# pixels above and below the map for the title and the colorbar
+TITLE_HEIGHT = 60
+COLORBAR_HEIGHT = 110
+
+# basemaps drawn in this process, by size
+_basemaps = {}
+
+
+def _rings(countries):
+    for feature in countries['features']:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            polygons = [geometry['coordinates']]
+        else:
+            polygons = geometry['coordinates']
+
+        for polygon in polygons:
+            for i, ring in enumerate(polygon):
+                # (ring, is exterior)
+                yield ring, i == 0
+
+
+def _draw_layer(width, height, collection):
+    # RGBA raster of a matplotlib collection over transparent background
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(width / 100.0, height / 100.0), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0)
+
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(-180, 180)
+    ax.set_ylim(-90, 90)
+    ax.add_collection(collection)
+
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).astype(np.float32) / 255
+
+
+def _draw_basemap(width, height):
+    # ocean and borders over transparent land, straight alpha
+    from matplotlib.collections import LineCollection, PolyCollection
+
+    logger.info('Drawing %dx%d basemap', width, height)
+
+    rings = list(_rings(load_countries()))
+    land = _draw_layer(width, height, PolyCollection(
+        [ring for ring, exterior in rings if exterior],
+        facecolors='white', edgecolors='none'
+    ))
+    borders = _draw_layer(width, height, LineCollection(
+        [ring for ring, _ in rings],
+        colors=[BORDER_COLOR], linewidths=BORDER_WIDTH
+    ))
+
+    ocean_alpha = 1 - land[..., 3:]
+    border_alpha = borders[..., 3:]
+    alpha = border_alpha + ocean_alpha * (1 - border_alpha)
+
+    ocean = np.array(OCEAN_COLOR, dtype=np.float32) / 255
+    rgb = borders[..., :3] * border_alpha + ocean * ocean_alpha * (1 - border_alpha)
+    rgb = np.divide(rgb, alpha, out=np.zeros_like(rgb), where=alpha > 0)
+
+    basemap = np.concatenate([rgb, alpha], axis=2)
+    return (basemap * 255).round().astype(np.uint8)
+
+
+def load_basemap(width, height, basemap_dir=None):
+    basemap = _basemaps.get((width, height))
+    if basemap is not None:
+        return basemap
+
+    fname = None
+    if basemap_dir is not None:
+        fname = os.path.join(basemap_dir, BASEMAP_NAME % (width, height))
+
+    if fname is not None and os.path.exists(fname):
+        basemap = np.load(fname)
+    else:
+        basemap = _draw_basemap(width, height)
+        if fname is not None:
+            if not os.path.isdir(basemap_dir):
+                os.makedirs(basemap_dir)
+
+            tmp_fname = '%s.%d.tmp.npy' % (fname[:-4], os.getpid())
+            np.save(tmp_fname, basemap)
+            os.rename(tmp_fname, fname)
+
+    _basemaps[(width, height)] = basemap
+    return basemap
+
+
+def _colormap():
+    try:
+        from matplotlib import colormaps
+        return colormaps[COLORMAP]
+    except ImportError:
+        from matplotlib import cm
+        return cm.get_cmap(COLORMAP)
+
+
+def _color_lut():
+    # LUT_SIZE colormap steps and NO_DATA_COLOR as the last entry
+    colors = _colormap()(np.linspace(0, 1, LUT_SIZE))
+    lut = np.vstack([(colors * 255).round(), NO_DATA_COLOR])
+    return lut.astype(np.uint8)
+
+
+def _color_codes(final_grid):
+    low, high = LATENCY_RANGE
+    codes = np.clip(
+        np.round((final_grid - low) / float(high - low) * (LUT_SIZE - 1)),
+        0, LUT_SIZE - 1
+    ).astype(np.intp)
+    codes[final_grid < low] = LUT_SIZE
+    return codes
+
+
+def _pixel_indices(density, width, height):
+    # grid cell of every pixel center, as _coords_to_indices does
+    lat = 90 - (np.arange(height) + 0.5) * 180.0 / height
+    lon = (np.arange(width) + 0.5) * 360.0 / width - 180
+
+    rows = np.clip(((lat + 90) * density).astype(np.intp), 0, 180 * density)
+    cols = np.clip(((lon + 180) * density).astype(np.intp), 0, 360 * density - 1)
+    return rows, cols
+
+
+def render_grid(final_grid, density, width=RASTER_WIDTH, basemap_dir=None):
+    # RGB image of the grid under the basemap
+    height = width // 2
+    basemap = load_basemap(width, height, basemap_dir)
+
+    rows, cols = _pixel_indices(density, width, height)
+    codes = _color_codes(final_grid)[np.ix_(rows, cols)]
+    heat = _color_lut()[codes][..., :3]
+
+    alpha = basemap[..., 3:].astype(np.float32) / 255
+    image = heat * (1 - alpha) + basemap[..., :3] * alpha
+    return image.round().astype(np.uint8)
+
+
+def draw_heatmap(final_grid, density, fname, target, width=RASTER_WIDTH, basemap_dir=None):
+    logger.info('Drawing the heatmap')
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.colorbar import ColorbarBase
+    from matplotlib.colors import ListedColormap, Normalize
+    from matplotlib.figure import Figure
+
+    image = render_grid(final_grid, density, width=width, basemap_dir=basemap_dir)
+    height = image.shape[0]
+    fig_height = height + TITLE_HEIGHT + COLORBAR_HEIGHT
+
+    fig = Figure(figsize=(width / 100.0, fig_height / 100.0), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    # pixel to pixel, no resampling
+    fig.figimage(image, xo=0, yo=COLORBAR_HEIGHT, origin='upper')
+    fig.text(
+        0.5, 1 - TITLE_HEIGHT / 2.0 / fig_height, '%s latency heatmap' % target,
+        ha='center', va='center', fontsize=24
+    )
+
+    cax = fig.add_axes([
+        0.25, COLORBAR_HEIGHT * 0.55 / fig_height,
+        0.5, COLORBAR_HEIGHT * 0.25 / fig_height
+    ])
+    lut = _color_lut() / 255.0
+    cmap = ListedColormap(lut[:LUT_SIZE])
+    cmap.set_under(lut[LUT_SIZE])
+    ColorbarBase(
+        cax,
+        cmap=cmap,
+        norm=Normalize(*LATENCY_RANGE),
+        orientation='horizontal',
+        extend='min',
+        label='latency, ms'
+    )
+
+    if not fname.endswith('.png'):
+        fname += '.png'
+
+    canvas.print_png(fname)
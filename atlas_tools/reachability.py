@@ -3,9 +3,14 @@ from __future__ import print_function
 import argparse
 from collections import defaultdict
 import logging
-import socket
 
-from atlas_tools.measurement import ping_measure, trace_measure
+from atlas_tools.cache import cache_from_args
+from atlas_tools.measurement import list_probes, ping_measure, ping_probes, trace_measure
+from atlas_tools.profiling import profile_from_args, span
+from atlas_tools.reverse_dns import resolve_ptrs
+from atlas_tools.ripe_atlas import completion_from_args, server_from_args
+from atlas_tools.sampling import sampling_from_args, FAILURE_THRESHOLD, SAMPLE_SIZE, \
+    TRACES_PER_ASN
 from atlas_tools.util import base_parser, atlas_parser, start_logger
 
 logger = logging.getLogger(__name__)
@@ -43,68 +48,145 @@ def _log_pings(pings, failed_countries, failed_countries_size):
             )
 
 
-def _log_traces(traces, failed_probes, filename):
+def _log_traces(traces, failed_probes, filename, ptr_cache=None):
+    # only the traces that have not reached the target
+    unreached = [
+        (src_ip, prb_id, hops)
+        for prb_id, src_ip, _, reached, hops in traces.results
+        if not reached
+    ]
+
     logger.info('Atlas trace measurement ids: %s', traces.response)
     logger.info(
         'Failed traces: %s / %s',
-        len(traces.results),
+        len(unreached),
         len(failed_probes)
     )
 
+    # transit routers appear in many traces, resolve each of them once
+    hostnames = resolve_ptrs(
+        set(
+            hop_ip
+            for _, _, hops in unreached
+            for hop_num, hop_ips, _, _, _, _, _ in hops
+            if hop_num != 255
+            for hop_ip in hop_ips
+        ),
+        cache=ptr_cache
+    )
+
     with open(filename, 'w+') as fd:
-        for src_ip, prb_id, trace in traces.results:
+        for src_ip, prb_id, hops in unreached:
             fd.write(
                 'Source ip: %s, prb_id: %s\nTrace:\nHop\tip\t\trtt\tptr\n' %
                 (src_ip, prb_id)
             )
 
-            for hop_num, hop_ip, hop_rtt in trace:
+            for hop_num, hop_ips, _, _, rtt_min, _, error in hops:
                 if hop_num == 255:
                     continue
 
-                if hop_ip == '*':
-                    fd.write('%s\t%s\t\t%s\n' % (hop_num, hop_ip, hop_rtt))
-                elif hop_ip == 'error':
-                    fd.write('%s\t%s\n' % (hop_num, hop_rtt))
+                if error is not None:
+                    fd.write('%s\t%s\n' % (hop_num, error))
+                elif not hop_ips:
+                    fd.write('%s\t*\t\t-\n' % hop_num)
                 else:
-                    try:
-                        host_str, _, _ = socket.gethostbyaddr(hop_ip)
-                        fd.write(
-                            '%s\t%s\t%s\t%s\n' %
-                            (hop_num, hop_ip, hop_rtt, host_str)
-                        )
-                    except socket.herror:
-                        pass
+                    hop_rtt = '-' if rtt_min is None else round(rtt_min, 3)
+                    for hop_ip in hop_ips:
+                        if hop_ip in hostnames:
+                            fd.write(
+                                '%s\t%s\t%s\t%s\n' %
+                                (hop_num, hop_ip, hop_rtt, hostnames[hop_ip])
+                            )
 
             fd.write('\n')
 
 
-def test_reachability(fname, atlas_key, target, protocol, country=None,
-                      probe_limit=None, timeout=None):
-    pings = ping_measure(
-        atlas_key, target,
-        country=country,
-        probe_limit=probe_limit,
-        timeout=timeout
-    )
+def _adaptive_pings(atlas_key, target, sampling, country=None, probe_limit=None,
+                    timeout=None, cache=None, completion=None):
+    # the failed probes and the ones of them to trace
+    probes_data = list_probes(country=country, probe_limit=probe_limit, cache=cache)
 
+    sample = sampling.sample(probes_data)
+    pings = ping_probes(
+        atlas_key, target, sample,
+        timeout=timeout,
+        cache=cache,
+        completion=completion
+    )
     _log_pings(pings, FAILED_COUNTRIES, FAILED_COUNTRIES_SIZE)
+    failed_probes = dict(pings.failed_probes)
+    pinged = len(sample)
+
+    countries = sampling.failing_countries(pings)
+    expansion = sampling.expansion(probes_data, countries, sample)
+    if expansion:
+        logger.info(
+            'Failure rate is over the threshold in %s, pinging %d more probes there',
+            ', '.join(countries), len(expansion)
+        )
+        pings = ping_probes(
+            atlas_key, target, expansion,
+            timeout=timeout,
+            cache=cache,
+            completion=completion
+        )
+        _log_pings(pings, FAILED_COUNTRIES, FAILED_COUNTRIES_SIZE)
+        failed_probes.update(pings.failed_probes)
+        pinged += len(expansion)
+
+    trace_probes = sampling.trace_probes(failed_probes, probes_data)
+    logger.info(
+        'Pinged %d of %d probes, tracing %d of %d failed ones',
+        pinged, len(probes_data), len(trace_probes), len(failed_probes)
+    )
+    return failed_probes, trace_probes
 
 
-    logger.info('Tracing target with ping-failed probes')
+def test_reachability(fname, atlas_key, target, protocol, country=None,
+                      probe_limit=None, timeout=None, cache=None, completion=None,
+                      sampling=None):
+    if sampling is None:
+        pings = ping_measure(
+            atlas_key, target,
+            country=country,
+            probe_limit=probe_limit,
+            timeout=timeout,
+            cache=cache,
+            completion=completion
+        )
+
+        _log_pings(pings, FAILED_COUNTRIES, FAILED_COUNTRIES_SIZE)
+
+        probes_data = {
+            probe_id: pings.probes_data[probe_id]
+            for probe_id in pings.failed_probes
+        }
+    else:
+        _, probes_data = _adaptive_pings(
+            atlas_key, target, sampling,
+            country=country,
+            probe_limit=probe_limit,
+            timeout=timeout,
+            cache=cache,
+            completion=completion
+        )
 
-    probes_data = {
-        probe_id: pings.probes_data[probe_id]
-        for probe_id in pings.failed_probes
-    }
+    logger.info('Tracing target with ping-failed probes')
 
     traces = trace_measure(
         atlas_key, target, protocol,
         probes_data=probes_data,
-        timeout=timeout
+        timeout=timeout,
+        cache=cache,
+        completion=completion
     )
 
-    _log_traces(traces, pings.failed_probes, fname)
+    ptr_cache = None if cache is None else cache.ptr
+    with span('log_traces', items=len(traces.results)):
+        _log_traces(traces, probes_data, fname, ptr_cache=ptr_cache)
+    if ptr_cache is not None:
+        ptr_cache.save()
 
 
 def main():
@@ -123,19 +205,54 @@ def main():
         default='ICMP',
         help='choose measurement protocol (default: ICMP)'
     )
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help='ping a sample of probes of every country and ASN first and the rest '
+             'only in the failing countries, trace a few failed probes per ASN '
+             '(default: ping all the probes, trace all the failed ones)'
+    )
+    parser.add_argument(
+        '--sample-size',
+        type=int,
+        default=SAMPLE_SIZE,
+        metavar='N',
+        help='--adaptive: probes of every country and ASN to ping first (default: %d)' % SAMPLE_SIZE
+    )
+    parser.add_argument(
+        '--failure-threshold',
+        type=float,
+        default=FAILURE_THRESHOLD * 100,
+        metavar='PERCENT',
+        help='--adaptive: ping all the probes of a country if this share of its sampled '
+             'probes failed (default: %g)' % (FAILURE_THRESHOLD * 100)
+    )
+    parser.add_argument(
+        '--traces-per-asn',
+        type=int,
+        default=TRACES_PER_ASN,
+        metavar='N',
+        help='--adaptive: failed probes of every ASN to trace (default: %d)' % TRACES_PER_ASN
+    )
     args = parser.parse_args()
 
     if args.filename is None:
         args.filename = 'reachability_%s.dat' % args.target
 
     start_logger('atlas_tools', verbose=args.verbose)
-
-    test_reachability(
-        args.filename, args.key, args.target, args.protocol,
-        country=args.country,
-        probe_limit=args.probe_number,
-        timeout=args.timeout
-    )
+    profile_from_args(args)
+    server_from_args(args)
+
+    with span('run', tool='atlas-reachability', target=args.target):
+        test_reachability(
+            args.filename, args.key, args.target, args.protocol,
+            country=args.country,
+            probe_limit=args.probe_number,
+            timeout=args.timeout,
+            cache=cache_from_args(args),
+            completion=completion_from_args(args),
+            sampling=sampling_from_args(args)
+        )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,271 @@
+import numpy as np
+
+# ASNs are 32-bit unsigned, AS 0 is reserved (RFC 7607) and never a probe's
+NO_ASN = 0
+
+
+class StringTable(object):
+    # interns strings (IP addresses) as small integers
+
+    def __init__(self):
+        self.values = []
+        self._indices = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def intern(self, value):
+        index = self._indices.get(value)
+        if index is None:
+            index = len(self.values)
+            self._indices[value] = index
+            self.values.append(value)
+        return index
+
+    def decode(self, indices):
+        values = np.empty(len(self.values), dtype=object)
+        values[:] = self.values
+        return values[indices]
+
+
+class Records(object):
+    # a growable numpy structured array of DTYPE rows
+    DTYPE = None
+
+    def __init__(self, capacity=0):
+        self._data = np.empty(capacity, dtype=self.DTYPE)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, name):
+        return self._data[name][:self._size]
+
+    @property
+    def data(self):
+        return self._data[:self._size]
+
+    def reserve(self, capacity):
+        if capacity > len(self._data):
+            data = np.empty(capacity, dtype=self.DTYPE)
+            data[:self._size] = self.data
+            self._data = data
+
+    def append_row(self, row):
+        if self._size == len(self._data):
+            self.reserve(max(2 * self._size, 1024))
+
+        self._data[self._size] = row
+        self._size += 1
+        return self._size - 1
+
+    def extend(self, rows):
+        # a list of row tuples, copied in one go
+        size = self._size + len(rows)
+        if size > len(self._data):
+            self.reserve(max(2 * self._size, size, 1024))
+
+        self._data[self._size:size] = rows
+        self._size = size
+
+    def pack(self):
+        # no more rows are expected: drop the spare capacity
+        if len(self._data) > self._size:
+            self._data = self.data.copy()
+
+
+class PingResults(Records):
+    DTYPE = np.dtype([
+        ('probe_id', np.int32),
+        ('source_ip', np.int32),
+        ('dst_ip', np.int32),
+        ('asn', np.uint32),
+        ('country', 'U2'),
+        ('latitude', np.float64),
+        ('longitude', np.float64),
+        ('latency', np.float64),
+    ])
+    IP_COLUMNS = ('source_ip', 'dst_ip')
+
+    def __init__(self, capacity=0):
+        super(PingResults, self).__init__(capacity)
+        self.ips = StringTable()
+
+    def __iter__(self):
+        # rows in the original tuple layout:
+        # (probe_id, source_ip, dst_ip, asn, country, latitude, longitude, latency)
+        for row in self.data.tolist():
+            prb_id, src_ip, dst_ip, asn, country, lat, lon, rtt = row
+            yield (
+                prb_id, self.ips[src_ip], self.ips[dst_ip],
+                None if asn == NO_ASN else asn, country, lat, lon, rtt
+            )
+
+    def append(self, prb_id, src_ip, dst_ip, asn, country, lat, lon, rtt):
+        self.append_row((
+            prb_id, self.ips.intern(src_ip), self.ips.intern(dst_ip),
+            NO_ASN if asn is None else asn, country or '', lat, lon, rtt
+        ))
+
+    def column(self, name):
+        # IP columns are decoded back to strings
+        values = self[name]
+        if name in self.IP_COLUMNS:
+            return self.ips.decode(values)
+        return values
+
+
+class PathTrie(Records):
+    # Hop paths of the traces with the common prefixes stored once. A node is
+    # a hop: its number and the set of IPs that replied, after the parent path.
+    DTYPE = np.dtype([
+        ('parent', np.int32),
+        ('hop', np.uint8),
+        ('ip_set', np.int32),
+    ])
+    ROOT = -1
+
+    def __init__(self, capacity=0):
+        super(PathTrie, self).__init__(capacity)
+        # tuples of interned IPs, sorted
+        self.ip_sets = StringTable()
+        self._children = {}
+
+    def child(self, parent, hop_num, ip_set):
+        ip_set = self.ip_sets.intern(ip_set)
+        key = ((parent + 1) << 40) | (hop_num << 32) | ip_set
+        children = self._children
+        if children is None:
+            children = self._index()
+
+        node = children.get(key)
+        if node is None:
+            node = self.append_row((parent, hop_num, ip_set))
+            children[key] = node
+        return node
+
+    def _index(self):
+        # node by (parent, hop, ip set) packed into an int, the same key as
+        # in child(); it is most of the trie size, so pack() drops it
+        parents = self['parent'].astype(np.int64)
+        hops = self['hop'].astype(np.int64)
+        keys = ((parents + 1) << 40) | (hops << 32) | self['ip_set']
+        self._children = dict(zip(keys.tolist(), range(len(self))))
+        return self._children
+
+    def pack(self):
+        super(PathTrie, self).pack()
+        self._children = None
+
+    def path(self, node):
+        # nodes from the first hop to this one
+        parents = self['parent']
+        nodes = []
+        while node != self.ROOT:
+            nodes.append(node)
+            node = int(parents[node])
+        nodes.reverse()
+        return nodes
+
+
+class TraceHops(Records):
+    # every hop of every trace; IPs are kept by the trie node of the hop
+    DTYPE = np.dtype([
+        ('node', np.int32),
+        ('sent', np.uint8),
+        ('received', np.uint8),
+        ('rtt_min', np.float32),
+        ('rtt_avg', np.float32),
+        ('error', np.int16),
+    ])
+
+
+class TraceResults(Records):
+    DTYPE = np.dtype([
+        ('probe_id', np.int32),
+        ('source_ip', np.int32),
+        ('dst_ip', np.int32),
+        ('reached', np.bool_),
+        # the trie node of the last hop, PathTrie.ROOT for no hops
+        ('path', np.int32),
+        ('first_hop', np.int32),
+        ('hop_count', np.int16),
+    ])
+    NO_ERROR = -1
+
+    def __init__(self, capacity=0):
+        super(TraceResults, self).__init__(capacity)
+        self.ips = StringTable()
+        self.errors = StringTable()
+        self.paths = PathTrie()
+        self.hops = TraceHops()
+
+    def append(self, prb_id, src_ip, dst_ip, hops):
+        # hops: (hop number, replied IPs, sent, received, min rtt, avg rtt, error)
+        intern = self.ips.intern
+        child = self.paths.child
+        dst_index = intern(dst_ip)
+        node = PathTrie.ROOT
+        reached = False
+
+        rows = []
+        for hop_num, ips, sent, received, rtt_min, rtt_avg, error in hops:
+            if len(ips) == 1:
+                ip_set = (intern(ips[0]),)
+            else:
+                ip_set = tuple(sorted(intern(ip) for ip in ips))
+            reached = reached or dst_index in ip_set
+            node = child(node, hop_num, ip_set)
+            rows.append((
+                node, sent, received, rtt_min, rtt_avg,
+                self.NO_ERROR if error is None else self.errors.intern(error)
+            ))
+
+        self.append_row((
+            prb_id, intern(src_ip), dst_index, reached, node,
+            len(self.hops), len(rows)
+        ))
+        self.hops.extend(rows)
+
+    def pack(self):
+        # once no more traces are expected for a while
+        super(TraceResults, self).pack()
+        self.hops.pack()
+        self.paths.pack()
+
+    def _decode_hop(self, hop, nodes):
+        node, sent, received, rtt_min, rtt_avg, error = hop
+        _, hop_num, ip_set = nodes[node]
+        return (
+            hop_num, [self.ips[ip] for ip in self.paths.ip_sets[ip_set]],
+            sent, received,
+            None if received == 0 else rtt_min,
+            None if received == 0 else rtt_avg,
+            None if error == self.NO_ERROR else self.errors[error]
+        )
+
+    def trace_hops(self, index):
+        # [(hop number, replied IPs, sent, received, min rtt, avg rtt, error)]
+        first_hop = int(self['first_hop'][index])
+        hops = self.hops.data[first_hop:first_hop + int(self['hop_count'][index])]
+        nodes = dict(zip(hops['node'].tolist(), self.paths.data[hops['node']].tolist()))
+        return [self._decode_hop(hop, nodes) for hop in hops.tolist()]
+
+    def __iter__(self):
+        # (probe_id, source_ip, dst_ip, reached, hops), see trace_hops
+        hops = self.hops.data.tolist()
+        nodes = self.paths.data.tolist()
+        for prb_id, src_ip, dst_ip, reached, _, first_hop, hop_count in self.data.tolist():
+            yield prb_id, self.ips[src_ip], self.ips[dst_ip], reached, [
+                self._decode_hop(hop, nodes) for hop in hops[first_hop:first_hop + hop_count]
+            ]
+
+    def loss(self):
+        # share of the lost packets of every hop
+        sent = self.hops['sent'].astype(np.float64)
+        lost = sent - self.hops['received']
+        return np.divide(lost, sent, out=np.ones_like(sent), where=sent > 0)
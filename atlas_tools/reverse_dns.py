@@ -0,0 +1,183 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+PTR_WORKERS = 32
+# seconds a single PTR lookup may take
+PTR_TIMEOUT = 5.0
+PTR_CACHE_SIZE = 100000
+# seconds a cached PTR record (or a missing one) is trusted
+PTR_TTL = 24 * 3600
+# h_errno of the definitive answers that there is no PTR record, other
+# failures (TRY_AGAIN, resolver errors) are not cached
+HOST_NOT_FOUND = 1
+NO_DATA = 4
+
+
+class PtrCache(object):
+    # LRU cache of PTR lookups with expiration, optionally kept in a JSON file.
+    # None is cached for addresses without a PTR record.
+
+    def __init__(self, path=None, size=PTR_CACHE_SIZE, ttl=PTR_TTL):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as fd:
+                records = json.load(fd)
+        except ValueError:
+            logger.warning('broken PTR cache %s is ignored', self.path)
+            return
+
+        now = time.time()
+        for address, hostname, expires in records:
+            if expires > now:
+                self._records[address] = (hostname, expires)
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self._lock:
+            records = [
+                (address, hostname, expires)
+                for address, (hostname, expires) in self._records.items()
+            ]
+
+        tmp_fname = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_fname, 'w') as fd:
+            json.dump(records, fd)
+        os.rename(tmp_fname, self.path)
+
+    def get(self, address):
+        # (True, hostname or None) for cached addresses, (False, None) otherwise
+        with self._lock:
+            record = self._records.get(address)
+            if record is None:
+                return False, None
+
+            hostname, expires = record
+            if expires <= time.time():
+                del self._records[address]
+                return False, None
+
+            self._records[address] = self._records.pop(address)
+            return True, hostname
+
+    def put(self, address, hostname):
+        with self._lock:
+            self._records.pop(address, None)
+            self._records[address] = (hostname, time.time() + self.ttl)
+            while len(self._records) > self.size:
+                self._records.popitem(last=False)
+
+
+def _gethostbyaddr(address, started):
+    started[address] = time.time()
+    try:
+        host_str, _, _ = socket.gethostbyaddr(address)
+        return host_str
+    except socket.herror as e:
+        if e.args and e.args[0] in (HOST_NOT_FOUND, NO_DATA):
+            return None
+        raise
+
+
+def _lookup_worker(addresses, results, started):
+    # (address, hostname, error) of every lookup
+    while True:
+        try:
+            address = addresses.get_nowait()
+        except queue.Empty:
+            return
+
+        try:
+            results.put((address, _gethostbyaddr(address, started), None))
+        except socket.error as e:
+            results.put((address, None, e))
+
+
+def resolve_ptrs(addresses, cache=None, workers=PTR_WORKERS, timeout=PTR_TIMEOUT):
+    # Returns {address: hostname}, addresses without a PTR record
+    # (or with a lookup that timed out) are left out.
+    if cache is None:
+        cache = PtrCache()
+
+    hostnames = {}
+    lookups = set()
+    for address in addresses:
+        found, hostname = cache.get(address)
+        if not found:
+            lookups.add(address)
+        elif hostname is not None:
+            hostnames[address] = hostname
+
+    if not lookups:
+        return hostnames
+
+    logger.info('Resolving %d PTR records', len(lookups))
+
+    pending_lookups = queue.Queue()
+    for address in lookups:
+        pending_lookups.put(address)
+    results = queue.Queue()
+    started = {}
+
+    # A stuck resolver call can't be interrupted. The lookups run in daemon
+    # threads, so that the ones given up on don't keep the process alive.
+    workers = min(workers, len(lookups))
+    for _ in range(workers):
+        thread = threading.Thread(target=_lookup_worker, args=(pending_lookups, results, started))
+        thread.daemon = True
+        thread.start()
+
+    # even if every worker gets stuck, nothing waits longer than this
+    deadline = time.time() + timeout * (len(lookups) // workers + 1)
+    pending = set(lookups)
+    while pending:
+        try:
+            address, hostname, error = results.get(timeout=0.1)
+        except queue.Empty:
+            pass
+        else:
+            if address in pending:
+                pending.remove(address)
+                if error is not None:
+                    logger.info('PTR lookup failed: %s: %s', address, error)
+                else:
+                    cache.put(address, hostname)
+                    if hostname is not None:
+                        hostnames[address] = hostname
+
+        now = time.time()
+        for address in list(pending):
+            if now > deadline or (address in started and now - started[address] > timeout):
+                logger.info('PTR lookup timeout: %s', address)
+                pending.remove(address)
+
+    # the lookups not started yet are given up on as well
+    while True:
+        try:
+            pending_lookups.get_nowait()
+        except queue.Empty:
+            break
+
+    return hostnames
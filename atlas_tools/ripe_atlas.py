@@ -1,31 +1,205 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import json
 import logging
+import threading
 import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import requests
 from ripe.atlas.cousteau import Ping, Traceroute, AtlasRequest, AtlasSource, \
-    AtlasCreateRequest, AtlasResultsRequest, ProbeRequest
+    AtlasCreateRequest, AtlasLatestRequest, AtlasResultsRequest, AtlasStopRequest, ProbeRequest
+
+from atlas_tools import profiling, session
+from atlas_tools.profiling import span
 
 logger = logging.getLogger(__name__)
 
+# (scheme, host) of the Atlas API if it is not ATLAS_URL, see use_server()
+_server = None
+
+# all the cousteau requests share the pooled keep-alive connections
+session.install()
+
+# seconds between retries of failed requests
+POLL_INTERVAL = 10
+# bounds of the adaptive interval between status checks, seconds
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 60
+# seconds probes may need to report after the end of the spread
+REPORT_DELAY = 60
+# Atlas limit of simultaneous measurements
+MAX_MEASUREMENTS = 100
+# seconds of results fetched again while streaming, to catch late reports
+STREAM_LOOKBACK = 300
+# downloaded results waiting to be parsed, per request_results call
+RESULTS_BUFFER = 1000
+
+ATLAS_URL = 'https://atlas.ripe.net'
+
+STOPPED = 'stopped'
+TIMED_OUT = 'timed out'
+COMPLETED = 'completed'
+
+
+class DownloadCancelled(Exception):
+    # the results were not all downloaded, they must not be taken as complete
+    pass
+
+
+def _install_url_hook():
+    # every cousteau request, probe pages included, builds its url here
+    build_url = AtlasRequest.build_url
+    if getattr(build_url, 'configurable', False):
+        return
+
+    def configurable_build_url(self):
+        server = _server
+        if server is None:
+            return build_url(self)
+        self.url = '%s://%s%s' % (server[0], server[1], self.url_path)
+
+    configurable_build_url.configurable = True
+    AtlasRequest.build_url = configurable_build_url
+
+
+def use_server(url):
+    # e.g. a local stand-in of the Atlas API: http://127.0.0.1:8000
+    global _server
+
+    if url is None or url.rstrip('/') == ATLAS_URL:
+        _server = None
+        return
+
+    parts = urlparse(url)
+    if not parts.scheme or not parts.netloc:
+        raise ValueError('Atlas API url must be like scheme://host[:port]: %s' % url)
+
+    _install_url_hook()
+    _server = (parts.scheme, parts.netloc)
+    logger.info('Using Atlas API at %s', url)
+
+
+def server_from_args(args):
+    use_server(args.atlas_url)
+    session.configure(pool_size=args.pool_size)
+
+
+def _compact_probe(probe):
+    # only the probe attributes used by the tools
+    return {
+        'id': probe['id'],
+        'country_code': probe.get('country_code'),
+        'asn_v4': probe.get('asn_v4'),
+        'geometry': probe.get('geometry')
+    }
+
+
+def form_probes(atlas_params, limit=None, catalog=None):
+    if catalog is not None and catalog.supports(atlas_params):
+        return catalog.select(atlas_params, limit=limit)
 
-def form_probes(atlas_params, limit=None):
     probe_request = ProbeRequest(**atlas_params)
 
     probes_data = {}
-    for probe in probe_request:
-        probes_data[probe['id']] = probe
+    with span('list_probes') as probes_span:
+        for probe in probe_request:
+            probes_data[probe['id']] = _compact_probe(probe)
+
+            if limit is not None and len(probes_data) >= limit:
+                break
 
-        if limit is not None and len(probes_data) >= limit:
-            break
+        probes_span.set(items=len(probes_data))
 
     return probes_data
 
 
+class Completion(object):
+    # Early completion policy: a measurement is not waited for anymore once
+    # `min_reported` (a fraction) of its scheduled probes have reported, or
+    # when no probe has reported for `idle_timeout` seconds.
+
+    def __init__(self, min_reported=None, idle_timeout=None):
+        self.min_reported = min_reported
+        self.idle_timeout = idle_timeout
+
+
+class Progress(object):
+    # Tracks the number of probes that reported to a running measurement
+    # and picks the interval of the next status check. The status of a
+    # measurement only tells its schedule, the probes that reported are
+    # counted from its results.
+
+    def __init__(self, completion=None):
+        self.completion = completion
+        self.reported = 0
+        self.scheduled = None
+        self.expected_end = None
+        self.changed = time.time()
+
+    def update(self, status):
+        self.scheduled = status.get('probes_scheduled') or status.get('probes_requested')
+        self.expected_end = status['start_time'] + (status.get('spread') or 0) + REPORT_DELAY
+
+    def report(self, probe_ids):
+        # the probes with results so far
+        if len(probe_ids) != self.reported:
+            self.reported = len(probe_ids)
+            self.changed = time.time()
+
+    def is_complete(self):
+        if self.completion is None:
+            return False
+
+        min_reported = self.completion.min_reported
+        if min_reported is not None and self.scheduled and \
+                self.reported >= min_reported * self.scheduled:
+            return True
+
+        idle_timeout = self.completion.idle_timeout
+        return idle_timeout is not None and self.reported > 0 and \
+            time.time() - self.changed >= idle_timeout
+
+    def interval(self):
+        # Halve the distance to the expected end of the measurement; after
+        # that poll often while probes keep reporting and back off when
+        # they don't.
+        now = time.time()
+        if self.expected_end is None:
+            interval = POLL_INTERVAL
+        elif now < self.expected_end:
+            interval = (self.expected_end - now) / 2
+        else:
+            interval = (now - self.changed) / 2
+
+        return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, interval))
+
+
+def completion_from_args(args):
+    if args.min_reported is None and args.idle_timeout is None:
+        return None
+
+    min_reported = None if args.min_reported is None else args.min_reported / 100.0
+    return Completion(min_reported=min_reported, idle_timeout=args.idle_timeout)
+
+
 class Atlas(object):
-    def __init__(self, atlas_api_key, ip_version=4, protocol='ICMP'):
+    def __init__(self, atlas_api_key, ip_version=4, protocol='ICMP', cache=None,
+                 completion=None):
         self.af = ip_version
         self.atlas_api_key = atlas_api_key
         self.protocol = protocol
+        self.cache = cache
+        self.completion = completion
         self.source = None
         self.trace = None
 
@@ -41,14 +215,20 @@ class Atlas(object):
 
         return trace
 
-    def create_ping(self, target, packets=1):
+    def create_ping(self, target, packets=1, interval=None):
+        # an ongoing measurement repeats every `interval` seconds
+        options = {}
+        if interval is not None:
+            options['interval'] = interval
+
         ping = Ping(
             af=self.af,
             target=target,
             description="Ping for %s" % target,
             protocol=self.protocol,
             packets=packets,
-            skip_dns_check=True
+            skip_dns_check=True,
+            **options
         )
 
         return ping
@@ -78,43 +258,290 @@ class Atlas(object):
         return is_success, response
 
     @staticmethod
-    def request_results(response, timeout):
-        msm_data = list()
-        for measurement_num in response:
-            kwargs = {
-                "msm_id": measurement_num
-            }
+    def measurement_status(measurement_num, timeout, progress=None, reported=None):
+        # STOPPED, TIMED_OUT or COMPLETED if there is no reason to wait for
+        # the measurement anymore, None otherwise. `reported`: the probes
+        # with results so far if the caller fetches them anyway.
+        kwargs = {
+            "msm_id": measurement_num
+        }
 
-            # Check measurement status. Move on if measurement stopped or timeout expired.
-            while True:
-                is_success, results = AtlasStatusRequest(**kwargs).create()
-                if is_success:
-                    if results['status']['name'] == 'Stopped':
-                        break
-                    if timeout is not None and time.time() >= results['start_time'] + timeout:
-                        logging.warning('measurement %d timeout', measurement_num)
-                        break
+        is_success, results = AtlasStatusRequest(**kwargs).create()
+        if is_success:
+            if results['status']['name'] == 'Stopped':
+                return STOPPED
+            if timeout is not None and time.time() >= results['start_time'] + timeout:
+                logging.warning('measurement %d timeout', measurement_num)
+                return TIMED_OUT
+
+            logging.info('measurement %d status: %s', measurement_num, results['status']['name'])
+
+            if progress is not None:
+                progress.update(results)
+                if reported is None and progress.completion is not None:
+                    # the reported probes only matter to an early completion
+                    reported = Atlas._reported_probes(measurement_num)
+                if reported is not None:
+                    progress.report(reported)
+                if progress.is_complete():
+                    logging.info('measurement %d is complete: %d probes reported',
+                                 measurement_num, progress.reported)
+                    return COMPLETED
+        else:
+            logging.warning('status request failed: %s', results)
+
+        return None
+
+    @staticmethod
+    def _reported_probes(measurement_num):
+        # the latest result of every probe that reported, None on failure
+        is_success, results = AtlasLatestRequest(msm_id=measurement_num).create()
+        if not is_success:
+            logging.warning('latest results request failed: %s', results)
+            return None
+
+        return set(item['prb_id'] for item in results)
+
+    def _wait_measurement(self, measurement_num, timeout, cancelled):
+        # Check measurement status. Move on if measurement stopped or timeout expired.
+        progress = Progress(self.completion)
+        with span('wait_measurement', msm_id=measurement_num) as wait_span:
+            while not cancelled.is_set():
+                status = self.measurement_status(measurement_num, timeout, progress)
+                if status is not None:
+                    wait_span.set(status=status, items=progress.reported)
+                    return status
 
-                    logging.info('measurement %d status: %s', measurement_num, results['status']['name'])
-                else:
-                    logging.warning('status request failed: %s', results)
+                cancelled.wait(progress.interval())
 
-                time.sleep(10)
-                continue
+    def stop_measurement(self, measurement_num):
+        if self.atlas_api_key is None:
+            return
 
-            # Get measurement data
-            while True:
+        is_success, results = AtlasStopRequest(
+            msm_id=measurement_num, key=self.atlas_api_key
+        ).create()
+        if not is_success:
+            logging.warning('measurement %d stop request failed: %s', measurement_num, results)
+
+    @staticmethod
+    def fetch_results(measurement_num, start=None, cancelled=None):
+        # Retried until the results are fetched. None if cancelled before,
+        # which is not the same as a measurement without results.
+        if cancelled is None:
+            cancelled = threading.Event()
+
+        kwargs = {
+            "msm_id": measurement_num,
+            "start": start
+        }
+
+        with span('fetch_results', msm_id=measurement_num) as fetch_span:
+            while not cancelled.is_set():
                 is_success, results = AtlasResultsRequest(**kwargs).create()
                 if is_success:
-                    break
-                else:
-                    logging.warning('status request failed: %s', results)
-                    time.sleep(10)
+                    fetch_span.set(items=len(results))
+                    return results
+
+                logging.warning('status request failed: %s', results)
+                cancelled.wait(POLL_INTERVAL)
+
+        return None
+
+    def _cached_results(self, measurement_num):
+        if self.cache is None or measurement_num not in self.cache.results:
+            return None
+
+        with span('load_cached_results', msm_id=measurement_num) as load_span:
+            results = self.cache.results.load(measurement_num)
+            load_span.set(items=len(results) if results is not None else 0)
+
+        return results
+
+    def _cache_results(self, measurement_num, results):
+        # results of a stopped measurement never change
+        if self.cache is not None:
+            self.cache.results.store(measurement_num, results)
+
+    @staticmethod
+    def _download_results(measurement_num, cancelled):
+        # Results of a finished measurement, parsed one by one as they arrive.
+        # A broken download is restarted, skipping the results already read.
+        # Raises DownloadCancelled if cancelled before the end.
+        read = 0
+        while not cancelled.is_set():
+            is_success, results = AtlasResultLinesRequest(msm_id=measurement_num).create()
+            if is_success:
+                try:
+                    for i, item in enumerate(results):
+                        if i >= read:
+                            read += 1
+                            yield item
+                    return
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    results = e.args
+
+            logging.warning('results request failed: %s', results)
+            cancelled.wait(POLL_INTERVAL)
+
+        raise DownloadCancelled('measurement %d results download is cancelled' % measurement_num)
+
+    def _measurement_results(self, measurement_num, timeout, cancelled):
+        if self.cache is not None and measurement_num in self.cache.results:
+            logger.info('measurement %d results are loaded from the cache', measurement_num)
+            results = self.cache.results.iter_results(measurement_num)
+            name = 'load_cached_results'
+
+        else:
+            status = self._wait_measurement(measurement_num, timeout, cancelled)
+            if status == COMPLETED:
+                # don't wait for the rest of the probes, finish it for everyone
+                self.stop_measurement(measurement_num)
+
+            results = self._download_results(measurement_num, cancelled)
+            if status == STOPPED and self.cache is not None:
+                # results of a stopped measurement never change
+                results = self.cache.results.store_iter(measurement_num, results)
+            name = 'fetch_results'
+
+        with span(name, msm_id=measurement_num) as results_span:
+            count = 0
+            for item in results:
+                count += 1
+                yield item
+
+            results_span.set(items=count)
+
+    @staticmethod
+    def _put(results, item, cancelled):
+        # False if nobody reads the results anymore
+        while not cancelled.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce_results(self, measurement_num, timeout, cancelled, results):
+        try:
+            for item in self._measurement_results(measurement_num, timeout, cancelled):
+                if not self._put(results, (measurement_num, item), cancelled):
+                    return
+        except DownloadCancelled:
+            # nobody reads the results anymore
+            pass
+        finally:
+            self._put(results, None, cancelled)
+
+    def iter_measurement_results(self, response, timeout, workers=MAX_MEASUREMENTS,
+                                 buffer_size=RESULTS_BUFFER):
+        # (measurement id, result) pairs. Every measurement is polled by its
+        # own worker and downloaded as soon as it is stopped, so the total
+        # wait is the slowest measurement rather than the sum of all of them.
+        # Results are yielded as they are downloaded, with no more than
+        # buffer_size of them held in memory.
+        if not response:
+            return
+
+        cancelled = threading.Event()
+        results = queue.Queue(maxsize=buffer_size)
+        pool = ThreadPoolExecutor(max_workers=min(workers, len(response)))
+        with span('request_results', measurements=len(response)) as results_span:
+            count = 0
+            try:
+                futures = [
+                    pool.submit(self._produce_results, measurement_num, timeout, cancelled, results)
+                    for measurement_num in response
+                ]
+
+                finished = 0
+                while finished < len(futures):
+                    item = results.get()
+                    if item is None:
+                        finished += 1
+                        continue
+
+                    count += 1
+                    yield item
+
+                for future in futures:
+                    future.result()
+            finally:
+                cancelled.set()
+                pool.shutdown()
+
+            results_span.set(items=count)
+
+    def iter_results(self, response, timeout, workers=MAX_MEASUREMENTS, buffer_size=RESULTS_BUFFER):
+        for _, item in self.iter_measurement_results(response, timeout, workers, buffer_size):
+            yield item
+
+    def request_results(self, response, timeout, workers=MAX_MEASUREMENTS):
+        return list(self.iter_results(response, timeout, workers=workers))
+
+    def stream_results(self, response, timeout):
+        # Yield lists of results that have not been seen yet while the
+        # measurements are running. Atlas filters results by their own
+        # timestamp, but probes report with a delay, so every poll looks
+        # STREAM_LOOKBACK seconds back and drops results already yielded.
+        # Once a measurement is finished, its whole result set is checked.
+        # Every measurement is polled at the interval of its own progress,
+        # the probes it counts are those of the results yielded.
+        seen = set()
+        last_seen = dict.fromkeys(response, 0)
+        reported = dict((measurement_num, set()) for measurement_num in response)
+        progress = dict((measurement_num, Progress(self.completion)) for measurement_num in response)
+        next_poll = dict.fromkeys(response, 0)
+        running = list()
+        for measurement_num in response:
+            results = self._cached_results(measurement_num)
+            if results is None:
+                running.append(measurement_num)
+            elif results:
+                yield results
+
+        while running:
+            for measurement_num in list(running):
+                if next_poll[measurement_num] > time.time():
                     continue
 
-            msm_data.extend(results)
+                status = self.measurement_status(
+                    measurement_num, timeout, progress[measurement_num],
+                    reported=reported[measurement_num]
+                )
+                if status == COMPLETED:
+                    # don't wait for the rest of the probes, finish it for everyone
+                    self.stop_measurement(measurement_num)
 
-        return msm_data
+                start = None
+                if status is not None:
+                    running.remove(measurement_num)
+                elif last_seen[measurement_num]:
+                    start = last_seen[measurement_num] - STREAM_LOOKBACK
+
+                results = self.fetch_results(measurement_num, start=start)
+                if status == STOPPED:
+                    self._cache_results(measurement_num, results)
+
+                new_results = list()
+                for item in results:
+                    key = (measurement_num, item['prb_id'], item['timestamp'])
+                    if key in seen:
+                        continue
+
+                    seen.add(key)
+                    reported[measurement_num].add(item['prb_id'])
+                    last_seen[measurement_num] = max(last_seen[measurement_num], item['timestamp'])
+                    new_results.append(item)
+
+                next_poll[measurement_num] = time.time() + progress[measurement_num].interval()
+                if new_results:
+                    yield new_results
+
+            if running:
+                wake_up = min(next_poll[measurement_num] for measurement_num in running)
+                time.sleep(max(0, wake_up - time.time()))
 
 
 class AtlasStatusRequest(AtlasRequest):
@@ -128,3 +555,44 @@ class AtlasStatusRequest(AtlasRequest):
 
     def create(self):
         return self.get()
+
+
+class AtlasResultLinesRequest(AtlasRequest):
+    # Results as one JSON document per line (format=txt), so that they can be
+    # parsed as they arrive instead of loading the whole array at once.
+
+    def __init__(self, **kwargs):
+        super(AtlasResultLinesRequest, self).__init__(**kwargs)
+
+        self.url_path = '/api/v2/measurements/{0}/results/'
+        self.msm_id = kwargs["msm_id"]
+
+        self.url_path = self.url_path.format(self.msm_id)
+        self.http_method_args['params']['format'] = 'txt'
+        self.http_method_args['stream'] = True
+
+    @staticmethod
+    def _iter_lines(response):
+        try:
+            for line in response.iter_lines():
+                profiling.count(downloaded=len(line) + 1)
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            session.stream_read(response)
+            response.close()
+
+    def create(self):
+        # (True, iterator of the results) or (False, error)
+        self.build_url()
+        try:
+            response = self.get_http_method('GET')
+        except requests.exceptions.RequestException as e:
+            return False, e.args
+
+        if not response.ok:
+            message = response.text
+            response.close()
+            return False, message
+
+        return True, self._iter_lines(response)
@@ -0,0 +1,102 @@
+from collections import defaultdict
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_SIZE = 3
+FAILURE_THRESHOLD = 0.2
+TRACES_PER_ASN = 2
+# the same probes are drawn for the same probe list
+SAMPLE_SEED = 0
+
+
+def _shuffled(probe_ids, rng):
+    probe_ids = sorted(probe_ids)
+    rng.shuffle(probe_ids)
+    return probe_ids
+
+
+class AdaptiveSampling(object):
+    # Two-phase reachability check: ping `sample_size` probes of every
+    # country and ASN pair first, then ping the rest of the probes only in
+    # the countries where at least `failure_threshold` (a fraction) of the
+    # sampled probes failed. No more than `traces_per_asn` failed probes of
+    # an ASN are traced.
+
+    def __init__(self, sample_size=SAMPLE_SIZE, failure_threshold=FAILURE_THRESHOLD,
+                 traces_per_asn=TRACES_PER_ASN, seed=SAMPLE_SEED):
+        self.sample_size = sample_size
+        self.failure_threshold = failure_threshold
+        self.traces_per_asn = traces_per_asn
+        self.seed = seed
+
+    def sample(self, probes_data):
+        strata = defaultdict(list)
+        for probe_id, probe in probes_data.items():
+            strata[(probe['country_code'] or '', probe['asn_v4'])].append(probe_id)
+
+        rng = random.Random(self.seed)
+        sample = {}
+        for key in sorted(strata, key=str):
+            for probe_id in _shuffled(strata[key], rng)[:self.sample_size]:
+                sample[probe_id] = probes_data[probe_id]
+
+        logger.info(
+            'Sampled %d of %d probes in %d countries and ASNs',
+            len(sample), len(probes_data), len(strata)
+        )
+        return sample
+
+    def failure_rates(self, pings):
+        # by country, of the probes that have reported
+        failed = defaultdict(int)
+        for country in pings.failed_probes.values():
+            failed[country or ''] += 1
+
+        reported = defaultdict(int, failed)
+        for country in pings.results['country'].tolist():
+            reported[country] += 1
+
+        return dict(
+            (country, float(failed[country]) / count)
+            for country, count in reported.items()
+        )
+
+    def failing_countries(self, pings):
+        return sorted(
+            country
+            for country, rate in self.failure_rates(pings).items()
+            if rate > 0 and rate >= self.failure_threshold
+        )
+
+    def expansion(self, probes_data, countries, sampled):
+        countries = set(countries)
+        return dict(
+            (probe_id, probe)
+            for probe_id, probe in probes_data.items()
+            if (probe['country_code'] or '') in countries and probe_id not in sampled
+        )
+
+    def trace_probes(self, failed_probes, probes_data):
+        by_asn = defaultdict(list)
+        for probe_id in failed_probes:
+            by_asn[probes_data[probe_id]['asn_v4']].append(probe_id)
+
+        rng = random.Random(self.seed)
+        chosen = {}
+        for asn in sorted(by_asn, key=str):
+            for probe_id in _shuffled(by_asn[asn], rng)[:self.traces_per_asn]:
+                chosen[probe_id] = probes_data[probe_id]
+        return chosen
+
+
+def sampling_from_args(args):
+    if not args.adaptive:
+        return None
+
+    return AdaptiveSampling(
+        sample_size=args.sample_size,
+        failure_threshold=args.failure_threshold / 100.0,
+        traces_per_asn=args.traces_per_asn
+    )
@@ -0,0 +1,173 @@
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import logging
+import math
+import time
+
+from atlas_tools import ripe_atlas
+
+logger = logging.getLogger(__name__)
+
+# Atlas limits
+MAX_PROBES = 1000
+MAX_TARGET_MEASUREMENTS = 25
+MAX_RESULTS_RATE = 50
+
+CREATE_WORKERS = 10
+CREATE_RETRIES = 5
+# seconds before the first retry of a throttled creation, doubled every time
+CREATE_BACKOFF = 10
+THROTTLE_STATUSES = (429, 502, 503, 504)
+
+
+def plan_chunks(probe_ids, size=MAX_PROBES):
+    # as few measurements as possible, with evenly split probes
+    probe_ids = list(probe_ids)
+    if not probe_ids:
+        return []
+
+    count = int(math.ceil(float(len(probe_ids)) / size))
+    chunk_size, extra = divmod(len(probe_ids), count)
+
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + chunk_size + (1 if i < extra else 0)
+        chunks.append(probe_ids[start:end])
+        start = end
+
+    return chunks
+
+
+def min_spread(probe_number):
+    # no more than MAX_RESULTS_RATE results per second per measurement
+    return int(math.ceil(float(probe_number) / MAX_RESULTS_RATE))
+
+
+def _is_throttled(response):
+    # request errors (connection problems) come as a tuple of exception args
+    if not isinstance(response, dict):
+        return True
+
+    error = response.get('error') or {}
+    if error.get('status') in THROTTLE_STATUSES:
+        return True
+
+    detail = str(error.get('detail', '')).lower()
+    return 'concurrent' in detail or 'too many' in detail
+
+
+class Job(object):
+    def __init__(self, measurement, probes):
+        self.measurement = copy.deepcopy(measurement)
+        self.measurement.add_option(spread=min_spread(len(probes)))
+        self.probes = probes
+        self.key = (measurement.target, measurement.measurement_type)
+        self.measurements = []
+
+
+class MeasurementScheduler(object):
+    # Creates measurements for probe chunks within the Atlas limits: at most
+    # max_measurements at once and max_per_target of the same type against
+    # the same target. Chunks over the limits wait for running measurements
+    # to stop and are created in the next wave.
+
+    def __init__(self, atlas, timeout=None, max_measurements=ripe_atlas.MAX_MEASUREMENTS,
+                 max_per_target=MAX_TARGET_MEASUREMENTS, workers=CREATE_WORKERS,
+                 is_oneoff=True):
+        self.atlas = atlas
+        self.timeout = timeout
+        self.is_oneoff = is_oneoff
+        self.max_measurements = max_measurements
+        self.max_per_target = max_per_target
+        self.workers = workers
+        self.jobs = []
+
+    def add(self, measurement, probe_ids):
+        jobs = [Job(measurement, probes) for probes in plan_chunks(probe_ids)]
+        self.jobs.extend(jobs)
+        return jobs
+
+    def _create(self, job):
+        source = self.atlas.create_source(
+            msm_type='probes',
+            value=','.join(str(probe_id) for probe_id in job.probes),
+            num_of_probes=len(job.probes)
+        )
+
+        delay = CREATE_BACKOFF
+        for attempt in range(CREATE_RETRIES + 1):
+            is_success, resp = self.atlas.create_request(
+                [job.measurement], source, is_oneoff=self.is_oneoff
+            )
+            if is_success:
+                return resp['measurements']
+
+            if attempt == CREATE_RETRIES or not _is_throttled(resp):
+                break
+
+            logger.warning('measurement creation throttled, retry in %d s: %s', delay, resp)
+            time.sleep(delay)
+            delay *= 2
+
+        logger.error('%s %s', is_success, resp)
+        return []
+
+    def _launch(self, queue, running, pool):
+        per_target = defaultdict(int)
+        for key in running.values():
+            per_target[key] += 1
+
+        batch = []
+        for job in list(queue):
+            if len(running) + len(batch) >= self.max_measurements:
+                break
+            if per_target[job.key] >= self.max_per_target:
+                continue
+
+            per_target[job.key] += 1
+            batch.append(job)
+            queue.remove(job)
+
+        for job, measurements in zip(batch, pool.map(self._create, batch)):
+            job.measurements = measurements
+            for msm_id in measurements:
+                running[msm_id] = job.key
+
+        return len(batch)
+
+    def _wait_slot(self, running):
+        # Until at least one of the running measurements stops. A timed out
+        # measurement still counts in the Atlas limits, it is stopped first.
+        running_number = len(running)
+        while running and len(running) == running_number:
+            time.sleep(ripe_atlas.POLL_INTERVAL)
+            for msm_id in list(running):
+                status = self.atlas.measurement_status(msm_id, self.timeout)
+                if status == ripe_atlas.STOPPED:
+                    del running[msm_id]
+                elif status == ripe_atlas.TIMED_OUT:
+                    self.atlas.stop_measurement(msm_id)
+
+    def run(self):
+        queue = deque(self.jobs)
+        running = {}
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while queue:
+                launched = self._launch(queue, running, pool)
+                if not queue:
+                    break
+
+                if not launched and not running:
+                    # nothing is running and nothing can be created
+                    logger.error('%d measurements can not be scheduled', len(queue))
+                    break
+
+                logger.info('%d measurements are queued until the running ones stop', len(queue))
+                self._wait_slot(running)
+        finally:
+            pool.shutdown()
+
+        return self.jobs
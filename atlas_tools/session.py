@@ -0,0 +1,141 @@
+import logging
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# idle keep-alive connections kept per host: one per results worker,
+# see ripe_atlas.MAX_MEASUREMENTS
+POOL_SIZE = 100
+
+# the session of all the Atlas API calls, see configure()
+_session = None
+_session_lock = threading.Lock()
+
+
+class _CountingAdapter(HTTPAdapter):
+    # remembers the connection pools it sends through, they count the
+    # connections they open
+
+    def __init__(self, session, **kwargs):
+        self.atlas_session = session
+        super(_CountingAdapter, self).__init__(**kwargs)
+
+    def get_connection_with_tls_context(self, *args, **kwargs):
+        # requests >= 2.32
+        pool = super(_CountingAdapter, self).get_connection_with_tls_context(*args, **kwargs)
+        self.atlas_session._track(pool)
+        return pool
+
+    def get_connection(self, *args, **kwargs):
+        pool = super(_CountingAdapter, self).get_connection(*args, **kwargs)
+        self.atlas_session._track(pool)
+        return pool
+
+
+class AtlasSession(object):
+    # A pooled keep-alive session shared by the threads polling Atlas.
+    # Bytes are counted as they come over the wire, so compressed responses
+    # count their compressed size.
+
+    def __init__(self, pool_size=POOL_SIZE, gzip=True):
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        # requests already asks for 'gzip, deflate', gzip=False asks for uncompressed
+        # responses instead, to measure what the compression saves (see test_session)
+        self.session.headers['Accept-Encoding'] = 'gzip' if gzip else 'identity'
+
+        adapter = _CountingAdapter(self, pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._pools = []
+        self._streams = weakref.WeakSet()
+        self._requests = 0
+        self._bytes = 0
+
+    def _track(self, pool):
+        with self._lock:
+            if all(pool is not known for known in self._pools):
+                self._pools.append(pool)
+
+    def request(self, method, url, **kwargs):
+        response = self.session.request(method, url, **kwargs)
+        with self._lock:
+            self._requests += 1
+            if kwargs.get('stream'):
+                # counted once it is read, see stream_read()
+                self._streams.add(response)
+            else:
+                self._bytes += response.raw.tell()
+        return response
+
+    def stream_read(self, response):
+        with self._lock:
+            if response in self._streams:
+                self._streams.discard(response)
+                self._bytes += response.raw.tell()
+
+    def counters(self):
+        with self._lock:
+            connections = sum(pool.num_connections for pool in self._pools)
+            return {
+                'requests': self._requests,
+                'connections': connections,
+                'reused_connections': max(0, self._requests - connections),
+                'bytes': self._bytes,
+            }
+
+    def close(self):
+        self.session.close()
+
+
+def _http_method(method):
+    def http_method(url, **kwargs):
+        return get_session().request(method, url, **kwargs)
+
+    http_method.pooled = True
+    return http_method
+
+
+def install():
+    # every cousteau request calls one of AtlasRequest.http_methods
+    from ripe.atlas.cousteau.request import AtlasRequest
+
+    if getattr(AtlasRequest.http_methods.get('GET'), 'pooled', False):
+        return
+
+    AtlasRequest.http_methods = dict(
+        (method, _http_method(method)) for method in AtlasRequest.http_methods
+    )
+
+
+def get_session():
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = AtlasSession()
+        return _session
+
+
+def configure(pool_size=POOL_SIZE, gzip=True):
+    global _session
+
+    with _session_lock:
+        session, _session = _session, AtlasSession(pool_size=pool_size, gzip=gzip)
+    if session is not None:
+        session.close()
+    logger.info('Atlas API session with %d pooled connections', pool_size)
+
+
+def stream_read(response):
+    get_session().stream_read(response)
+
+
+def counters():
+    return get_session().counters()
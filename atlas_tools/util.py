@@ -11,13 +11,22 @@ def base_parser():
     return parser
 
 
-def atlas_parser():
+def atlas_parser(multiple_targets=False, one_off=True):
     parser = argparse.ArgumentParser(add_help=False)
-    parser.add_argument(
-        '-t', '--target',
-        required=True,
-        help='IPv4 address | domain name'
-    )
+    if multiple_targets:
+        parser.add_argument(
+            '-t', '--targets',
+            nargs='+',
+            default=[],
+            metavar='TARGET',
+            help='IPv4 addresses | domain names'
+        )
+    else:
+        parser.add_argument(
+            '-t', '--target',
+            required=True,
+            help='IPv4 address | domain name'
+        )
     parser.add_argument(
         '-k', '--key',
         # required=True,
@@ -36,12 +45,67 @@ def atlas_parser():
         help='number of probes in measurement '
              '(default: all active Atlas probes)'
     )
+    # ongoing measurements are never stopped
+    if one_off:
+        parser.add_argument(
+            '-T', '--timeout',
+            type=int,
+            default=900,
+            help='time allocated for measurement in seconds '
+                 '(default: 15 min)'
+        )
+        parser.add_argument(
+            '--min-reported',
+            type=float,
+            metavar='PERCENT',
+            help='stop a measurement once this share of its probes have reported '
+                 '(default: wait for all of them)'
+        )
+        parser.add_argument(
+            '--idle-timeout',
+            type=int,
+            metavar='SECONDS',
+            help='stop a measurement if no probe has reported for this long '
+                 '(default: wait for all of them)'
+        )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        help='directory of the local probe and result cache '
+             '(default: ~/.cache/atlas_tools)'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='always query Atlas, do not read or write the local cache'
+    )
+    parser.add_argument(
+        '--probes-ttl',
+        type=int,
+        default=3600,
+        metavar='SECONDS',
+        help='refresh the cached probe list if it is older than this '
+             '(default: 1 hour)'
+    )
+    parser.add_argument(
+        '--atlas-url',
+        metavar='URL',
+        help='Atlas API to use, e.g. a local stand-in for testing '
+             '(default: https://atlas.ripe.net)'
+    )
     parser.add_argument(
-        '-T', '--timeout',
+        '--pool-size',
         type=int,
-        default=900,
-        help='time allocated for measurement in seconds '
-             '(default: 15 min)'
+        default=100,
+        metavar='N',
+        help='keep-alive connections to the Atlas API kept open for the concurrent '
+             'polling (default: 100)'
+    )
+    parser.add_argument(
+        '--profile-out',
+        metavar='FILE',
+        help='write timing and resource usage of every stage to FILE as JSON lines '
+             '(default: no profiling)'
     )
     return parser
 
@@ -16,6 +16,8 @@ setup(
             'atlas-countrymap = atlas_tools.latency_countrymap:main',
             'atlas-dnsmap = atlas_tools.dns_map:main',
             'atlas-reachability = atlas_tools.reachability:main',
+            'atlas-batch = atlas_tools.batch:main',
+            'atlas-monitor = atlas_tools.monitor:main',
         ],
     },
     package_data={
@@ -13,6 +13,10 @@ BASE_MEASUREMENT_ID = 10000
 
 _measurement_id = BASE_MEASUREMENT_ID
 _measurements = {}
+_stopped = set()
+# generated data used instead of the fixtures, by name or by measurement id
+synthetic_data = {}
+synthetic_results = {}
 
 atlas_data_types = {
     'ping': 'ping_results',
@@ -21,6 +25,9 @@ atlas_data_types = {
 
 
 def _json_data(name):
+    if name in synthetic_data:
+        return synthetic_data[name]
+
     fpath = os.path.join(DATA_PATH, name + '.json.gz')
     with gzip.open(fpath, 'rt') as fd:
         return json.load(fd)
@@ -63,7 +70,15 @@ def atlas_status(self):
     return is_success, response
 
 
+def atlas_stop(self):
+    _stopped.add(self.msm_id)
+    return True, None
+
+
 def atlas_results(self):
+    if self.msm_id in synthetic_results:
+        return True, synthetic_results[self.msm_id]
+
     measurement_type = _measurements[self.msm_id]
     data_type = atlas_data_types[measurement_type]
 
@@ -72,14 +87,24 @@ def atlas_results(self):
     return is_success, response
 
 
+def atlas_result_lines(self):
+    is_success, response = atlas_results(self)
+    return is_success, iter(response)
+
+
+PATCHES = [
+    ('ripe.atlas.cousteau.request.AtlasRequest.http_method', atlas_http_method),
+    ('ripe.atlas.cousteau.ProbeRequest.__iter__', atlas_probes),
+    ('ripe.atlas.cousteau.request.AtlasCreateRequest.create', atlas_create_request),
+    ('atlas_tools.ripe_atlas.AtlasStatusRequest.create', atlas_status),
+    ('ripe.atlas.cousteau.request.AtlasResultsRequest.create', atlas_results),
+    ('ripe.atlas.cousteau.request.AtlasLatestRequest.create', atlas_results),
+    ('atlas_tools.ripe_atlas.AtlasResultLinesRequest.create', atlas_result_lines),
+    ('ripe.atlas.cousteau.request.AtlasStopRequest.create', atlas_stop),
+]
+
+
 def patch_atlas(cls):
-    patches = [
-        ('ripe.atlas.cousteau.request.AtlasRequest.http_method', atlas_http_method),
-        ('ripe.atlas.cousteau.ProbeRequest.__iter__', atlas_probes),
-        ('ripe.atlas.cousteau.request.AtlasCreateRequest.create', atlas_create_request),
-        ('atlas_tools.ripe_atlas.AtlasStatusRequest.create', atlas_status),
-        ('ripe.atlas.cousteau.request.AtlasResultsRequest.create', atlas_results),
-    ]
-    for patch_spec in patches:
+    for patch_spec in PATCHES:
         cls = patch(*patch_spec)(cls)
     return cls
@@ -0,0 +1,566 @@
+from __future__ import print_function
+
+import argparse
+from collections import Counter
+import json
+import random
+import re
+import threading
+import time
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlencode, urlparse, parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import urlencode
+    from urlparse import urlparse, parse_qsl
+
+from atlas_tools.ripe_atlas import MAX_MEASUREMENTS
+from atlas_tools.scheduler import MAX_TARGET_MEASUREMENTS
+
+from tests.benchmark import SyntheticLoad
+
+# Stand-in of the Atlas API endpoints used by the tools, served on localhost
+# so that the real client runs end to end with no network access:
+#   python -m tests.atlas_server -n 10000 --latency 0.05 --throttle-rate 0.1
+#   atlas-heatmap -t example.com -k any --atlas-url http://127.0.0.1:8000
+
+PORT = 8000
+BASE_MEASUREMENT_ID = 20000
+PAGE_SIZE = 100
+# seconds of the spread of measurements created without one
+DEFAULT_SPREAD = 60
+# endpoints that throttle and fail; the probe listing of cousteau raises on
+# the first failed page, as it does against Atlas
+FAULTY_ENDPOINTS = ('create', 'status', 'results', 'stop')
+# results lines written before a broken stream is cut
+BROKEN_STREAM_LINES = 10
+# smaller responses are not compressed
+GZIP_MIN_SIZE = 1024
+
+ONGOING = {'id': 2, 'name': 'Ongoing'}
+STOPPED = {'id': 4, 'name': 'Stopped'}
+
+MEASUREMENT_PATH = re.compile(r'^/api/v2/measurements/(\d+)/?$')
+RESULTS_PATH = re.compile(r'^/api/v2/measurements/(\d+)/results/?$')
+LATEST_PATH = re.compile(r'^/api/v2/measurements/(\d+)/latest/?$')
+
+
+def _gzip_compressor():
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _error(status, title, detail):
+    return status, {'error': {'status': status, 'title': title, 'detail': detail}}
+
+
+class ServedMeasurement(object):
+    # A measurement of the stand-in: every probe reports `offset` seconds
+    # after the start and, if it is ongoing, every `interval` seconds after
+    # that, until the measurement is stopped. Times are scaled by the
+    # time scale of the server.
+
+    def __init__(self, msm_id, definition, probe_ids, offsets, start_time, is_oneoff,
+                 time_scale=1.0):
+        self.msm_id = msm_id
+        self.type = definition['type']
+        self.target = definition['target']
+        self.spread = (definition.get('spread') or DEFAULT_SPREAD) * time_scale
+        self.interval = None if is_oneoff else definition.get('interval', 240) * time_scale
+        self.probe_ids = probe_ids
+        self.offsets = offsets
+        self.start_time = start_time
+        self.stop_time = None
+        if is_oneoff:
+            self.stop_time = start_time + max(offsets.values() or [0])
+
+    def key(self):
+        return self.target, self.type
+
+    def is_running(self, now):
+        return self.stop_time is None or now < self.stop_time
+
+    def stop(self, now):
+        if self.is_running(now):
+            self.stop_time = now
+
+    def reports(self, now, start=None, stop=None):
+        # (timestamp, probe id) in the order of the timestamps
+        end = now if self.stop_time is None else min(now, self.stop_time)
+        if stop is not None:
+            end = min(end, stop)
+
+        reports = []
+        for probe_id, offset in self.offsets.items():
+            timestamp = self.start_time + offset
+            while timestamp <= end:
+                if start is None or timestamp >= start:
+                    reports.append((timestamp, probe_id))
+                if self.interval is None:
+                    break
+                timestamp += self.interval
+
+        return sorted(reports)
+
+    def status(self, now):
+        return {
+            'id': self.msm_id,
+            'type': self.type,
+            'target': self.target,
+            'status': ONGOING if self.is_running(now) else STOPPED,
+            'start_time': int(self.start_time),
+            'stop_time': None if self.stop_time is None else int(self.stop_time),
+            'spread': self.spread,
+            'interval': self.interval,
+            'is_oneoff': self.interval is None,
+            'probes_requested': len(self.probe_ids),
+            'probes_scheduled': len(self.probe_ids),
+        }
+
+
+class AtlasServer(object):
+    # latency: seconds before every response
+    # time_scale: measurement spreads and intervals are multiplied by it
+    # throttle_rate, failure_rate: shares of the requests answered with 429
+    #   and 503, of the FAULTY_ENDPOINTS only
+    # broken_stream_rate: share of the line results downloads cut short
+    # silent_share: share of the scheduled probes that never report
+
+    def __init__(self, load=None, latency=0.0, time_scale=1.0, throttle_rate=0.0,
+                 failure_rate=0.0, broken_stream_rate=0.0, silent_share=0.0,
+                 max_measurements=MAX_MEASUREMENTS, max_per_target=MAX_TARGET_MEASUREMENTS,
+                 port=0, seed=0):
+        if load is None:
+            load = SyntheticLoad(1000, seed=seed)
+
+        self.latency = latency
+        self.time_scale = time_scale
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.broken_stream_rate = broken_stream_rate
+        self.silent_share = silent_share
+        self.max_measurements = max_measurements
+        self.max_per_target = max_per_target
+        self.started = time.time()
+
+        self.probes = load.probes()
+        self.templates = {
+            'ping': dict((item['prb_id'], item) for item in load.ping_results()),
+            'traceroute': dict((item['prb_id'], item) for item in load.trace_results()),
+        }
+        self.measurements = {}
+        # requests by endpoint and responses by status code
+        self.requests = Counter()
+        self.responses = Counter()
+
+        self._next_id = BASE_MEASUREMENT_ID
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.httpd.atlas = self
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def _chance(self, rate):
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def _fault(self, endpoint):
+        if endpoint not in FAULTY_ENDPOINTS:
+            return None
+        if self._chance(self.throttle_rate):
+            return _error(429, 'Too Many Requests', 'Request was throttled.')
+        if self._chance(self.failure_rate):
+            return _error(503, 'Service Unavailable', 'The server is temporarily unavailable.')
+        return None
+
+    def _select_probes(self, sources):
+        probe_ids = []
+        for source in sources:
+            value = str(source.get('value', ''))
+            if source['type'] == 'probes':
+                wanted = set(int(probe_id) for probe_id in value.split(',') if probe_id)
+                candidates = [probe['id'] for probe in self.probes if probe['id'] in wanted]
+            elif source['type'] == 'country':
+                candidates = [probe['id'] for probe in self.probes if probe['country_code'] == value]
+            else:
+                candidates = [probe['id'] for probe in self.probes]
+
+            probe_ids.extend(candidates[:source.get('requested', len(candidates))])
+        return probe_ids
+
+    def create(self, request):
+        now = time.time()
+        with self._lock:
+            running = [msm for msm in self.measurements.values() if msm.is_running(now)]
+            per_target = Counter(msm.key() for msm in running)
+
+            measurements = []
+            probe_ids = self._select_probes(request.get('probes', []))
+            if not probe_ids:
+                return _error(400, 'Bad Request', 'No suitable probes for the measurement.')
+
+            for definition in request['definitions']:
+                key = (definition['target'], definition['type'])
+                if len(running) + len(measurements) >= self.max_measurements:
+                    return _error(400, 'Bad Request', 'You have too many concurrent measurements.')
+                if per_target[key] >= self.max_per_target:
+                    return _error(
+                        400, 'Bad Request',
+                        'There are too many concurrent measurements to the same target.'
+                    )
+
+                spread = (definition.get('spread') or DEFAULT_SPREAD) * self.time_scale
+                offsets = dict(
+                    (probe_id, self._random.uniform(0, spread))
+                    for probe_id in probe_ids
+                    if self._random.random() >= self.silent_share
+                )
+                measurement = ServedMeasurement(
+                    self._next_id, definition, probe_ids, offsets, now,
+                    bool(request.get('is_oneoff')), time_scale=self.time_scale
+                )
+                self._next_id += 1
+                per_target[key] += 1
+                measurements.append(measurement)
+
+            for measurement in measurements:
+                self.measurements[measurement.msm_id] = measurement
+
+        return 201, {'measurements': [measurement.msm_id for measurement in measurements]}
+
+    def _measurement(self, msm_id):
+        with self._lock:
+            return self.measurements.get(msm_id)
+
+    def status(self, msm_id):
+        measurement = self._measurement(msm_id)
+        if measurement is None:
+            return _error(404, 'Not Found', 'Not found.')
+        return 200, measurement.status(time.time())
+
+    def stop_measurement(self, msm_id):
+        measurement = self._measurement(msm_id)
+        if measurement is None:
+            return _error(404, 'Not Found', 'Not found.')
+
+        with self._lock:
+            measurement.stop(time.time())
+        return 204, None
+
+    def results(self, msm_id, params):
+        measurement = self._measurement(msm_id)
+        if measurement is None:
+            return None
+
+        start = float(params['start']) if 'start' in params else None
+        stop = float(params['stop']) if 'stop' in params else None
+        probe_ids = None
+        if params.get('probe_ids'):
+            probe_ids = set(int(probe_id) for probe_id in params['probe_ids'].split(','))
+
+        templates = self.templates.get(measurement.type, {})
+        results = []
+        for timestamp, probe_id in measurement.reports(time.time(), start, stop):
+            if probe_id not in templates or (probe_ids is not None and probe_id not in probe_ids):
+                continue
+
+            item = dict(templates[probe_id])
+            item.update(msm_id=msm_id, timestamp=int(timestamp), dst_name=measurement.target)
+            results.append(item)
+        return results
+
+    def list_probes(self, params):
+        probes = self.probes
+        for name, value in params.items():
+            if name == 'status_name':
+                probes = [probe for probe in probes if probe['status']['name'] == value]
+            elif name == 'tags':
+                tags = set(value.split(','))
+                probes = [
+                    probe for probe in probes
+                    if tags <= set(tag['slug'] for tag in probe['tags'])
+                ]
+            elif name == 'country_code':
+                probes = [probe for probe in probes if probe['country_code'] == value]
+            elif name == 'id__in':
+                probe_ids = set(int(probe_id) for probe_id in value.split(','))
+                probes = [probe for probe in probes if probe['id'] in probe_ids]
+            elif name == 'id__gt':
+                probes = [probe for probe in probes if probe['id'] > int(value)]
+            elif name == 'status_since__gte':
+                # all the probes have been connected since the server started
+                if self.started < float(value):
+                    probes = []
+
+        return probes
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, so every response has a length or is chunked
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, delayed ACKs would hold the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _gzip(self):
+        return 'gzip' in (self.headers.get('Accept-Encoding') or '')
+
+    def _reply(self, status, body=None):
+        atlas = self.server.atlas
+        with atlas._lock:
+            atlas.responses[status] += 1
+
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        if len(data) >= GZIP_MIN_SIZE and self._gzip():
+            compressor = _gzip_compressor()
+            data = compressor.compress(data) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data):
+        self.wfile.write(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+
+    def _stream_lines(self, results, broken):
+        atlas = self.server.atlas
+        with atlas._lock:
+            atlas.responses[200] += 1
+
+        compressor = _gzip_compressor() if self._gzip() else None
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        if compressor is not None:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        for i, item in enumerate(results):
+            if broken and i >= BROKEN_STREAM_LINES:
+                # no terminating chunk: the client sees a broken download
+                self.close_connection = True
+                return
+
+            data = json.dumps(item).encode('utf-8') + b'\n'
+            if compressor is not None:
+                data = compressor.compress(data)
+            # an empty chunk would end the stream
+            if data:
+                self._write_chunk(data)
+
+        if compressor is not None:
+            self._write_chunk(compressor.flush())
+        self._write_chunk(b'')
+
+    def _endpoint(self, method, path):
+        if path.rstrip('/') == '/api/v2/probes' and method == 'GET':
+            return 'probes', None
+        if path.rstrip('/') == '/api/v2/measurements' and method == 'POST':
+            return 'create', None
+
+        match = RESULTS_PATH.match(path)
+        if match and method == 'GET':
+            return 'results', int(match.group(1))
+        match = LATEST_PATH.match(path)
+        if match and method == 'GET':
+            return 'latest', int(match.group(1))
+
+        match = MEASUREMENT_PATH.match(path)
+        if match and method == 'GET':
+            return 'status', int(match.group(1))
+        if match and method == 'DELETE':
+            return 'stop', int(match.group(1))
+
+        return None, None
+
+    def _handle(self, method):
+        atlas = self.server.atlas
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        endpoint, msm_id = self._endpoint(method, url.path)
+
+        body = None
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+
+        with atlas._lock:
+            atlas.requests[endpoint or 'unknown'] += 1
+
+        if atlas.latency:
+            time.sleep(atlas.latency)
+
+        if endpoint is None:
+            return self._reply(*_error(404, 'Not Found', 'Not found.'))
+
+        fault = atlas._fault(endpoint)
+        if fault is not None:
+            return self._reply(*fault)
+
+        if endpoint in ('create', 'stop') and \
+                not (self.headers.get('Authorization') or '').startswith('Key '):
+            return self._reply(*_error(
+                403, 'Forbidden', 'Authentication credentials were not provided.'
+            ))
+
+        if endpoint == 'create':
+            return self._reply(*atlas.create(json.loads(body.decode('utf-8'))))
+        if endpoint == 'status':
+            return self._reply(*atlas.status(msm_id))
+        if endpoint == 'stop':
+            return self._reply(*atlas.stop_measurement(msm_id))
+        if endpoint == 'probes':
+            return self._probes_page(params)
+
+        results = atlas.results(msm_id, params)
+        if results is None:
+            return self._reply(*_error(404, 'Not Found', 'Not found.'))
+        if endpoint == 'latest':
+            # the results are sorted by time, the last one of a probe wins
+            latest = dict((item['prb_id'], item) for item in results)
+            return self._reply(200, list(latest.values()))
+        if params.get('format') == 'txt':
+            return self._stream_lines(results, atlas._chance(atlas.broken_stream_rate))
+        return self._reply(200, results)
+
+    def _probes_page(self, params):
+        page = int(params.pop('page', 1))
+        page_size = int(params.pop('page_size', PAGE_SIZE))
+        probes = self.server.atlas.list_probes(params)
+
+        start = (page - 1) * page_size
+        next_url = None
+        if start + page_size < len(probes):
+            params.update(page=page + 1, page_size=page_size)
+            next_url = 'http://%s/api/v2/probes/?%s' % (self.headers['Host'], urlencode(params))
+
+        self._reply(200, {
+            'count': len(probes),
+            'next': next_url,
+            'previous': None,
+            'results': probes[start:start + page_size],
+        })
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='serve a stand-in of the Atlas API with synthetic probes and results'
+    )
+    parser.add_argument('-p', '--port', type=int, default=PORT, help='(default: %d)' % PORT)
+    parser.add_argument(
+        '-n', '--probes',
+        type=int,
+        default=10000,
+        help='synthetic probe population (default: 10000)'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        metavar='SECONDS',
+        help='delay of every response (default: 0)'
+    )
+    parser.add_argument(
+        '--time-scale',
+        type=float,
+        default=1.0,
+        help='multiplier of the measurement spreads and intervals (default: 1)'
+    )
+    parser.add_argument(
+        '--throttle-rate',
+        type=float,
+        default=0.0,
+        help='share of the measurement requests answered with 429 (default: 0)'
+    )
+    parser.add_argument(
+        '--failure-rate',
+        type=float,
+        default=0.0,
+        help='share of the measurement requests answered with 503 (default: 0)'
+    )
+    parser.add_argument(
+        '--broken-stream-rate',
+        type=float,
+        default=0.0,
+        help='share of the results downloads cut short (default: 0)'
+    )
+    parser.add_argument(
+        '--silent-share',
+        type=float,
+        default=0.0,
+        help='share of the scheduled probes that never report (default: 0)'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='(default: 0)')
+    args = parser.parse_args()
+
+    server = AtlasServer(
+        SyntheticLoad(args.probes, seed=args.seed),
+        latency=args.latency,
+        time_scale=args.time_scale,
+        throttle_rate=args.throttle_rate,
+        failure_rate=args.failure_rate,
+        broken_stream_rate=args.broken_stream_rate,
+        silent_share=args.silent_share,
+        port=args.port,
+        seed=args.seed
+    )
+    print('Atlas API stand-in at %s' % server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print('requests: %s' % dict(server.requests))
+        print('responses: %s' % dict(server.responses))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from mock import patch
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from atlas_tools.dns_map import make_map
+from atlas_tools.latency_countrymap import country_latencies
+from atlas_tools.grid import _make_grid, interpolate, EARTH_RADIUS
+from atlas_tools import ripe_atlas, scheduler, session
+from atlas_tools.measurement import PingMeasure, TraceMeasure, ping_measure
+from atlas_tools.reachability import _log_traces
+from atlas_tools.reverse_dns import PtrCache
+from atlas_tools.ripe_atlas import Atlas, form_probes, use_server
+from atlas_tools.scheduler import MAX_PROBES
+
+from tests import atlas_mock
+
+# Synthetic load benchmark of the pipeline stages, on top of the Atlas mocks:
+#   python -m tests.benchmark -n 1000 10000
+#   python -m tests.benchmark --compare .benchmarks/<commit>.json
+# and of the whole client against the local Atlas API stand-in:
+#   python -m tests.benchmark -n 10000 --end-to-end --latency 0.05
+
+PROBE_NUMBERS = (1000, 5000, 10000, 50000)
+STAGES = (
+    'form_probes', 'request_results', 'ping_flush_results', 'make_grid',
+    'interpolate_grid', 'handle_data', 'make_map', 'trace_flush_results', 'log_traces',
+)
+RESULTS_DIR = '.benchmarks'
+SEED = 42
+GRID_DENSITY = 4
+TARGET = 'example.com'
+# (latitude, longitude) of the target
+TARGET_LOCATION = (50.11, 8.68)
+# share of probes failing the ping and traced
+FAILED_SHARE = 0.05
+RESOLVED_IPS = 8
+TRANSIT_ROUTERS = 2000
+TRACE_HOPS = 12
+# ratio of the compared wall time reported as a regression
+REGRESSION_RATIO = 1.2
+# seconds of the stand-in server response delay
+LATENCY = 0.02
+# the measurements and the client polling run this much faster than on Atlas
+TIME_SCALE = 0.01
+
+# Atlas probes gather where the networks are: (country, lat, lon, weight)
+PROBE_CLUSTERS = [
+    ('DE', 50.11, 8.68, 14), ('NL', 52.37, 4.90, 10), ('FR', 48.86, 2.35, 8),
+    ('GB', 51.51, -0.13, 8), ('RU', 55.76, 37.62, 6), ('IT', 41.90, 12.50, 4),
+    ('UA', 50.45, 30.52, 3), ('SE', 59.33, 18.07, 3), ('US', 40.71, -74.01, 10),
+    ('US', 37.77, -122.42, 6), ('CA', 43.65, -79.38, 3), ('BR', -23.55, -46.63, 3),
+    ('JP', 35.68, 139.69, 3), ('IN', 19.08, 72.88, 2), ('AU', -33.87, 151.21, 2),
+    ('SG', 1.35, 103.82, 1), ('ZA', -26.20, 28.05, 1), ('AR', -34.60, -58.38, 1),
+]
+# degrees of the normal spread around a cluster center
+CLUSTER_SPREAD = 3.0
+
+
+def _ip(number):
+    return '%d.%d.%d.%d' % (
+        10 + (number >> 24) % 200, (number >> 16) & 255, (number >> 8) & 255, number & 255
+    )
+
+
+def _distance(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    target_lat, target_lon = np.radians(TARGET_LOCATION)
+    cos_angle = (np.sin(lat) * np.sin(target_lat) +
+                 np.cos(lat) * np.cos(target_lat) * np.cos(lon - target_lon))
+    return EARTH_RADIUS * np.arccos(np.clip(cos_angle, -1, 1))
+
+
+class SyntheticLoad(object):
+    def __init__(self, probe_number, seed=SEED):
+        self.probe_number = probe_number
+        random = np.random.RandomState(seed)
+
+        weights = np.array([cluster[3] for cluster in PROBE_CLUSTERS], dtype=float)
+        clusters = random.choice(len(PROBE_CLUSTERS), probe_number, p=weights / weights.sum())
+        centers = np.array([cluster[1:3] for cluster in PROBE_CLUSTERS])[clusters]
+
+        self.latitudes = np.clip(
+            centers[:, 0] + random.normal(0, CLUSTER_SPREAD, probe_number), -60, 75
+        ).round(4)
+        self.longitudes = (
+            (centers[:, 1] + random.normal(0, CLUSTER_SPREAD, probe_number) + 180) % 360 - 180
+        ).round(4)
+        self.countries = [PROBE_CLUSTERS[cluster][0] for cluster in clusters]
+        self.clusters = clusters
+        self.asns = 1000 + clusters * 100 + random.randint(0, 50, probe_number)
+
+        # ~200 km per ms of round trip in fiber plus last mile noise
+        self.rtts = (2 + _distance(self.latitudes, self.longitudes) / 100 *
+                     random.lognormal(0.2, 0.3, probe_number)).round(3)
+        self.failed = random.random_sample(probe_number) < FAILED_SHARE
+        self.random = random
+
+    def probe_ids(self):
+        return range(1, self.probe_number + 1)
+
+    def probes(self):
+        return [
+            {
+                'id': prb_id,
+                'country_code': self.countries[i],
+                'asn_v4': int(self.asns[i]),
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [float(self.longitudes[i]), float(self.latitudes[i])],
+                },
+                'status': {'id': 1, 'name': 'Connected'},
+                'tags': [{'name': 'system: IPv4 Works', 'slug': 'system-ipv4-works'}],
+                'is_anchor': False,
+                'is_public': True,
+            }
+            for i, prb_id in enumerate(self.probe_ids())
+        ]
+
+    def ping_results(self):
+        results = []
+        for i, prb_id in enumerate(self.probe_ids()):
+            rtt = -1 if self.failed[i] else float(self.rtts[i])
+            results.append({
+                'af': 4, 'prb_id': prb_id, 'type': 'ping', 'proto': 'ICMP',
+                'from': _ip(prb_id), 'src_addr': '192.168.1.2',
+                'dst_name': TARGET,
+                # geo DNS: the nearest of a few addresses
+                'dst_addr': '198.51.100.%d' % (self.clusters[i] % RESOLVED_IPS + 1),
+                'result': [{'x': '*'}] if rtt == -1 else [{'rtt': rtt}],
+                'min': rtt, 'avg': rtt, 'max': rtt,
+                'sent': 1, 'rcvd': 0 if rtt == -1 else 1, 'size': 64,
+                'timestamp': 1524000000 + i % 600, 'msm_id': 0,
+            })
+        return results
+
+    def trace_results(self):
+        results = []
+        for i, prb_id in enumerate(self.probe_ids()):
+            if not self.failed[i]:
+                continue
+
+            hops = [
+                {'hop': 1, 'result': [{'from': '192.168.1.1', 'rtt': 0.5, 'ttl': 64}]},
+                {'hop': 2, 'result': [{'from': _ip(prb_id + 1000000), 'rtt': 3.2, 'ttl': 63}]},
+            ]
+            # transit routers are shared between the traces
+            transit = self.random.randint(0, TRANSIT_ROUTERS, TRACE_HOPS - 5)
+            for hop_num, router in enumerate(transit, 3):
+                reply = {'from': _ip(router + 2000000), 'rtt': 3.0 + hop_num * 2.5, 'ttl': 60}
+                hops.append({'hop': hop_num, 'result': [reply] * 3})
+            for hop_num in range(len(hops) + 1, TRACE_HOPS):
+                hops.append({'hop': hop_num, 'result': [{'x': '*'}] * 3})
+            hops.append({'hop': 255, 'result': [{'x': '*'}] * 3})
+
+            results.append({
+                'af': 4, 'prb_id': prb_id, 'type': 'traceroute', 'proto': 'ICMP',
+                'from': _ip(prb_id), 'src_addr': '192.168.1.2',
+                'dst_name': TARGET, 'dst_addr': '198.51.100.1',
+                'result': hops, 'timestamp': 1524000000 + i % 600, 'msm_id': 0,
+            })
+        return results
+
+
+def _register_measurements(measurement_type, results):
+    # a measurement per MAX_PROBES results, as the scheduler makes them
+    response = []
+    for start in range(0, len(results), MAX_PROBES):
+        msm_id = atlas_mock._measurement_id
+        atlas_mock._measurement_id += 1
+        atlas_mock._measurements[msm_id] = measurement_type
+        atlas_mock.synthetic_results[msm_id] = results[start:start + MAX_PROBES]
+        response.append(msm_id)
+    return response
+
+
+def _gethostbyaddr(addr):
+    return 'host-%s.example.net' % addr.replace('.', '-'), None, None
+
+
+class Pipeline(object):
+    # every stage is a method, taking its input from the previous stages
+
+    def __init__(self, load, output_dir, density=GRID_DENSITY, workers=1):
+        self.load = load
+        self.output_dir = output_dir
+        self.density = density
+        self.workers = workers
+
+        atlas_mock.synthetic_data['probes'] = load.probes()
+        self.ping_response = _register_measurements('ping', load.ping_results())
+        self.trace_response = _register_measurements('trace', load.trace_results())
+
+        self.probes_data = form_probes({})
+        self.ping_data = Atlas(None).request_results(self.ping_response, None)
+        self.trace_data = Atlas(None).request_results(self.trace_response, None)
+        self.pings = self.stage_ping_flush_results()
+        self.traces = self.stage_trace_flush_results()
+
+    def stage_form_probes(self):
+        return form_probes({'status_name': 'Connected', 'tags': 'system-ipv4-works'})
+
+    def stage_request_results(self):
+        return Atlas(None).request_results(self.ping_response, None)
+
+    def stage_ping_flush_results(self):
+        pings = PingMeasure(TARGET, None, probes_data=self.probes_data)
+        pings.add_results(list(self.ping_data))
+        return pings
+
+    def stage_trace_flush_results(self):
+        failed_probes = dict(
+            (prb_id, self.probes_data[prb_id]) for prb_id in self.pings.failed_probes
+        )
+        traces = TraceMeasure(TARGET, None, probes_data=failed_probes)
+        traces.response = self.trace_response
+        traces.add_results(list(self.trace_data))
+        return traces
+
+    def stage_make_grid(self):
+        return _make_grid(self.pings.results, self.density, workers=self.workers)
+
+    def stage_interpolate_grid(self):
+        return interpolate(self.pings.results, self.density, workers=self.workers)
+
+    def stage_handle_data(self):
+        return country_latencies(self.pings.results)
+
+    def stage_make_map(self):
+        make_map(self.pings.results, os.path.join(self.output_dir, 'dnsmap.html'))
+
+    def stage_log_traces(self):
+        _log_traces(
+            self.traces, self.pings.failed_probes,
+            os.path.join(self.output_dir, 'reachability.dat'),
+            ptr_cache=PtrCache()
+        )
+
+
+def _run_stage(stage, repeat):
+    # best wall time of `repeat` runs, then the peak of traced memory in one more run
+    seconds = None
+    for _ in range(repeat):
+        started = time.time()
+        stage()
+        elapsed = time.time() - started
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    peak_bytes = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            stage()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return seconds, peak_bytes
+
+
+def run_benchmarks(probe_numbers=PROBE_NUMBERS, stages=STAGES, repeat=1, log=None,
+                   density=GRID_DENSITY, workers=1):
+    patchers = [patch(*patch_spec) for patch_spec in atlas_mock.PATCHES]
+    patchers.append(patch('socket.gethostbyaddr', _gethostbyaddr))
+    for patcher in patchers:
+        patcher.start()
+
+    output_dir = tempfile.mkdtemp()
+    records = []
+    try:
+        for probe_number in probe_numbers:
+            pipeline = Pipeline(SyntheticLoad(probe_number), output_dir, density, workers)
+            for stage_name in stages:
+                record = {'stage': stage_name, 'probes': probe_number}
+                try:
+                    record['seconds'], record['peak_bytes'] = _run_stage(
+                        getattr(pipeline, 'stage_' + stage_name), repeat
+                    )
+                except Exception as e:
+                    record['error'] = '%s: %s' % (type(e).__name__, e)
+
+                records.append(record)
+                if log is not None:
+                    log(_format_record(record))
+    finally:
+        for patcher in reversed(patchers):
+            patcher.stop()
+        atlas_mock.synthetic_data.clear()
+        atlas_mock.synthetic_results.clear()
+        shutil.rmtree(output_dir)
+
+    return records
+
+
+def run_end_to_end(probe_numbers=PROBE_NUMBERS, latency=LATENCY, time_scale=TIME_SCALE,
+                   log=None):
+    # ping_measure over HTTP, from the probe listing to the parsed results
+    from tests.atlas_server import AtlasServer
+
+    patchers = [
+        patch.object(ripe_atlas, name, getattr(ripe_atlas, name) * time_scale)
+        for name in ('POLL_INTERVAL', 'MIN_POLL_INTERVAL', 'MAX_POLL_INTERVAL', 'REPORT_DELAY')
+    ]
+    patchers.append(patch.object(scheduler, 'CREATE_BACKOFF', scheduler.CREATE_BACKOFF * time_scale))
+    for patcher in patchers:
+        patcher.start()
+
+    records = []
+    try:
+        for probe_number in probe_numbers:
+            record = {'stage': 'end_to_end', 'probes': probe_number, 'peak_bytes': None}
+            server = AtlasServer(SyntheticLoad(probe_number), latency=latency, time_scale=time_scale)
+            use_server(server.url)
+            session.configure()
+            try:
+                with server:
+                    started = time.time()
+                    ping_measure('benchmark', TARGET)
+                    record['seconds'] = time.time() - started
+                record.update(session.counters())
+            except Exception as e:
+                record['error'] = '%s: %s' % (type(e).__name__, e)
+            finally:
+                use_server(None)
+
+            records.append(record)
+            if log is not None:
+                log(_format_record(record))
+    finally:
+        for patcher in reversed(patchers):
+            patcher.stop()
+
+    return records
+
+
+def _format_record(record, baseline=None):
+    line = '%-20s %7d' % (record['stage'], record['probes'])
+    if 'error' in record:
+        return '%s  failed: %s' % (line, record['error'])
+
+    line += ' %9.3f s' % record['seconds']
+    if record['peak_bytes'] is not None:
+        line += ' %9.1f MB' % (record['peak_bytes'] / 1e6)
+    if 'requests' in record:
+        line += ' %6d requests %6d connections %9.1f MB received' % (
+            record['requests'], record['connections'], record['bytes'] / 1e6
+        )
+
+    if baseline is not None and baseline.get('seconds'):
+        ratio = record['seconds'] / baseline['seconds']
+        line += '  x%.2f of %.3f s' % (ratio, baseline['seconds'])
+        if ratio > REGRESSION_RATIO:
+            line += '  REGRESSION'
+
+    return line
+
+
+def _git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'])
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision.decode().strip() + ('-dirty' if dirty else '')
+
+
+def compare(records, baseline_records):
+    baseline = dict(
+        ((record['stage'], record['probes']), record) for record in baseline_records
+    )
+    return [
+        _format_record(record, baseline.get((record['stage'], record['probes'])))
+        for record in records
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark the pipeline stages on synthetic Atlas data'
+    )
+    parser.add_argument(
+        '-n', '--probe-numbers',
+        type=int,
+        nargs='+',
+        default=PROBE_NUMBERS,
+        metavar='N',
+        help='synthetic probe populations (default: %s)' % ' '.join(map(str, PROBE_NUMBERS))
+    )
+    parser.add_argument(
+        '-s', '--stages',
+        nargs='+',
+        choices=STAGES,
+        default=STAGES,
+        metavar='STAGE',
+        help='stages to run: %s (default: all)' % ', '.join(STAGES)
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int,
+        default=1,
+        help='runs of every stage, the best time is kept (default: 1)'
+    )
+    parser.add_argument(
+        '-d', '--density',
+        type=int,
+        default=GRID_DENSITY,
+        help='grid cells per degree of the grid stages (default: %d)' % GRID_DENSITY
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help='processes of the grid stages (default: 1)'
+    )
+    parser.add_argument(
+        '-e', '--end-to-end',
+        action='store_true',
+        help='also run the real client against the local Atlas API stand-in'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=LATENCY,
+        metavar='SECONDS',
+        help='response delay of the stand-in, with --end-to-end (default: %s)' % LATENCY
+    )
+    parser.add_argument(
+        '--time-scale',
+        type=float,
+        default=TIME_SCALE,
+        help='speed up of the measurements and the polling, with --end-to-end '
+             '(default: %s)' % TIME_SCALE
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help="JSON file of the results (default: '%s/<git revision>.json')" % RESULTS_DIR
+    )
+    parser.add_argument(
+        '-c', '--compare',
+        metavar='FILE',
+        help='results of an earlier run to compare with'
+    )
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+
+    revision = _git_revision()
+    log = None if baseline is not None else print
+    records = run_benchmarks(
+        args.probe_numbers, args.stages, args.repeat, log=log,
+        density=args.density, workers=args.workers
+    )
+    if args.end_to_end:
+        records.extend(run_end_to_end(
+            args.probe_numbers, latency=args.latency, time_scale=args.time_scale, log=log
+        ))
+    if baseline is not None:
+        print('compared with %s' % (baseline.get('revision') or args.compare))
+        for line in compare(records, baseline['records']):
+            print(line)
+
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, '%s.json' % (revision or int(time.time())))
+
+    with open(output, 'w') as fd:
+        json.dump({
+            'revision': revision,
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'records': records,
+        }, fd, indent=1, sort_keys=True)
+
+    print('results are saved to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
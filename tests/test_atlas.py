@@ -1,15 +1,37 @@
+from collections import defaultdict
+import json
 import os.path
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
-from mock import patch
+from mock import Mock, patch
+import requests
+from ripe.atlas.cousteau.request import AtlasRequest
 
-from atlas_tools.measurement import form_probes
+from atlas_tools import profiling
+from atlas_tools.batch import measure_targets, read_targets, render_outputs
+from atlas_tools.cache import AtlasCache
+from atlas_tools.countries import load_countries, DETAIL_LEVELS
+from atlas_tools.grid import LatencyGrid
+from atlas_tools.measurement import form_probes, list_probes, PingMeasure, TraceMeasure
+from atlas_tools.monitor import create_ongoing, Monitor, MAX_SILENT_ROUNDS
+from atlas_tools.reverse_dns import PtrCache, resolve_ptrs
+from atlas_tools.ripe_atlas import Atlas, AtlasResultLinesRequest, Completion, \
+    DownloadCancelled, STOPPED, TIMED_OUT
+from atlas_tools.scheduler import MeasurementScheduler, plan_chunks
 from atlas_tools.latency_countrymap import create_countrymap
-from atlas_tools.latency_heatmap import init_renderer, create_heatmap
-from atlas_tools.dns_map import create_map
+from atlas_tools.latency_heatmap import init_renderer, create_heatmap, _load_grid
+from atlas_tools.dns_map import create_map, _group_resolves, _resolve_features
+from atlas_tools.results import PingResults, PathTrie
 from atlas_tools.reachability import test_reachability
+from atlas_tools.sampling import AdaptiveSampling
 
-from tests.atlas_mock import patch_atlas, atlas_data_types
+from tests.atlas_mock import patch_atlas, atlas_data_types, atlas_status, atlas_probes, \
+    _json_data, _stopped, synthetic_results
 
 
 def _gethostbyaddr(addr):
@@ -32,6 +54,170 @@ class TestAtlas(unittest.TestCase):
         for probe_id, probe in probes.items():
             self.assertEqual(probe_id, probe['id'])
 
+    def test_probe_catalog(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        requests = []
+
+        def probes(request):
+            requests.append(request)
+            return atlas_probes(request)
+
+        params = {'status_name': 'Connected', 'tags': 'system-ipv4-works', 'country_code': 'nl'}
+        with patch('ripe.atlas.cousteau.ProbeRequest.__iter__', probes):
+            catalog = AtlasCache(cache_dir).probes
+            probes_data = form_probes(params, catalog=catalog)
+            self.assertEqual(len(requests), 1)
+
+            # fresh catalog: no API calls, also after reopening
+            catalog = AtlasCache(cache_dir).probes
+            self.assertEqual(form_probes(params, catalog=catalog), probes_data)
+            self.assertEqual(len(requests), 1)
+
+            catalog.ttl = 0
+            form_probes({'id__in': list(probes_data)[:3]}, catalog=catalog)
+            self.assertEqual(len(requests), 3)
+
+            # probes missing from a fresh catalog are loaded by ID
+            catalog.ttl = 3600
+            missing_id = sorted(probes_data)[0]
+            with catalog.connection:
+                catalog.connection.execute('DELETE FROM probes WHERE id = ?', (missing_id,))
+            with patch('atlas_tools.cache.logger') as logger:
+                selected = form_probes({'id__in': [missing_id, -1]}, catalog=catalog)
+            self.assertEqual(list(selected), [missing_id])
+            self.assertEqual(len(requests), 4)
+            self.assertEqual(logger.warning.call_count, 1)
+
+        expected = [
+            probe['id'] for probe in _json_data('probes')
+            if probe['status']['name'] == 'Connected' and probe['country_code'] == 'NL' and
+            'system-ipv4-works' in [tag['slug'] for tag in probe['tags']]
+        ]
+        self.assertTrue(expected)
+        self.assertEqual(sorted(probes_data), sorted(expected))
+
+        for probe_id, probe in probes_data.items():
+            self.assertEqual(probe_id, probe['id'])
+            self.assertEqual(len(probe['geometry']['coordinates']), 2)
+
+    def test_result_cache(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = AtlasCache(cache_dir)
+
+        pings = PingMeasure(self.TARGET, None, cache=cache)
+        pings.run()
+        for msm_id in pings.response:
+            self.assertIn(msm_id, cache.results)
+
+        def offline(request):
+            raise AssertionError('cached measurement %s is requested' % request.msm_id)
+
+        with patch('atlas_tools.ripe_atlas.AtlasStatusRequest.create', offline), \
+                patch('ripe.atlas.cousteau.request.AtlasResultsRequest.create', offline), \
+                patch('atlas_tools.ripe_atlas.AtlasResultLinesRequest.create', offline):
+            cached = PingMeasure(
+                self.TARGET, None, measurements_list=pings.response, cache=cache
+            )
+            cached.run()
+
+        self.assertEqual(sorted(cached.results), sorted(pings.results))
+
+    def test_resolve_ptrs(self):
+        lookups = []
+
+        def gethostbyaddr(addr):
+            lookups.append(addr)
+            # a stuck lookup must not keep the process alive
+            self.assertTrue(threading.current_thread().daemon)
+            if addr == '10.0.0.2':
+                raise socket.herror(1, 'Unknown host')
+            if addr == '10.0.0.4':
+                raise socket.herror(2, 'Host name lookup failure')
+            if addr == '10.0.0.5':
+                raise socket.gaierror(socket.EAI_AGAIN, 'Temporary failure in name resolution')
+            if addr == '10.0.0.3':
+                time.sleep(0.5)
+            return 'host-' + addr, None, None
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = PtrCache(os.path.join(cache_dir, 'ptr.json'))
+
+        addresses = ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.5', '10.0.0.1']
+        with patch('socket.gethostbyaddr', gethostbyaddr):
+            hostnames = resolve_ptrs(addresses, cache=cache, timeout=0.2)
+            self.assertEqual(hostnames, {'10.0.0.1': 'host-10.0.0.1'})
+            self.assertEqual(sorted(lookups), ['10.0.0.%d' % i for i in range(1, 6)])
+
+            # missing records are cached, temporary failures and timed out
+            # lookups are not
+            cache.save()
+            cache = PtrCache(cache.path)
+            del lookups[:]
+            resolve_ptrs(addresses, cache=cache, timeout=1)
+            self.assertEqual(sorted(lookups), ['10.0.0.3', '10.0.0.4', '10.0.0.5'])
+
+    @patch('atlas_tools.ripe_atlas.POLL_INTERVAL', 0)
+    @patch('atlas_tools.scheduler.CREATE_BACKOFF', 0)
+    def test_scheduler(self):
+        self.assertEqual([len(chunk) for chunk in plan_chunks(range(8250))], [917] * 6 + [916] * 3)
+
+        created = []
+        running = set()
+        stopped = set()
+        max_running = [0]
+        lock = threading.Lock()
+
+        class ThrottledAtlas(Atlas):
+            def create_request(self, measurements, source, is_oneoff=True):
+                with lock:
+                    if not created:
+                        created.append(None)
+                        return False, {'error': {'status': 429, 'detail': 'Too many requests'}}
+
+                    msm_id = len(created)
+                    created.append(measurements[0])
+                    running.add(msm_id)
+                    max_running[0] = max(max_running[0], len(running))
+                return True, {'measurements': [msm_id]}
+
+            def measurement_status(self, msm_id, timeout):
+                if msm_id not in stopped:
+                    return TIMED_OUT
+                running.discard(msm_id)
+                return STOPPED
+
+            def stop_measurement(self, msm_id):
+                stopped.add(msm_id)
+
+        scheduler = MeasurementScheduler(ThrottledAtlas(None))
+        scheduler.add(Atlas(None).create_ping(self.TARGET), range(30000))
+        scheduler.add(Atlas(None).create_ping('example.org'), range(5000))
+        jobs = scheduler.run()
+
+        self.assertEqual(len(jobs), 35)
+        self.assertEqual(sorted(msm_id for job in jobs for msm_id in job.measurements), list(range(1, 36)))
+        self.assertLessEqual(max_running[0], 30)
+        self.assertTrue(stopped)
+        for measurement in created[1:]:
+            self.assertEqual(measurement.spread, 20)
+
+    def test_countries(self):
+        sizes = {}
+        for detail in DETAIL_LEVELS:
+            countries = load_countries(detail)
+            self.assertEqual(countries['type'], 'FeatureCollection')
+            self.assertIn('RU', [feature['properties']['iso_a2'] for feature in countries['features']])
+            sizes[detail] = len(str(countries))
+
+        self.assertLess(sizes['low'], sizes['medium'])
+        self.assertLess(sizes['medium'], sizes['full'])
+
     def test_countrymap(self):
         atlas_data_types['ping'] = 'ping_results'
 
@@ -52,6 +238,119 @@ class TestAtlas(unittest.TestCase):
         if self.DELETE_FILES:
             os.unlink(fname)
 
+    def test_heatmap_grid(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        tmp_dir = tempfile.mkdtemp()
+        fname = os.path.join(tmp_dir, 'heatmap.test.png')
+        grid_file = os.path.join(tmp_dir, 'heatmap.grid')
+        try:
+            create_heatmap(fname, None, self.TARGET, density=2, backend='raster', grid_file=grid_file)
+            counts = LatencyGrid.load(grid_file).counts.sum()
+            self.assertGreater(counts, 0)
+            self.assertIsNotNone(LatencyGrid.load(grid_file).minimums)
+            self.assertIsNone(_load_grid(None, 2).minimums)
+
+            # the second run adds to the first one
+            create_heatmap(fname, None, self.TARGET, density=2, backend='raster', grid_file=grid_file)
+            self.assertEqual(LatencyGrid.load(grid_file).counts.sum(), 2 * counts)
+            self.assertTrue(os.path.exists(fname))
+
+            with self.assertRaises(ValueError):
+                create_heatmap(fname, None, self.TARGET, density=3, grid_file=grid_file)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_heatmap_interpolation(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        tmp_dir = tempfile.mkdtemp()
+        fname = os.path.join(tmp_dir, 'heatmap.test.png')
+        try:
+            create_heatmap(fname, None, self.TARGET, density=2, backend='raster', interpolation='idw')
+            self.assertTrue(os.path.exists(fname))
+
+            with self.assertRaises(ValueError):
+                create_heatmap(
+                    fname, None, self.TARGET, interpolation='nearest',
+                    grid_file=os.path.join(tmp_dir, 'heatmap.grid')
+                )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_batch(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+
+        targets = read_targets([self.TARGET, 'example.net', self.TARGET])
+        self.assertEqual(targets, [self.TARGET, 'example.net'])
+
+        measures = measure_targets(targets, None)
+        self.assertIs(measures[0].probes_data, measures[1].probes_data)
+        self.assertFalse(set(measures[0].response) & set(measures[1].response))
+        for measure in measures:
+            self.assertGreater(len(measure.results), 0)
+
+        rendered = render_outputs(
+            measures, ['heatmap'], output_dir=output_dir, workers=2,
+            density=2, backend='raster', basemap_dir=None
+        )
+        self.assertEqual(len(rendered), 2)
+        for fname in rendered:
+            self.assertTrue(os.path.exists(fname))
+
+    def test_monitor(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        heatmap = os.path.join(tmp_dir, 'heatmap.png')
+
+        probes_data = list_probes()
+        measurements = create_ongoing(Atlas(None), self.TARGET, probes_data, interval=60)
+        self.assertEqual(len(measurements), 1)
+
+        results = _json_data('ping_results')
+        now = max(item['timestamp'] for item in results)
+        monitor = Monitor(self.TARGET, measurements, probes_data, heatmap=heatmap,
+                          density=2, backend='raster', interval=60, since=0)
+
+        self.assertTrue(monitor.cycle(now=now))
+        self.assertTrue(os.path.exists(heatmap))
+        aggregates = monitor.aggregates
+        probes = len(aggregates.latest)
+        counts = aggregates.grid.counts.sum()
+        self.assertGreater(probes, 0)
+
+        # nothing new
+        self.assertFalse(monitor.cycle(now=now))
+
+        # newer results replace the old ones, small changes are not drawn
+        def next_round(delay, added_rtt):
+            synthetic_results[measurements[0]] = [
+                dict(item, timestamp=item['timestamp'] + delay,
+                     min=item['min'] + added_rtt if item['min'] != -1 else -1)
+                for item in results
+            ]
+
+        next_round(60, 1.0)
+        self.assertFalse(monitor.cycle(now=now + 60))
+        next_round(120, 40.0)
+        self.assertTrue(monitor.cycle(now=now + 120))
+        self.assertEqual(len(aggregates.latest), probes)
+        self.assertEqual(aggregates.grid.counts.sum(), counts)
+        self.assertEqual(
+            sum(aggregates.country_counts.values()), probes
+        )
+
+        # silent probes are dropped
+        monitor.cycle(now=now + 120 + MAX_SILENT_ROUNDS * 60 + 1)
+        self.assertEqual(len(aggregates.latest), 0)
+        self.assertEqual(aggregates.grid.counts.sum(), 0)
+        del synthetic_results[measurements[0]]
+
     def test_dnsmap(self):
         atlas_data_types['ping'] = 'ping_results'
 
@@ -62,6 +361,25 @@ class TestAtlas(unittest.TestCase):
         if self.DELETE_FILES:
             os.unlink(fname)
 
+    def test_dns_layers(self):
+        ping_results = PingResults()
+        dst_ips = ['10.0.0.2', '10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.2', '10.0.0.1']
+        for prb_id, dst_ip in enumerate(dst_ips):
+            ping_results.append(prb_id, '192.0.2.1', dst_ip, None, 'NL', prb_id, -prb_id, 10.0)
+
+        groups = _group_resolves(ping_results)
+        self.assertEqual(
+            [(dst_ip, rows.tolist()) for dst_ip, rows in groups],
+            [('10.0.0.2', [0, 2, 4]), ('10.0.0.1', [1, 5]), ('10.0.0.3', [3])]
+        )
+
+        features = _resolve_features(ping_results, *groups[1])['features']
+        self.assertEqual([f['properties'] for f in features], [
+            {'probe_id': 1, 'dst_ip': '10.0.0.1'},
+            {'probe_id': 5, 'dst_ip': '10.0.0.1'},
+        ])
+        self.assertEqual(features[1]['geometry']['coordinates'], [-5.0, 5.0])
+
     def test_reachability(self):
         atlas_data_types['ping'] = 'ping_fail_results'
 
@@ -71,3 +389,375 @@ class TestAtlas(unittest.TestCase):
         self.assertTrue(os.path.exists(fname))
         if self.DELETE_FILES:
             os.unlink(fname)
+
+    def test_reachability_adaptive(self):
+        atlas_data_types['ping'] = 'ping_fail_results'
+
+        fname = 'reachability.adaptive.test.dat'
+        test_reachability(fname, None, self.TARGET, 'ICMP',
+                          sampling=AdaptiveSampling(sample_size=1, traces_per_asn=1))
+
+        self.assertTrue(os.path.exists(fname))
+        if self.DELETE_FILES:
+            os.unlink(fname)
+
+    @patch('atlas_tools.ripe_atlas.MAX_POLL_INTERVAL', 0)
+    def test_request_results(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        atlas = Atlas(None)
+        response = []
+        for _ in range(3):
+            _, resp = atlas.create_request(
+                [atlas.create_ping(self.TARGET)],
+                atlas.create_source('probes', '1', 1)
+            )
+            response.extend(resp['measurements'])
+
+        # measurements stop after a different number of polls each; the first
+        # polls of all of them must meet, which is impossible one by one
+        polls = defaultdict(int)
+        first_polls = threading.Barrier(len(response), timeout=5)
+
+        def status(request):
+            is_success, results = atlas_status(request)
+            polls[request.msm_id] += 1
+            if polls[request.msm_id] == 1:
+                first_polls.wait()
+            if polls[request.msm_id] < 5 - response.index(request.msm_id):
+                results = dict(results, status={'name': 'Ongoing'})
+            return is_success, results
+
+        with patch('atlas_tools.ripe_atlas.AtlasStatusRequest.create', status):
+            msm_data = atlas.request_results(response, timeout=None)
+
+        self.assertFalse(first_polls.broken)
+        self.assertEqual(len(msm_data), 3 * len(_json_data('ping_results')))
+
+    @patch('atlas_tools.ripe_atlas.MAX_POLL_INTERVAL', 0)
+    def test_early_completion(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = AtlasCache(cache_dir)
+
+        # 10 more probes report on every status check, up to 99
+        polls = defaultdict(int)
+
+        def status(request):
+            is_success, results = atlas_status(request)
+            polls[request.msm_id] += 1
+            results = dict(results, status={'name': 'Ongoing'}, start_time=time.time())
+            return is_success, results
+
+        def latest(request):
+            reported = min(10 * polls[request.msm_id], 99)
+            return True, [{'prb_id': prb_id} for prb_id in range(reported)]
+
+        with patch('atlas_tools.ripe_atlas.AtlasStatusRequest.create', status), \
+                patch('ripe.atlas.cousteau.request.AtlasLatestRequest.create', latest):
+            pings = PingMeasure(
+                self.TARGET, 'key', cache=cache, timeout=60,
+                completion=Completion(min_reported=0.9)
+            )
+            pings.run()
+
+        msm_id, = pings.response
+        self.assertEqual(polls[msm_id], 9)
+        self.assertIn(msm_id, _stopped)
+        self.assertNotIn(msm_id, cache.results)
+        self.assertTrue(len(pings.results))
+
+    @patch('atlas_tools.ripe_atlas.MIN_POLL_INTERVAL', 0)
+    @patch('atlas_tools.ripe_atlas.MAX_POLL_INTERVAL', 0)
+    def test_stream(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        pings = PingMeasure(self.TARGET, None)
+        pings.run()
+
+        # the mocked results API ignores `start`, so every poll returns
+        # all results and only the first one must be yielded
+        polls = defaultdict(int)
+
+        def status(request):
+            is_success, results = atlas_status(request)
+            polls[request.msm_id] += 1
+            if polls[request.msm_id] < 3:
+                results = dict(results, status={'name': 'Ongoing'})
+            return is_success, results
+
+        streaming = PingMeasure(self.TARGET, None, probes_data=pings.probes_data)
+        with patch('atlas_tools.ripe_atlas.AtlasStatusRequest.create', status):
+            batches = list(streaming.run(stream=True))
+
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(sorted(batches[0]), sorted(pings.results))
+
+    @patch('atlas_tools.ripe_atlas.MIN_POLL_INTERVAL', 0)
+    @patch('atlas_tools.ripe_atlas.MAX_POLL_INTERVAL', 0)
+    def test_stream_completion(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        # never stops on its own, the probes of the first batch are enough
+        polls = defaultdict(int)
+
+        def status(request):
+            is_success, results = atlas_status(request)
+            polls[request.msm_id] += 1
+            return is_success, dict(results, status={'name': 'Ongoing'}, start_time=time.time())
+
+        streaming = PingMeasure(self.TARGET, 'key', completion=Completion(min_reported=0.5))
+        with patch('atlas_tools.ripe_atlas.AtlasStatusRequest.create', status):
+            batches = list(streaming.run(stream=True))
+
+        msm_id, = streaming.response
+        self.assertEqual(polls[msm_id], 2)
+        self.assertIn(msm_id, _stopped)
+        self.assertEqual(len(batches), 1)
+
+    def test_profiling(self):
+        atlas_data_types['ping'] = 'ping_results'
+
+        tmp_dir = tempfile.mkdtemp()
+        fname = os.path.join(tmp_dir, 'profile.jsonl')
+        profiling.enable(fname)
+        try:
+            pings = PingMeasure(self.TARGET, None)
+            pings.run()
+        finally:
+            profiling.disable()
+            with open(fname) as fd:
+                spans = [json.loads(line) for line in fd]
+            shutil.rmtree(tmp_dir)
+
+        names = [record['span'] for record in spans]
+        for name in ('list_probes', 'form_probes', 'create_measurements', 'wait_measurement',
+                     'fetch_results', 'request_results', 'parse_results'):
+            self.assertIn(name, names)
+
+        parse = spans[names.index('parse_results')]
+        self.assertEqual(parse['items'], len(pings.results))
+        self.assertGreaterEqual(parse['end'], parse['start'])
+        self.assertEqual(profiling.span('disabled'), profiling.NULL_SPAN)
+
+
+class TestProfiling(unittest.TestCase):
+    def test_http_counters(self):
+        response = Mock(ok=True, content=b'{"id": 1}')
+        response.json.return_value = {'id': 1}
+
+        tmp_dir = tempfile.mkdtemp()
+        fname = os.path.join(tmp_dir, 'profile.jsonl')
+        profiling.enable(fname)
+        try:
+            with patch.dict(AtlasRequest.http_methods, {'GET': Mock(return_value=response)}):
+                with profiling.span('requests'):
+                    for _ in range(3):
+                        AtlasRequest(url_path='/api/v2/probes/1/').get()
+        finally:
+            profiling.disable()
+            with open(fname) as fd:
+                record = json.loads(fd.readline())
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(record['span'], 'requests')
+        self.assertEqual(record['api_calls'], 3)
+        self.assertEqual(record['bytes'], 3 * len(response.content))
+
+
+class TestResultLines(unittest.TestCase):
+    RESULTS = [{'prb_id': prb_id, 'min': 10.0 + prb_id} for prb_id in range(5)]
+
+    def _response(self, results, broken_after=None):
+        lines = [json.dumps(item).encode() for item in results]
+
+        def iter_lines():
+            for i, line in enumerate(lines):
+                if i == broken_after:
+                    raise requests.exceptions.ChunkedEncodingError('connection broken')
+                yield line
+                yield b''
+
+        response = Mock(ok=True)
+        response.iter_lines = iter_lines
+        return response
+
+    def test_parse_lines(self):
+        get = Mock(return_value=self._response(self.RESULTS))
+        with patch.dict(AtlasRequest.http_methods, {'GET': get}):
+            is_success, results = AtlasResultLinesRequest(msm_id=1).create()
+            self.assertTrue(is_success)
+            self.assertEqual(list(results), self.RESULTS)
+
+        _, kwargs = get.call_args
+        self.assertEqual(kwargs['params']['format'], 'txt')
+        self.assertTrue(kwargs['stream'])
+
+    @patch('atlas_tools.ripe_atlas.POLL_INTERVAL', 0)
+    def test_broken_download(self):
+        responses = [self._response(self.RESULTS, broken_after=2), self._response(self.RESULTS)]
+        with patch.dict(AtlasRequest.http_methods, {'GET': Mock(side_effect=responses)}):
+            results = list(Atlas._download_results(1, threading.Event()))
+
+        self.assertEqual(results, self.RESULTS)
+
+    @patch('atlas_tools.ripe_atlas.POLL_INTERVAL', 0)
+    def test_cancelled_fetch(self):
+        cancelled = threading.Event()
+
+        def failed(request):
+            cancelled.set()
+            return False, 'Service Unavailable'
+
+        with patch('ripe.atlas.cousteau.request.AtlasResultsRequest.create', failed):
+            self.assertIsNone(Atlas.fetch_results(1, cancelled=cancelled))
+
+    def test_partial_results_not_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = AtlasCache(cache_dir)
+
+        results = cache.results.store_iter(1, iter(self.RESULTS))
+        next(results)
+        results.close()
+        self.assertNotIn(1, cache.results)
+        self.assertEqual(os.listdir(cache.results.path), [])
+
+        cache.results.store(1, self.RESULTS)
+        self.assertEqual(cache.results.load(1), self.RESULTS)
+
+    @patch('atlas_tools.ripe_atlas.POLL_INTERVAL', 0)
+    def test_cancelled_download_not_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        atlas = Atlas(None, cache=AtlasCache(cache_dir))
+
+        class CancelledOnRetry(threading.Event):
+            def wait(self, timeout=None):
+                self.set()
+                return True
+
+        responses = [self._response(self.RESULTS, broken_after=2), self._response(self.RESULTS)]
+        with patch.dict(AtlasRequest.http_methods, {'GET': Mock(side_effect=responses)}), \
+                patch.object(atlas, '_wait_measurement', Mock(return_value=STOPPED)):
+            results = atlas._measurement_results(1, None, CancelledOnRetry())
+            with self.assertRaises(DownloadCancelled):
+                list(results)
+
+        self.assertNotIn(1, atlas.cache.results)
+        self.assertEqual(os.listdir(atlas.cache.results.path), [])
+
+    def test_buffer(self):
+        atlas = Atlas(None)
+        read = []
+
+        def measurement_results(measurement_num, timeout, cancelled):
+            for item in self.RESULTS:
+                read.append(item)
+                yield dict(item, msm_id=measurement_num)
+
+        with patch.object(atlas, '_measurement_results', measurement_results):
+            results = atlas.iter_results([1, 2], None, buffer_size=1)
+            first = next(results)
+            time.sleep(0.2)
+            # the workers wait for the results to be read
+            self.assertLessEqual(len(read), 4)
+
+            rest = list(results)
+
+        self.assertEqual(len(rest) + 1, 2 * len(self.RESULTS))
+        self.assertIn(first, [dict(item, msm_id=1) for item in self.RESULTS] +
+                      [dict(item, msm_id=2) for item in self.RESULTS])
+
+
+class TestTraceResults(unittest.TestCase):
+    TARGET = '198.51.100.1'
+
+    def _trace(self, prb_id, hops, reached=False):
+        result = [
+            {'hop': hop_num, 'result': replies}
+            for hop_num, replies in enumerate(hops, 1)
+        ]
+        if reached:
+            result.append({'hop': len(hops) + 1, 'result': [{'from': self.TARGET, 'rtt': 20.0}]})
+        return {'prb_id': prb_id, 'from': '192.0.2.%d' % prb_id, 'dst_addr': self.TARGET,
+                'result': result}
+
+    def test_parse(self):
+        gateway = [{'from': '10.0.0.1', 'rtt': 1.0}, {'from': '10.0.0.1', 'rtt': 3.0}]
+        balanced = [{'from': '10.0.1.1', 'rtt': 5.0}, {'x': '*'}, {'from': '10.0.1.2', 'rtt': 7.0},
+                    {'from': '10.0.9.9', 'late': 1}]
+        traces = TraceMeasure(self.TARGET, None, probes_data={})
+        traces.msm_data = [
+            self._trace(1, [gateway, balanced, [{'x': '*'}] * 3]),
+            self._trace(2, [gateway, balanced], reached=True),
+            self._trace(3, [gateway, [{'x': '*'}]]),
+        ]
+        traces.msm_data[2]['result'].append({'hop': 3, 'error': 'network unreachable'})
+        traces._flush_results()
+
+        results = traces.results
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results['reached'].tolist(), [False, True, False])
+
+        prb_id, src_ip, dst_ip, reached, hops = list(results)[0]
+        self.assertEqual((prb_id, src_ip, dst_ip, reached), (1, '192.0.2.1', self.TARGET, False))
+        self.assertEqual(hops, [
+            (1, ['10.0.0.1'], 2, 2, 1.0, 2.0, None),
+            (2, ['10.0.1.1', '10.0.1.2'], 3, 2, 5.0, 6.0, None),
+            (3, [], 3, 0, None, None, None),
+        ])
+        self.assertEqual(list(results)[2][4][-1], (3, [], 0, 0, None, None, 'network unreachable'))
+        self.assertEqual(results.loss()[:3].tolist(), [0.0, 1 / 3.0, 1.0])
+
+        # the first two hops are shared by all the traces
+        paths = [results.paths.path(node) for node in results['path'].tolist()]
+        self.assertEqual(paths[0][:2], paths[1][:2])
+        self.assertEqual(paths[0][:1], paths[2][:1])
+        self.assertEqual(len(results.paths), 6)
+        self.assertEqual(PathTrie.ROOT, results.paths['parent'][paths[0][0]])
+
+        # the trie index is rebuilt for the next results
+        traces.msm_data = [self._trace(4, [gateway, balanced])]
+        traces._flush_results()
+        self.assertEqual(len(results.paths), 6)
+        self.assertEqual(results.paths.path(results['path'][3]), paths[1][:2])
+
+
+class TestSampling(unittest.TestCase):
+    def _probes(self):
+        probes = {}
+        for probe_id in range(24):
+            country, asn = [('NL', 1), ('NL', 2), ('DE', 3)][probe_id % 3]
+            probes[probe_id] = {'id': probe_id, 'country_code': country, 'asn_v4': asn}
+        return probes
+
+    def test_two_phases(self):
+        probes_data = self._probes()
+        sampling = AdaptiveSampling(sample_size=2, failure_threshold=0.5, traces_per_asn=3)
+
+        sample = sampling.sample(probes_data)
+        self.assertEqual(len(sample), 6)
+        self.assertEqual(sample, sampling.sample(probes_data))
+
+        # the sampled NL probes of ASN 1 fail, DE works
+        pings = Mock(failed_probes={}, results=PingResults())
+        for probe_id, probe in sample.items():
+            if probe['asn_v4'] == 1:
+                pings.failed_probes[probe_id] = 'NL'
+            else:
+                pings.results.append(probe_id, '192.0.2.1', '198.51.100.1', probe['asn_v4'],
+                                     probe['country_code'], 0.0, 0.0, 10.0)
+
+        self.assertEqual(sampling.failure_rates(pings), {'NL': 0.5, 'DE': 0.0})
+        self.assertEqual(sampling.failing_countries(pings), ['NL'])
+
+        expansion = sampling.expansion(probes_data, ['NL'], sample)
+        self.assertEqual(len(expansion), 16 - 4)
+        self.assertFalse(set(expansion) & set(sample))
+
+        failed = [probe_id for probe_id in probes_data if probe_id % 3 != 2]
+        traced = sampling.trace_probes(failed, probes_data)
+        self.assertEqual(sorted(probe['asn_v4'] for probe in traced.values()), [1, 1, 1, 2, 2, 2])
@@ -0,0 +1,92 @@
+import unittest
+
+from mock import patch
+
+from atlas_tools import session
+from atlas_tools.measurement import list_probes, ping_measure
+from atlas_tools.ripe_atlas import Completion, use_server
+
+from tests.atlas_server import AtlasServer
+from tests.benchmark import SyntheticLoad
+
+TARGET = 'example.com'
+KEY = 'test-key'
+
+
+@patch('atlas_tools.ripe_atlas.POLL_INTERVAL', 0.05)
+@patch('atlas_tools.ripe_atlas.MIN_POLL_INTERVAL', 0.05)
+@patch('atlas_tools.ripe_atlas.MAX_POLL_INTERVAL', 0.2)
+@patch('atlas_tools.ripe_atlas.REPORT_DELAY', 0)
+@patch('atlas_tools.scheduler.CREATE_BACKOFF', 0.05)
+class TestAtlasServer(unittest.TestCase):
+    # the real client against the local stand-in of the Atlas API
+
+    def _serve(self, load, **options):
+        server = AtlasServer(load, **options).start()
+        self.addCleanup(server.stop)
+        use_server(server.url)
+        self.addCleanup(use_server, None)
+        session.configure()
+        return server
+
+    def test_probes(self):
+        load = SyntheticLoad(700)
+        server = self._serve(load)
+
+        probes_data = list_probes(country='DE')
+        expected = [
+            prb_id for prb_id, country in zip(load.probe_ids(), load.countries)
+            if country == 'DE'
+        ]
+        self.assertEqual(sorted(probes_data), expected)
+        self.assertEqual(server.requests['probes'], (len(expected) + 99) // 100)
+
+        self.assertEqual(len(list_probes(probe_limit=150)), 150)
+
+    def test_ping_measure(self):
+        load = SyntheticLoad(1500)
+        server = self._serve(
+            load, latency=0.005, time_scale=0.02,
+            throttle_rate=0.1, failure_rate=0.1, broken_stream_rate=0.3
+        )
+
+        pings = ping_measure(KEY, TARGET)
+
+        self.assertEqual(len(pings.response), 2)
+        self.assertEqual(len(pings.results) + len(pings.failed_probes), 1500)
+        self.assertEqual(len(pings.failed_probes), load.failed.sum())
+        self.assertGreater(server.responses[429] + server.responses[503], 0)
+        self.assertEqual(server.requests['stop'], 0)
+
+        counters = session.counters()
+        self.assertEqual(counters['requests'], sum(server.requests.values()))
+        self.assertGreater(counters['reused_connections'], counters['connections'])
+
+    def test_session(self):
+        self._serve(SyntheticLoad(1000))
+
+        sizes = []
+        for gzip in (True, False):
+            session.configure(pool_size=2, gzip=gzip)
+            self.assertEqual(len(list_probes()), 1000)
+
+            # the pages are fetched one by one over the same connection
+            counters = session.counters()
+            self.assertEqual(counters['requests'], 10)
+            self.assertEqual(counters['connections'], 1)
+            self.assertEqual(counters['reused_connections'], 9)
+            sizes.append(counters['bytes'])
+
+        self.assertLess(sizes[0], sizes[1] / 2)
+
+    def test_early_completion(self):
+        server = self._serve(SyntheticLoad(500), time_scale=0.2, silent_share=0.2)
+
+        pings = ping_measure(KEY, TARGET, completion=Completion(min_reported=0.3))
+
+        measurement = server.measurements[pings.response[0]]
+        planned_end = measurement.start_time + max(measurement.offsets.values())
+        self.assertEqual(server.requests['stop'], 1)
+        self.assertLess(measurement.stop_time, planned_end)
+        self.assertGreaterEqual(len(pings.results) + len(pings.failed_probes), 150)
+        self.assertLess(len(pings.results) + len(pings.failed_probes), 400)
@@ -0,0 +1,26 @@
+import unittest
+
+from tests.benchmark import run_benchmarks, run_end_to_end, compare, STAGES
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        # folium rendering is covered by test_dnsmap
+        stages = [stage for stage in STAGES if stage != 'make_map']
+        records = run_benchmarks([300], stages)
+
+        self.assertEqual([record['stage'] for record in records], stages)
+        for record in records:
+            self.assertNotIn('error', record)
+            self.assertGreaterEqual(record['seconds'], 0)
+
+        slower = [dict(record, seconds=record['seconds'] * 2 + 1) for record in records]
+        lines = compare(slower, records)
+        self.assertTrue(all(line.endswith('REGRESSION') for line in lines))
+
+    def test_end_to_end(self):
+        records = run_end_to_end([300], latency=0)
+
+        self.assertEqual(len(records), 1)
+        self.assertNotIn('error', records[0])
+        self.assertGreater(records[0]['requests'], 0)
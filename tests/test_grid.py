@@ -0,0 +1,258 @@
+from collections import defaultdict
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from geopy.distance import great_circle
+import numpy as np
+
+from atlas_tools.grid import _make_grid, _great_circle, interpolate, merge_grids, \
+    LatencyGrid, BASE_VALUE, LATITUDE_1_DEGREE, LONGITUDE_EQUATOR_1_DEGREE
+from atlas_tools.raster_heatmap import render_grid, _color_codes, _color_lut, \
+    LUT_SIZE, NO_DATA_COLOR, OCEAN_COLOR
+from atlas_tools.results import PingResults
+
+
+def _reference_grid(ping_results, density, radius=250):
+    # the original per-cell implementation of _make_grid
+    probes_grid = defaultdict(list)
+    for (_, _, _, _, _, center_lat, center_lon, rtt) in ping_results:
+        center_lat_index = int((center_lat + 90) * density)
+        center_lon_index = int((center_lon + 180) * density)
+        lon_radius = int(
+            density * radius /
+            (math.cos(math.radians(center_lat)) * LONGITUDE_EQUATOR_1_DEGREE)
+        )
+        lat_radius = int(radius / LATITUDE_1_DEGREE * density)
+
+        for lon_index in range(center_lon_index - lon_radius, center_lon_index + lon_radius + 1):
+            for lat_index in range(center_lat_index - lat_radius, center_lat_index + lat_radius + 1):
+                lat = float(lat_index) / density - 90
+                lon = float(lon_index) / density - 180
+                if lat > 80 or lat < -80:
+                    continue
+
+                distance = great_circle((center_lat, center_lon), (lat, lon))
+                if distance.kilometers <= radius:
+                    probes_grid[(lat_index, lon_index % (360 * density))].append(rtt)
+
+    final_grid = np.full((180 * density + 1, 360 * density), BASE_VALUE)
+    for (lat_index, lon_index), rtts in probes_grid.items():
+        final_grid[lat_index][lon_index] = max(30, sum(rtts) / len(rtts))
+
+    return final_grid
+
+
+def _reference_interpolation(ping_results, density, method, neighbours, max_distance):
+    # every cell against every probe
+    lat = np.arange(180 * density + 1) / float(density) - 90
+    lon = np.arange(360 * density) / float(density) - 180
+    lat, lon = np.meshgrid(lat, lon, indexing='ij')
+    probes = np.array([row[5:] for row in ping_results])
+
+    distances = _great_circle(
+        lat[..., np.newaxis], lon[..., np.newaxis], probes[:, 0], probes[:, 1]
+    )
+    nearest = np.argsort(distances, axis=-1)[..., :neighbours]
+    distances = np.take_along_axis(distances, nearest, axis=-1)
+    found = distances <= max_distance
+    if method == 'idw':
+        weights = np.where(found, np.maximum(distances, 1.0) ** -2.0, 0)
+    else:
+        weights = found.astype(float)
+
+    total = weights.sum(axis=-1)
+    final_grid = np.full(lat.shape, BASE_VALUE)
+    has_data = (total > 0) & (np.abs(lat) <= 80)
+    means = (weights * probes[nearest, 2]).sum(axis=-1)
+    final_grid[has_data] = np.maximum(30, means[has_data] / total[has_data])
+    return final_grid
+
+
+def _ping_result(lat, lon, rtt):
+    return (1, '10.0.0.1', '10.0.0.2', 1, 'RU', lat, lon, rtt)
+
+
+def _ping_results(rows):
+    ping_results = PingResults()
+    for row in rows:
+        ping_results.append(*row)
+    return ping_results
+
+
+class TestGrid(unittest.TestCase):
+    PING_RESULTS = [
+        _ping_result(55.75, 37.61, 12.5),
+        _ping_result(55.0, 38.0, 70.25),
+        _ping_result(52.38, 4.88, 45.0),
+        _ping_result(78.9, 11.9, 120.0),
+        _ping_result(-79.5, -60.0, 55.0),
+        _ping_result(-33.87, 179.9, 80.0),
+        _ping_result(-33.5, -179.8, 60.0),
+        _ping_result(0.0, 0.0, 10.0),
+    ]
+
+    def test_matches_reference(self):
+        for density in (1, 2, 3):
+            expected = _reference_grid(self.PING_RESULTS, density)
+            actual = _make_grid(_ping_results(self.PING_RESULTS), density)
+
+            self.assertEqual(actual.shape, expected.shape)
+            np.testing.assert_allclose(actual, expected)
+
+    def test_empty(self):
+        grid = _make_grid(PingResults(), 2)
+        self.assertEqual(grid.shape, (361, 720))
+        self.assertTrue((grid == BASE_VALUE).all())
+
+    def test_interpolate(self):
+        ping_results = _ping_results(self.PING_RESULTS)
+        for method in ('idw', 'nearest'):
+            for neighbours, max_distance in ((3, 1000), (1, 5000), (20, 20000)):
+                expected = _reference_interpolation(
+                    self.PING_RESULTS, 2, method, neighbours, max_distance
+                )
+                actual = interpolate(
+                    ping_results, 2,
+                    method=method, neighbours=neighbours, max_distance=max_distance
+                )
+                np.testing.assert_allclose(actual, expected, rtol=1e-6)
+
+        # no limit: cells far from every probe get a value as well
+        grid = interpolate(ping_results, 1, max_distance=None)
+        self.assertTrue((grid[10:171] >= 30).all())
+        self.assertTrue((interpolate(PingResults(), 1) == BASE_VALUE).all())
+
+    def test_ping_results(self):
+        rows = self.PING_RESULTS + [
+            (3, '10.0.0.4', '10.0.0.2', 4200000000, 'NL', 10.0, 20.0, 5.0),
+            (2, '10.0.0.3', '10.0.0.2', None, None, 10.0, 20.0, 5.0)
+        ]
+        ping_results = _ping_results(rows)
+
+        self.assertEqual(len(ping_results), len(rows))
+        self.assertEqual(len(ping_results.ips), 4)
+        self.assertEqual(list(ping_results)[:-1], rows[:-1])
+        self.assertEqual(list(ping_results)[-1], (2, '10.0.0.3', '10.0.0.2', None, '', 10.0, 20.0, 5.0))
+        self.assertEqual(list(ping_results.column('dst_ip')), ['10.0.0.2'] * len(rows))
+
+
+class TestLatencyGrid(unittest.TestCase):
+    PING_RESULTS = TestGrid.PING_RESULTS
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_remove(self):
+        half = len(self.PING_RESULTS) // 2
+        grid = LatencyGrid(2, minimums=False, histogram=True).add(_ping_results(self.PING_RESULTS))
+        grid.remove(_ping_results(self.PING_RESULTS[half:]))
+        expected = LatencyGrid(2, minimums=False, histogram=True).add(
+            _ping_results(self.PING_RESULTS[:half])
+        )
+
+        np.testing.assert_array_equal(grid.counts, expected.counts)
+        np.testing.assert_array_equal(grid.histogram, expected.histogram)
+        np.testing.assert_allclose(grid.means(), expected.means())
+
+        with self.assertRaises(ValueError):
+            LatencyGrid(2).remove(_ping_results(self.PING_RESULTS))
+
+    def test_parallel(self):
+        random = np.random.RandomState(0)
+        rows = self.PING_RESULTS + [
+            _ping_result(lat, lon, rtt) for lat, lon, rtt in zip(
+                random.uniform(-85, 85, 300), random.uniform(-180, 180, 300),
+                random.uniform(1, 400, 300)
+            )
+        ]
+        ping_results = _ping_results(rows)
+
+        expected = LatencyGrid(3, histogram=True).add(ping_results)
+        # on top of the earlier results, as with a grid file
+        expected.add(ping_results)
+        grid = LatencyGrid(3, histogram=True).add(ping_results)
+        grid.add(ping_results, workers=3)
+
+        # the partial sums are added in another order
+        np.testing.assert_allclose(grid.sums, expected.sums)
+        for name in ('counts', 'minimums', 'histogram'):
+            np.testing.assert_array_equal(grid.arrays[name], expected.arrays[name], name)
+        np.testing.assert_allclose(_make_grid(ping_results, 2, workers=2), _make_grid(ping_results, 2))
+
+    def test_merge(self):
+        half = len(self.PING_RESULTS) // 2
+        whole = LatencyGrid(2, histogram=True).add(_ping_results(self.PING_RESULTS))
+        merged = LatencyGrid(2, histogram=True).add(_ping_results(self.PING_RESULTS[:half]))
+        merged.merge(LatencyGrid(2, histogram=True).add(_ping_results(self.PING_RESULTS[half:])))
+
+        np.testing.assert_allclose(merged.means(), whole.means())
+        np.testing.assert_allclose(merged.means(), _make_grid(_ping_results(self.PING_RESULTS), 2))
+        np.testing.assert_array_equal(merged.minimums, whole.minimums)
+        np.testing.assert_array_equal(merged.histogram, whole.histogram)
+
+        with self.assertRaises(ValueError):
+            merged.merge(LatencyGrid(3))
+
+    def test_files(self):
+        half = len(self.PING_RESULTS) // 2
+        first = os.path.join(self.tmp_dir, 'first.grid')
+        second = os.path.join(self.tmp_dir, 'second.grid')
+        LatencyGrid(2).add(_ping_results(self.PING_RESULTS[:half])).save(first)
+        LatencyGrid(2).add(_ping_results(self.PING_RESULTS[half:])).save(second)
+
+        merged = merge_grids([first, second])
+        expected = LatencyGrid(2).add(_ping_results(self.PING_RESULTS))
+        self.assertEqual(merged.density, 2)
+        np.testing.assert_allclose(merged.means(), expected.means())
+        np.testing.assert_array_equal(merged.minimums, expected.minimums)
+        # merging doesn't touch the files
+        np.testing.assert_allclose(
+            LatencyGrid.load(first).means(),
+            _make_grid(_ping_results(self.PING_RESULTS[:half]), 2)
+        )
+
+        # new results folded into the file in place
+        grid = LatencyGrid.load(first, writable=True)
+        grid.add(_ping_results(self.PING_RESULTS[half:]))
+        grid.flush()
+        del grid
+        np.testing.assert_allclose(LatencyGrid.load(first).means(), expected.means())
+
+    def test_quantiles(self):
+        rows = [_ping_result(10.0, 10.0, rtt) for rtt in (5.0, 15.0, 25.0, 95.0)]
+        grid = LatencyGrid(1, histogram=True).add(_ping_results(rows))
+
+        center = grid.counts.argmax()
+        self.assertEqual(grid.counts.flat[center], 4)
+        self.assertEqual(grid.quantiles(0.5).flat[center], 20)
+        self.assertEqual(grid.quantiles(1.0).flat[center], 100)
+        self.assertEqual(grid.minimums.flat[center], 5.0)
+        self.assertEqual(grid.quantiles(0.5).min(), BASE_VALUE)
+
+
+class TestRaster(unittest.TestCase):
+    def test_render_grid(self):
+        density = 2
+        grid = np.full((180 * density + 1, 360 * density), BASE_VALUE)
+        # latitude 50..60, longitude 80..100: in Russia
+        grid[280:300, 520:560] = 60.0
+
+        image = render_grid(grid, density, width=360)
+        self.assertEqual(image.shape, (180, 360, 3))
+
+        lut = _color_lut()
+        # the middle of the Pacific
+        self.assertEqual(tuple(image[90, 10]), OCEAN_COLOR)
+        # Russia, with and without data
+        self.assertEqual(tuple(image[35, 270]), tuple(lut[LUT_SIZE // 2, :3]))
+        self.assertEqual(tuple(image[25, 300]), NO_DATA_COLOR[:3])
+
+    def test_color_codes(self):
+        codes = _color_codes(np.array([BASE_VALUE, 30.0, 60.0, 90.0, 300.0]))
+        self.assertEqual(codes.tolist(), [LUT_SIZE, 0, LUT_SIZE // 2, LUT_SIZE - 1, LUT_SIZE - 1])
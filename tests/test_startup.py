@@ -0,0 +1,66 @@
+import subprocess
+import sys
+import unittest
+
+CLI_MODULES = [
+    'atlas_tools.latency_heatmap',
+    'atlas_tools.latency_countrymap',
+    'atlas_tools.dns_map',
+    'atlas_tools.reachability',
+    'atlas_tools.grid',
+    'atlas_tools.batch',
+    'atlas_tools.monitor',
+]
+
+# the plotting and geo stacks take seconds to import
+HEAVY_MODULES = [
+    'cartopy', 'folium', 'geopandas', 'geoviews', 'holoviews',
+    'matplotlib', 'pandas', 'pkg_resources', 'xarray',
+]
+
+IMPORT_CHECK = '''
+import sys
+import %s
+print(' '.join(name for name in %r if name in sys.modules))
+'''
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_imports(self):
+        for module in CLI_MODULES:
+            output = subprocess.check_output(
+                [sys.executable, '-c', IMPORT_CHECK % (module, HEAVY_MODULES)]
+            )
+            self.assertEqual(output.decode().strip(), '', module)
+
+    def test_bad_arguments(self):
+        for module in CLI_MODULES:
+            process = subprocess.Popen(
+                [sys.executable, '-m', module, '--no-such-flag'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            process.communicate()
+            self.assertEqual(process.returncode, 2, module)
+
+    def test_bad_values(self):
+        args = ['-m', 'atlas_tools.latency_heatmap', '-t', 'example.com', '-m', '1']
+        # rejected before any measurement is created
+        for flag, value in [('--neighbours', '0'), ('--max-distance', '-1'), ('--workers', '0')]:
+            process = subprocess.Popen(
+                [sys.executable] + args + [flag, value],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            _, stderr = process.communicate()
+            self.assertEqual(process.returncode, 2, flag)
+            self.assertIn('error: %s' % flag, stderr.decode())
+
+    def test_monitor_arguments(self):
+        # the monitor never stops its ongoing measurements
+        for flag, value in [('--timeout', '60'), ('--min-reported', '0.5'), ('--idle-timeout', '60')]:
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'atlas_tools.monitor', '-t', 'example.com', '-m', '1', flag, value],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            _, stderr = process.communicate()
+            self.assertEqual(process.returncode, 2, flag)
+            self.assertIn('unrecognized arguments: %s' % flag, stderr.decode())